@@ -2,13 +2,13 @@ import logging
 import asyncio
 import base64
 import os
+import sys
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from telegram import Bot
 from telegram.ext import Application
 from urllib.parse import quote_plus
-from common.file_manager import load_csv  # Load CSV file from file_manager
+from common.host import BotHost, run as run_host
 
 # Your Telegram bot token and Channel
 # LOAD TOKEN & CHANNEL_ID
@@ -16,27 +16,22 @@ load_dotenv()
 
 telegram_bot_token = os.getenv("BOT_TOKEN_ANNO")
 channel_id = os.getenv("CHANNEL_ID_ANNO")  # Replace with your Telegram channel name
+BOT_NAME = "anno_bot1"
+# Sends only; no updates to poll
+POLLING = False
+# Registrations arriving within this many seconds are folded into one edit
+ANNOUNCE_DELAY = 3.0
 
-# Enable logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Logging is set up by the host (common/log.py)
 logger = logging.getLogger(__name__)
 
-# Initialize Telegram Bot
-telegram_bot = Bot(token=telegram_bot_token)
+# Set by build_application
+bot_host: BotHost = None
+telegram_bot = None
 
-# Global variable to store games data
-games = []
 last_message_id = None
-
-def load_games():
-    """Load game data from the games.csv file."""
-    file_path = os.path.abspath("./store/games.csv")
-    if os.path.exists(file_path):
-        global games
-        games = load_csv(file_path)
-        logging.info(f"Loaded {len(games)} games from games.csv")
-    else:
-        logging.error(f"File not found: {file_path}")
+last_message_text = None
+pending_announcement = None
 
 def generate_registration_link(game_id):
     """Generate a deeplink for game registration."""
@@ -55,7 +50,7 @@ async def send_game_announcements():
     end_date = today + timedelta(days=7)
 
     # Filter upcoming games that are not fully booked
-    upcoming_games = [game for game in games if today <= datetime.strptime(game['date'], "%Y-%m-%d").date() <= end_date and int(game['spots_left']) > 0]
+    upcoming_games = [game for game in bot_host.catalog.games if today <= datetime.strptime(game['date'], "%Y-%m-%d").date() <= end_date and int(game['spots_left']) > 0]
 
     if not upcoming_games:
         logging.info("No upcoming games to announce.")
@@ -63,6 +58,8 @@ async def send_game_announcements():
 
     message = "📢 *Upcoming Games*\n\n"
     for game in upcoming_games:
+        # Built outside the f-string below: nested same-type quotes need Python 3.12
+        price = f"€{float(game['price_per_person']):.2f}"
         message += (
             f"🏆 *{escape_markdown(game['game_name'])}*\n"
             f"📍 About: {escape_markdown(game['description'])}\n"
@@ -70,11 +67,13 @@ async def send_game_announcements():
             f"🗓️ Date: {escape_markdown(game['date'])}\n"
             f"🕒 Time: {escape_markdown(game['time'])}\n"
             f"🎟️ Spots Available: {escape_markdown(str(game['spots_left']))}\n"
-            f"🎟️ Ticket Price: {escape_markdown(f'€{float(game['price_per_person']):.2f}')}\n"
+            f"🎟️ Ticket Price: {escape_markdown(price)}\n"
             f"[Register here]({generate_registration_link(game['game_id'])})\n\n"
         )
 
-    global last_message_id
+    global last_message_id, last_message_text
+    if message == last_message_text:
+        return
     try:
         if last_message_id:
             await telegram_bot.edit_message_text(chat_id=channel_id, message_id=last_message_id, text=message, parse_mode='MarkdownV2')
@@ -83,39 +82,44 @@ async def send_game_announcements():
             last_message_id = sent_message.message_id
             await telegram_bot.pin_chat_message(chat_id=channel_id, message_id=sent_message.message_id)
             logging.info("Pinned the announcement message.")
+        last_message_text = message
     except Exception as e:
         logging.error(f"Error sending or pinning message: {e}")
 
-async def monitor_game_updates():
-    """Monitor games.csv file for updates every 30 minutes and update the announcement."""
-    load_games()
+async def announce_later():
+    await asyncio.sleep(ANNOUNCE_DELAY)
     await send_game_announcements()
 
-async def main():
-    """Main entry point for the bot."""
-    load_games()
+async def on_catalog_change(event: dict):
+    """Update the announcement when games.csv changes (pushed by the registration bot)."""
+    global pending_announcement
+    if pending_announcement is None or pending_announcement.done():
+        pending_announcement = asyncio.create_task(announce_later())
 
-    # Initialize the bot application
-    app = Application.builder().token(telegram_bot_token).build()
-    await app.initialize()
+async def start_announcements(application: Application):
     await send_game_announcements()
 
-    # Schedule the game updates every 30 minutes
+    # Changes arrive as catalog events; the hourly run moves the 7-day window along
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(monitor_game_updates, 'interval', minutes=5)
+    scheduler.add_job(send_game_announcements, 'interval', hours=1)
     scheduler.start()
-
-    await app.start()
     logging.info("Bot is now online!")
 
-    # Keep the bot running
-    try:
-        await asyncio.Event().wait()
-    except KeyboardInterrupt:
-        await app.stop()
+def build_application(host: BotHost) -> Application:
+    """Set up the announcement bot on a shared host."""
+    global bot_host, telegram_bot
+    bot_host = host
+    app = (
+        Application.builder()
+        .token(telegram_bot_token)
+        .request(host.request())
+        .post_init(start_announcements)
+        .build()
+    )
+    telegram_bot = app.bot
+    host.catalog.subscribe(on_catalog_change)
+    return app
 
 if __name__ == "__main__":
-    try:
-        asyncio.run(main())
-    except (KeyboardInterrupt, SystemExit):
-        logging.info("Bot stopped.")
+    # Run this bot on its own; `python -m common.host reg_bot1 anno_bot1` runs both in one process
+    run_host(sys.modules[__name__])
@@ -0,0 +1,168 @@
+"""Async wrappers around the locked file storage in common.file_manager.
+
+All blocking file work, including waiting for another process's lock, runs
+on a small dedicated executor so the bot's event loop keeps serving updates
+while ``anno_bot1`` or a CLI holds a lock.
+
+    data = await aload_json(USER_DATA_FILE)
+
+    async with transaction(USER_DATA_FILE, timeout=5) as data:
+        data.setdefault(user_id, []).append(registration)
+    # saved atomically on exit, discarded if the block raises
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Callable, Dict, List
+from common.file_manager import (
+    LOCK_TIMEOUT, GAMES_CSV_FILE, file_lock, load_json, save_json, load_csv, update_game_csv,
+    read_json_unlocked, write_json_unlocked, update_user,
+)
+
+STORAGE_WORKERS = 4
+
+_executor = ThreadPoolExecutor(max_workers=STORAGE_WORKERS, thread_name_prefix="storage")
+# One in-process lock per file so coroutines queue here instead of parking executor threads
+_path_locks: Dict[str, asyncio.Lock] = {}
+
+
+def _path_lock(file_path: str) -> asyncio.Lock:
+    key = os.path.abspath(file_path)
+    lock = _path_locks.get(key)
+    if lock is None:
+        lock = _path_locks[key] = asyncio.Lock()
+    return lock
+
+
+async def run_io(func, *args, **kwargs):
+    """Run a blocking storage call on the storage executor."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, partial(func, *args, **kwargs))
+
+
+async def aload_json(file_path: str) -> dict:
+    return await run_io(load_json, file_path)
+
+
+async def asave_json(file_path: str, data: dict) -> None:
+    async with _path_lock(file_path):
+        await run_io(save_json, file_path, data)
+
+
+async def aload_csv(file_path: str) -> List[Dict[str, str]]:
+    return await run_io(load_csv, file_path)
+
+
+async def aupdate_game_csv(game_id: str, spots_registered: int) -> None:
+    async with _path_lock(GAMES_CSV_FILE):
+        await run_io(update_game_csv, game_id, spots_registered)
+
+
+async def aupdate_user(file_path: str, user_id: str, update: Callable[[List[dict]], List[dict]]) -> None:
+    """Streamed update of one user's entry; see file_manager.update_user."""
+    async with _path_lock(file_path):
+        await run_io(update_user, file_path, user_id, update)
+
+
+@asynccontextmanager
+async def transaction(file_path: str, timeout: float = LOCK_TIMEOUT):
+    """Async read-modify-write of a JSON file under its exclusive lock.
+
+    Raises asyncio.TimeoutError if the lock isn't acquired within ``timeout``.
+    """
+    deadline = time.monotonic() + timeout
+    await asyncio.wait_for(_path_lock(file_path).acquire(), timeout)
+    try:
+        remaining = max(0.0, deadline - time.monotonic())
+        lock = file_lock(file_path, timeout=remaining)
+        try:
+            await run_io(lock.__enter__)
+        except Exception as e:
+            raise asyncio.TimeoutError(f"Timed out waiting for lock on {file_path}") from e
+        try:
+            data = await run_io(read_json_unlocked, file_path)
+            yield data
+            await run_io(write_json_unlocked, file_path, data)
+        finally:
+            await run_io(lock.__exit__, None, None, None)
+    finally:
+        _path_lock(file_path).release()
+
+
+def _contention_worker(file_path: str, increments: int, result_queue) -> None:
+    """Benchmark worker: locked read-modify-write increments in its own process."""
+    latencies = []
+    for _ in range(increments):
+        started = time.perf_counter()
+        with file_lock(file_path, timeout=60):
+            data = read_json_unlocked(file_path)
+            data['counter'] = data.get('counter', 0) + 1
+            write_json_unlocked(file_path, data)
+        latencies.append(time.perf_counter() - started)
+    result_queue.put(latencies)
+
+
+async def _contention_benchmark(processes: int, increments: int) -> None:
+    import multiprocessing
+    import tempfile
+
+    file_path = os.path.join(tempfile.mkdtemp(prefix="storage_bench_"), "data.json")
+    write_json_unlocked(file_path, {'counter': 0})
+
+    result_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_contention_worker, args=(file_path, increments, result_queue))
+               for _ in range(processes)]
+
+    # Measure event loop responsiveness while this process also competes for the lock
+    lags = []
+    stop = asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lags.append(time.perf_counter() - started - 0.005)
+
+    async def async_writer():
+        latencies = []
+        for _ in range(increments):
+            started = time.perf_counter()
+            async with transaction(file_path, timeout=60) as data:
+                data['counter'] = data.get('counter', 0) + 1
+            latencies.append(time.perf_counter() - started)
+        return latencies
+
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    tick_task = asyncio.create_task(ticker())
+    latencies = await async_writer()
+    for _ in workers:
+        latencies += await run_io(result_queue.get)
+    for worker in workers:
+        await run_io(worker.join)
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick_task
+
+    counter = read_json_unlocked(file_path)['counter']
+    expected = (processes + 1) * increments
+    latencies.sort()
+    lags.sort()
+    print(f"{processes} processes + 1 async writer, {increments} increments each")
+    print(f"final counter: {counter} (expected {expected}) {'OK' if counter == expected else 'LOST UPDATES'}")
+    print(f"throughput: {expected / elapsed:.0f} txn/s")
+    print(f"txn latency p50={latencies[len(latencies) // 2] * 1000:.1f}ms "
+          f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms")
+    print(f"event loop lag p99={lags[int(len(lags) * 0.99)] * 1000:.2f}ms max={lags[-1] * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    import sys
+    process_count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    increment_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    asyncio.run(_contention_benchmark(process_count, increment_count))
@@ -0,0 +1,160 @@
+"""Resumable broadcast of a message to everyone registered for a game.
+
+Recipients come from the game_id -> registrants index. Messages go out
+concurrently, paced by a token bucket below Telegram's ~30 messages/s
+limit, and ``RetryAfter`` responses are honoured. Progress is checkpointed
+to ``store/broadcasts/<id>.json`` so a restart resumes with the recipients
+that were not reached yet; the checkpoint is deleted once the broadcast
+finishes.
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, Optional
+from telegram.error import Forbidden, RetryAfter, TelegramError
+from common.async_storage import aload_json, asave_json, run_io
+from common.rate_limit import TokenBucket
+from common.registrants import game_registrants
+
+BROADCAST_DIR = "./store/broadcasts"
+
+
+class Broadcaster:
+    def __init__(self, checkpoint_dir: str = BROADCAST_DIR, rate: float = 25.0, concurrency: int = 10,
+                 max_attempts: int = 3, checkpoint_every: int = 50):
+        self.checkpoint_dir = checkpoint_dir
+        self.rate = rate
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.checkpoint_every = checkpoint_every
+        self.bot = None
+        self.broadcasts: Dict[str, dict] = {}
+        self._tasks = set()
+
+    def _path(self, broadcast_id: str) -> str:
+        return os.path.join(self.checkpoint_dir, f"{broadcast_id}.json")
+
+    def _remove_checkpoint(self, broadcast_id: str) -> None:
+        path = self._path(broadcast_id)
+        for leftover in (path, f"{path}.lock"):
+            try:
+                os.remove(leftover)
+            except FileNotFoundError:
+                pass
+
+    async def start(self, bot) -> None:
+        """Attach the bot and resume unfinished broadcasts."""
+        self.bot = bot
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        for filename in sorted(os.listdir(self.checkpoint_dir)):
+            if not filename.endswith('.json'):
+                continue
+            state = await aload_json(os.path.join(self.checkpoint_dir, filename))
+            if state.get('status') == 'running':
+                logging.info(f"Resuming broadcast {state['id']} for game {state['game_id']}")
+                self._spawn(state)
+            elif state.get('id'):
+                # Finished before its checkpoint could be removed
+                await run_io(self._remove_checkpoint, state['id'])
+
+    async def broadcast(self, game_id: str, text: str, report_chat_id: Optional[str] = None) -> dict:
+        """Start a broadcast to the game's registrants and return its state."""
+        recipients = await run_io(game_registrants, game_id)
+        state = {
+            'id': f"{game_id}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:6]}",
+            'game_id': game_id,
+            'text': text,
+            'report_chat_id': report_chat_id,
+            'recipients': recipients,
+            'sent': [],
+            'failed': {},
+            'status': 'running',
+            'started': datetime.now().isoformat(),
+            'elapsed': 0.0,
+        }
+        await self._checkpoint(state)
+        self._spawn(state)
+        return state
+
+    def stats(self, state: dict) -> Dict[str, object]:
+        done = len(state['sent']) + len(state['failed'])
+        return {
+            'recipients': len(state['recipients']),
+            'sent': len(state['sent']),
+            'failed': len(state['failed']),
+            'blocked': sum(1 for error in state['failed'].values() if error == 'blocked'),
+            'pending': len(state['recipients']) - done,
+            'elapsed_s': round(state['elapsed'], 1),
+            'rate_per_s': round(done / state['elapsed'], 1) if state['elapsed'] else 0.0,
+        }
+
+    def _spawn(self, state: dict) -> None:
+        self.broadcasts[state['id']] = state
+        task = asyncio.create_task(self._run(state))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _checkpoint(self, state: dict) -> None:
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        # Copy the lists: sends keep appending while the file is written
+        snapshot = {**state, 'sent': list(state['sent']), 'failed': dict(state['failed'])}
+        await asave_json(self._path(state['id']), snapshot)
+
+    async def _send(self, state: dict, user_id: str, bucket: TokenBucket) -> None:
+        for attempt in range(1, self.max_attempts + 1):
+            while not bucket.take(time.monotonic()):
+                await asyncio.sleep(1 / self.rate)
+            try:
+                await self.bot.send_message(chat_id=user_id, text=state['text'])
+                state['sent'].append(user_id)
+                return
+            except RetryAfter as e:
+                retry_after = getattr(e.retry_after, 'total_seconds', lambda: e.retry_after)()
+                logging.warning(f"Broadcast {state['id']}: flood control, waiting {retry_after}s")
+                # Push the shared bucket into debt so every sender pauses, not just this one
+                bucket.tokens = min(bucket.tokens, 0.0) - retry_after * self.rate
+            except Forbidden:
+                # User blocked the bot; retrying won't help
+                state['failed'][user_id] = 'blocked'
+                return
+            except TelegramError as e:
+                if attempt == self.max_attempts:
+                    state['failed'][user_id] = str(e)
+                    return
+                await asyncio.sleep(attempt)
+        state['failed'][user_id] = 'retry limit'
+
+    async def _run(self, state: dict) -> None:
+        started = time.monotonic() - state['elapsed']
+        done = set(state['sent']) | set(state['failed'])
+        pending = [user_id for user_id in state['recipients'] if user_id not in done]
+        bucket = TokenBucket(self.rate, self.rate, time.monotonic())
+        semaphore = asyncio.Semaphore(self.concurrency)
+        since_checkpoint = 0
+
+        async def deliver(user_id: str) -> None:
+            nonlocal since_checkpoint
+            async with semaphore:
+                await self._send(state, user_id, bucket)
+                since_checkpoint += 1
+                if since_checkpoint >= self.checkpoint_every:
+                    since_checkpoint = 0
+                    state['elapsed'] = time.monotonic() - started
+                    await self._checkpoint(state)
+
+        await asyncio.gather(*(deliver(user_id) for user_id in pending))
+        state['elapsed'] = time.monotonic() - started
+        state['status'] = 'done'
+        state['finished'] = datetime.now().isoformat()
+        await run_io(self._remove_checkpoint, state['id'])
+
+        stats = self.stats(state)
+        logging.info(f"Broadcast {state['id']} finished: {stats}")
+        if state.get('report_chat_id'):
+            summary = "\n".join(f"{name}: {value}" for name, value in stats.items())
+            await self.bot.send_message(chat_id=state['report_chat_id'],
+                                        text=f"Broadcast {state['id']} finished\n{summary}")
@@ -0,0 +1,95 @@
+"""Shared in-memory copy of ``games.csv`` with change events.
+
+One Catalog is shared by every bot in the process. It is reloaded only
+when the file changes, and subscribers are called with an event whenever
+it does:
+
+    {'game_id': 'OP1' or None, 'reason': 'registration', 'version': 3}
+
+Bots publish a change right after they write ``games.csv`` (a registration
+reserves spots, a cancellation frees them), so the announcer reacts at once
+instead of on its next poll. ``watch()`` picks up edits made by hand.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable, Dict, List, Optional
+from common.async_storage import run_io
+from common.file_manager import GAMES_CSV_FILE, load_csv
+
+Subscriber = Callable[[dict], Awaitable[None]]
+
+
+class Catalog:
+    def __init__(self, csv_file: str = GAMES_CSV_FILE, metrics=None):
+        self.csv_file = csv_file
+        self.metrics = metrics
+        self.games: List[Dict[str, str]] = []
+        self.by_id: Dict[str, Dict[str, str]] = {}
+        self.version = 0
+        self._stamp = None
+        self._subscribers: List[Subscriber] = []
+        self._reload_lock = asyncio.Lock()
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.csv_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _read(self, force: bool):
+        """Read games.csv if it changed; returns (stamp, games) or None. Does file I/O."""
+        stamp = self._file_stamp()
+        if stamp is None or (stamp == self._stamp and not force):
+            return None
+        return stamp, load_csv(self.csv_file)
+
+    async def refresh(self, force: bool = False) -> bool:
+        """Reload games.csv off the event loop if it changed since the last load."""
+        async with self._reload_lock:
+            loaded = await run_io(self._read, force)
+            if loaded is None:
+                return False
+            self._stamp, games = loaded
+            # Swap whole objects so readers never see a half-built catalog
+            self.games = games
+            self.by_id = {game['game_id']: game for game in games if game.get('game_id')}
+            self.version += 1
+            if self.metrics:
+                self.metrics.inc('catalog_reloads')
+            return True
+
+    def get(self, game_id: str) -> Optional[Dict[str, str]]:
+        return self.by_id.get(game_id)
+
+    def subscribe(self, callback: Subscriber) -> None:
+        self._subscribers.append(callback)
+
+    async def changed(self, game_id: Optional[str] = None, reason: str = '') -> None:
+        """Reload after a write to games.csv and notify subscribers."""
+        await self.refresh(force=True)
+        self._publish({'game_id': game_id, 'reason': reason, 'version': self.version})
+
+    def _publish(self, event: dict) -> None:
+        if self.metrics:
+            self.metrics.inc('catalog_events', reason=event['reason'] or 'file')
+        for callback in self._subscribers:
+            asyncio.create_task(self._notify(callback, event))
+
+    async def _notify(self, callback: Subscriber, event: dict) -> None:
+        try:
+            await callback(event)
+        except Exception as e:
+            logging.error(f"Catalog subscriber {getattr(callback, '__name__', callback)} failed: {e}")
+
+    async def watch(self, interval: float = 30.0) -> None:
+        """Poll the file for changes made outside the bots."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                if await self.refresh():
+                    self._publish({'game_id': None, 'reason': '', 'version': self.version})
+            except Exception as e:
+                logging.error(f"Error reloading {self.csv_file}: {e}")
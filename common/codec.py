@@ -0,0 +1,395 @@
+"""Storage codecs for the registration store (``user_data.json``).
+
+The codec used to write the file comes from ``USER_DATA_CODEC``:
+
+* ``json``    - the old format, stdlib, indented (slow: indent disables the C encoder)
+* ``compact`` - stdlib JSON without indentation (default)
+* ``orjson``  - the same compact JSON, written and read by orjson (optional dependency)
+* ``msgpack`` - binary MessagePack (optional dependency)
+
+Reading never depends on the setting: the format is detected from the first
+byte, and JSON is parsed with orjson when it is installed. So switching
+codecs needs no migration - the file is rewritten in the new format on the
+next save - and ``python -m common.codec convert`` converts on demand.
+
+``iter_users`` streams ``(user_id, registrations)`` pairs without loading
+the whole file, for scans over large stores.
+
+    python -m common.codec convert store/user_data.json msgpack
+    python -m common.codec bench 10000 100000 1000000
+"""
+
+import abc
+import io
+import json
+import logging
+import os
+import struct
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+DEFAULT_CODEC = "compact"
+CHUNK_SIZE = 1 << 20
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class CodecUnavailable(ValueError):
+    """The file's format needs a package that isn't installed."""
+
+
+class Codec(abc.ABC):
+    name = ""
+    binary = False
+
+    @abc.abstractmethod
+    def dumps(self, data: dict) -> bytes:
+        ...
+
+    @abc.abstractmethod
+    def loads(self, raw: bytes) -> dict:
+        ...
+
+    def dump(self, data: dict, f) -> None:
+        """Write to a binary file."""
+        f.write(self.dumps(data))
+
+    @abc.abstractmethod
+    def dump_items(self, items: Iterable[Tuple[str, object]], f) -> None:
+        """Write (key, value) pairs as one object without holding them all in memory."""
+
+
+class CompactJsonCodec(Codec):
+    name = "compact"
+
+    def dumps(self, data: dict) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(self, raw: bytes) -> dict:
+        return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+    def _pair(self, key: str, value) -> bytes:
+        return self.dumps({key: value})[1:-1]
+
+    def dump_items(self, items, f) -> None:
+        separator = b'{'
+        for key, value in items:
+            f.write(separator + self._pair(key, value))
+            separator = b','
+        f.write(b'}' if separator == b',' else b'{}')
+
+
+class JsonCodec(CompactJsonCodec):
+    name = "json"
+
+    def dumps(self, data: dict) -> bytes:
+        return json.dumps(data, ensure_ascii=False, indent=4).encode('utf-8')
+
+    def dump(self, data: dict, f) -> None:
+        # The indenting encoder is pure Python either way; streaming it saves the copy
+        text = io.TextIOWrapper(f, encoding='utf-8', write_through=False)
+        json.dump(data, text, ensure_ascii=False, indent=4)
+        text.flush()
+        text.detach()
+
+    def dump_items(self, items, f) -> None:
+        separator = b'{\n    '
+        for key, value in items:
+            # Dumped inside a one-key object so it comes out indented one level, as in a full dump
+            pair = json.dumps({key: value}, ensure_ascii=False, indent=4)[6:-2]
+            f.write(separator + pair.encode('utf-8'))
+            separator = b',\n    '
+        f.write(b'\n}' if separator != b'{\n    ' else b'{}')
+
+
+class OrjsonCodec(CompactJsonCodec):
+    name = "orjson"
+
+    def dumps(self, data: dict) -> bytes:
+        return orjson.dumps(data)
+
+    def loads(self, raw: bytes) -> dict:
+        return orjson.loads(raw)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+    binary = True
+
+    def dumps(self, data: dict) -> bytes:
+        return msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, raw: bytes) -> dict:
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+
+    def dump_items(self, items, f) -> None:
+        # map32 header with the count patched in at the end; f must be seekable
+        start = f.tell()
+        f.write(b'\xdf\x00\x00\x00\x00')
+        packer = msgpack.Packer(use_bin_type=True)
+        count = 0
+        for key, value in items:
+            f.write(packer.pack(key) + packer.pack(value))
+            count += 1
+        end = f.tell()
+        f.seek(start + 1)
+        f.write(struct.pack('>I', count))
+        f.seek(end)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), CompactJsonCodec(), OrjsonCodec(), MsgpackCodec())}
+_DEPENDENCIES = {'orjson': lambda: orjson, 'msgpack': lambda: msgpack}
+_warned = set()
+
+
+def get_codec(name: str) -> Codec:
+    """Codec by name; ValueError if unknown, CodecUnavailable if its package isn't installed."""
+    codec = CODECS.get(name)
+    if codec is None:
+        raise ValueError(f"Unknown codec '{name}' (choose from {', '.join(CODECS)})")
+    if name in _DEPENDENCIES and _DEPENDENCIES[name]() is None:
+        raise CodecUnavailable(f"Codec '{name}' needs the {name} package (pip install {name})")
+    return codec
+
+
+def configured_codec() -> Codec:
+    """The codec for writing registrations, from USER_DATA_CODEC (falls back to compact)."""
+    name = os.getenv("USER_DATA_CODEC", DEFAULT_CODEC)
+    try:
+        return get_codec(name)
+    except ValueError as e:
+        if name not in _warned:
+            _warned.add(name)
+            logging.warning(f"{e}; using '{DEFAULT_CODEC}'")
+        return CODECS[DEFAULT_CODEC]
+
+
+def _is_msgpack(first: int) -> bool:
+    # fixmap, map16, map32
+    return 0x80 <= first <= 0x8f or first in (0xde, 0xdf)
+
+
+def detect_codec(raw: bytes) -> Codec:
+    """Codec that can read data starting with ``raw``; CodecUnavailable if it isn't installed."""
+    stripped = raw.lstrip()
+    if stripped and _is_msgpack(stripped[0]):
+        return get_codec('msgpack')
+    return CODECS['json']
+
+
+def loads(raw: bytes) -> dict:
+    if not raw.strip():
+        return {}
+    return detect_codec(raw[:16]).loads(raw)
+
+
+def load_file(file_path: str) -> dict:
+    """Read a store written by any codec."""
+    with open(file_path, 'rb') as f:
+        return loads(f.read())
+
+
+_NUMBER_CHARS = frozenset('0123456789+-.eE')
+
+
+def _iter_json_object(f) -> Iterator[Tuple[str, object]]:
+    """(key, value) pairs of a top-level JSON object, read in chunks."""
+    decoder = json.JSONDecoder()
+    buffer, pos, eof = "", 0, False
+
+    def fill() -> bool:
+        nonlocal buffer, pos, eof
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            eof = True
+            return False
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    def skip_whitespace() -> None:
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buffer) or not fill():
+                return
+
+    def may_continue(start: int, end: int) -> bool:
+        # A value that ends exactly at the buffer end may continue in the next
+        # chunk, and so may a number cut at '.', 'e' or a sign ("12." or "1e")
+        if end == len(buffer):
+            return True
+        return buffer[start] in '-0123456789' and all(char in _NUMBER_CHARS for char in buffer[end:])
+
+    def decode():
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof or not fill():
+                    raise
+                continue
+            if not eof and may_continue(pos, end) and fill():
+                continue
+            pos = end
+            return value
+
+    def expect(char: str) -> None:
+        nonlocal pos
+        skip_whitespace()
+        if pos >= len(buffer) or buffer[pos] != char:
+            raise ValueError(f"Expected '{char}' at offset {pos} of the current chunk")
+        pos += 1
+
+    expect('{')
+    skip_whitespace()
+    if pos < len(buffer) and buffer[pos] == '}':
+        return
+    while True:
+        skip_whitespace()
+        key = decode()
+        expect(':')
+        skip_whitespace()
+        yield key, decode()
+        skip_whitespace()
+        if pos < len(buffer) and buffer[pos] == '}':
+            return
+        expect(',')
+
+
+def iter_users(file_path: str) -> Iterator[Tuple[str, List[dict]]]:
+    """Stream (user_id, registrations) from a store without loading all of it."""
+    if not os.path.exists(file_path):
+        return
+    with open(file_path, 'rb') as f:
+        head = f.read(16)
+        if not head.strip():
+            return
+        f.seek(0)
+        if detect_codec(head).binary:
+            unpacker = msgpack.Unpacker(f, raw=False, strict_map_key=False, read_size=CHUNK_SIZE)
+            for _ in range(unpacker.read_map_header()):
+                key = unpacker.unpack()
+                yield key, unpacker.unpack()
+            return
+    with open(file_path, 'r', encoding='utf-8') as f:
+        yield from _iter_json_object(f)
+
+
+class StreamedUserData:
+    """Read-only ``items()``/``values()`` view of a store, streamed from disk on each call."""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+    def items(self) -> Iterator[Tuple[str, List[dict]]]:
+        return iter_users(self.file_path)
+
+    def values(self) -> Iterator[List[dict]]:
+        return (registrations for _, registrations in iter_users(self.file_path))
+
+
+def convert(file_path: str, codec_name: str) -> Dict[str, int]:
+    """Rewrite a store in another format (under its lock), streaming. Returns sizes in bytes."""
+    from common.file_manager import file_lock, write_store_items_unlocked
+    codec = get_codec(codec_name)
+    with file_lock(file_path):
+        before = os.path.getsize(file_path)
+        write_store_items_unlocked(file_path, iter_users(file_path), codec)
+    return {'before': before, 'after': os.path.getsize(file_path)}
+
+
+def _synthetic(count: int) -> dict:
+    data = {}
+    # One game_details dict per game, as the bot's interned records share them
+    games = [{'game_id': f"OP{game}", 'game_name': f"Game{game}", 'place': "StreetB",
+              'date': "2024-09-21", 'time': "21:00", 'price_per_person': "15"} for game in range(200)]
+    for i in range(count):
+        data.setdefault(str(100000000 + i // 3), []).append({
+            'lang': ('en', 'lv', 'ru')[i % 3],
+            'first_name': "Jānis", 'last_name': f"Bērziņš{i}", 'full_name': f"Jānis Bērziņš{i}",
+            'email': f"user{i}@example.com",
+            'cust_amount': i % 5 + 1,
+            'total_price': float((i % 5 + 1) * 15),
+            'invoice_number': f"OG_200924_{i}",
+            'pdf_path': f"./invoice_store/2024/09/{i:064x}.pdf",
+            'payment_link': f"https://checkout.stripe.com/c/pay/cs_test_{i:032x}",
+            'session_id': f"cs_test_{i:032x}",
+            'game_details': games[i % 200],
+            'payment_status': 'paid' if i % 4 else 'unpaid',
+            'canceled': i % 10 == 0,
+            'commit_token': f"{i:032x}",
+        })
+    return data
+
+
+def _bench_phase(phase: str, name: str, count: int, path: str) -> Tuple[float, float]:
+    """One benchmark phase; returns (seconds, peak RSS MiB of this process)."""
+    import resource
+    import time
+    users = (count + 2) // 3
+    if phase == 'dump':
+        data = _synthetic(count)
+        started = time.perf_counter()
+        with open(path, 'wb') as f:
+            CODECS[name].dump(data, f)
+    elif phase == 'load':
+        started = time.perf_counter()
+        assert len(load_file(path)) == users
+    else:
+        started = time.perf_counter()
+        assert sum(1 for _ in iter_users(path)) == users
+    elapsed = time.perf_counter() - started
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _benchmark(*counts: int) -> None:
+    """Dump/load time, size and peak memory per codec, and a streamed pass over the file.
+
+    Every phase runs in a fresh process, so its peak RSS is its own and large
+    counts don't pile up freed-but-kept memory from earlier phases.
+    """
+    import multiprocessing
+    import tempfile
+
+    names = [name for name in CODECS if name not in _DEPENDENCIES or _DEPENDENCIES[name]() is not None]
+    skipped = [name for name in CODECS if name not in names]
+    if skipped:
+        print(f"Not installed, skipped: {', '.join(skipped)}")
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as directory:
+        for count in counts or (10000, 100000):
+            print(f"\n{count} registrations ({(count + 2) // 3} users); peak RSS per phase")
+            print(f"{'codec':8} {'size MiB':>9} {'dump s':>8} {'load s':>8} {'stream s':>9} "
+                  f"{'load MiB':>9} {'stream MiB':>11}")
+            for name in names:
+                path = os.path.join(directory, f"user_data.{name}")
+                results = {}
+                for phase in ('dump', 'load', 'stream'):
+                    with context.Pool(1) as pool:
+                        results[phase] = pool.apply(_bench_phase, (phase, name, count, path))
+                size = os.path.getsize(path)
+                print(f"{name:8} {size / 2**20:9.1f} {results['dump'][0]:8.2f} {results['load'][0]:8.2f} "
+                      f"{results['stream'][0]:9.2f} {results['load'][1]:9.0f} {results['stream'][1]:11.0f}", flush=True)
+                os.remove(path)
+
+
+if __name__ == "__main__":
+    import sys
+    command = sys.argv[1] if len(sys.argv) > 1 else ""
+    if command == "convert" and len(sys.argv) == 4:
+        print(convert(sys.argv[2], sys.argv[3]))
+    elif command == "bench":
+        _benchmark(*(int(arg) for arg in sys.argv[2:]))
+    else:
+        print("Usage: python -m common.codec convert <file> <json|compact|orjson|msgpack>\n"
+              "       python -m common.codec bench [count ...]")
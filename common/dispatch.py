@@ -0,0 +1,188 @@
+"""Per-user ordered update dispatch with duplicate suppression.
+
+``PerUserUpdateProcessor`` plugs into python-telegram-bot's
+``ApplicationBuilder.concurrent_updates``. Updates from different users run
+concurrently, updates from one user run one at a time in arrival order, and
+repeats (same ``update_id``, or the same content from the same user within
+a short window, e.g. a double-tapped keyboard button) are dropped.
+
+A user's inline queries (a search typed in any chat) are ordered among
+themselves but don't wait behind, or take the queue places of, the user's
+conversation updates.
+
+Duplicates and updates rejected by ``admit`` (the rate limits) are dropped
+before they queue for their user. Only updates whose turn has come take one
+of the ``max_concurrent_updates`` running slots, and a user can have at most
+``max_queued_per_user`` updates waiting, so one user's burst can't hold up
+everybody else.
+
+``Idempotency`` makes a commit run once per token, e.g. a registration that
+gets submitted twice.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+from common.log import bind
+
+
+def _update_user_key(update: object) -> Optional[Hashable]:
+    if isinstance(update, Update):
+        if update.inline_query:
+            return ('inline', update.inline_query.from_user.id)
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return ('chat', update.effective_chat.id)
+    return None
+
+
+def _update_content_key(update: object) -> Optional[Hashable]:
+    if not isinstance(update, Update) or not update.effective_user:
+        return None
+    if update.message and update.message.text is not None:
+        return (update.effective_user.id, update.message.chat_id, 'text', update.message.text)
+    if update.callback_query and update.callback_query.data is not None:
+        return (update.effective_user.id, 'callback', update.callback_query.data)
+    return None
+
+
+class _ExpiringSet:
+    """Keys remembered for ``ttl`` seconds, oldest evicted first."""
+
+    def __init__(self, ttl: float, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items: 'OrderedDict[Hashable, float]' = OrderedDict()
+
+    def seen(self, key: Hashable, now: float) -> bool:
+        """Return True if key was added within ttl; otherwise add it."""
+        while self._items:
+            added = next(iter(self._items.values()))
+            if now - added <= self.ttl and len(self._items) <= self.max_size:
+                break
+            self._items.popitem(last=False)
+        if key in self._items:
+            return True
+        self._items[key] = now
+        return False
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """``admit(update)`` runs for every update that isn't a duplicate; False drops it."""
+
+    def __init__(self, max_concurrent_updates: int = 256, dedup_window: float = 2.0,
+                 update_id_ttl: float = 600.0, max_queued_per_user: int = 5,
+                 max_pending_updates: int = 10000,
+                 admit: Optional[Callable[[object], Awaitable[bool]]] = None):
+        # PTB's semaphore is held for the whole of do_process_update, including the wait
+        # for the user's turn, so it only bounds pending updates; running ones use _running
+        super().__init__(max_pending_updates)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self.max_queued_per_user = max_queued_per_user
+        self.admit = admit
+        self._update_ids = _ExpiringSet(update_id_ttl)
+        self._contents = _ExpiringSet(dedup_window)
+        # user key -> [lock, number of updates holding or waiting for it]
+        self._user_locks: Dict[Hashable, list] = {}
+        self.duplicates_dropped = 0
+        self.rejected = 0
+        self.queue_full = 0
+
+    @property
+    def dropped(self) -> int:
+        """Updates that never reached the handlers."""
+        return self.duplicates_dropped + self.rejected + self.queue_full
+
+    def stats(self) -> Dict[str, int]:
+        return {'duplicates_dropped': self.duplicates_dropped, 'rejected': self.rejected,
+                'queue_full': self.queue_full, 'users_waiting': len(self._user_locks)}
+
+    def is_duplicate(self, update: object) -> bool:
+        now = time.monotonic()
+        if isinstance(update, Update) and self._update_ids.seen(update.update_id, now):
+            return True
+        content_key = _update_content_key(update)
+        return content_key is not None and self._contents.seen(content_key, now)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        # Each update runs in its own task; everything it logs carries these fields
+        user_key = _update_user_key(update)
+        bind(update=getattr(update, 'update_id', None), user=user_key)
+
+        if self.is_duplicate(update):
+            self.duplicates_dropped += 1
+            logging.info(f"Dropped duplicate update {getattr(update, 'update_id', '?')}",
+                         extra={'event': 'duplicate_update'})
+            coroutine.close()
+            return
+
+        if self.admit is not None and not await self.admit(update):
+            self.rejected += 1
+            coroutine.close()
+            return
+
+        if user_key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._user_locks.get(user_key)
+        if entry is None:
+            entry = self._user_locks[user_key] = [asyncio.Lock(), 0]
+        elif entry[1] > self.max_queued_per_user:
+            # One running and max_queued_per_user waiting already
+            self.queue_full += 1
+            logging.info(f"Dropped update {getattr(update, 'update_id', '?')}: too many queued for the user",
+                         extra={'event': 'user_queue_full'})
+            coroutine.close()
+            return
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[user_key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+class Idempotency:
+    """Run a coroutine function once per token; repeats get the same result."""
+
+    def __init__(self, ttl: float = 3600.0):
+        self.ttl = ttl
+        self._results: 'OrderedDict[Hashable, tuple]' = OrderedDict()
+
+    async def once(self, token: Hashable, func: Callable[[], Awaitable]):
+        now = time.monotonic()
+        while self._results:
+            created = next(iter(self._results.values()))[0]
+            if now - created <= self.ttl:
+                break
+            self._results.popitem(last=False)
+
+        cached = self._results.get(token)
+        if cached is None:
+            future = asyncio.ensure_future(func())
+            self._results[token] = (now, future)
+        else:
+            future = cached[1]
+        try:
+            return await asyncio.shield(future)
+        except Exception:
+            # A failed commit may be retried with the same token
+            if self._results.get(token, (None, None))[1] is future:
+                del self._results[token]
+            raise
@@ -2,98 +2,240 @@ import csv
 import json
 import sqlite3
 import os
+import logging
+import tempfile
 import portalocker
-from typing import Optional, List, Dict
+from contextlib import contextmanager
+from typing import Callable, Optional, List, Dict, Tuple
+from common import codec
 
 GAMES_CSV_FILE = "./store/games.csv"
 USER_DATA_FILE = "./store/user_data.json"
 TRANSLATIONS_FILE = "./store/translations.json"
 DATABASE = "./common/tg_bot_db.db"
 
+# Seconds to wait for another process's lock before giving up
+LOCK_TIMEOUT = 10
+
+# Files written with the USER_DATA_CODEC codec; other JSON files stay indented
+CODEC_FILES = {os.path.abspath(USER_DATA_FILE)}
+
 def db_connect():
     """Connect to the SQLite database."""
     conn = sqlite3.connect(DATABASE)
     return conn
 
-def load_json(file_path: str) -> dict:
-    """Load JSON data from a file with file locking."""
+@contextmanager
+def file_lock(file_path: str, exclusive: bool = True, timeout: float = LOCK_TIMEOUT):
+    """Hold a lock on ``<file_path>.lock`` for the duration of the block.
+
+    Data files are replaced by rename, so the lock lives on a sidecar file
+    that is never replaced. Raises portalocker.LockException on timeout.
+    """
+    flags = (portalocker.LOCK_EX if exclusive else portalocker.LOCK_SH) | portalocker.LOCK_NB
+    with portalocker.Lock(f"{file_path}.lock", mode='a', timeout=timeout, flags=flags):
+        yield
+
+def _write_atomic(file_path: str, write, newline: Optional[str] = None, binary: bool = False) -> None:
+    """Write through a temp file in the same directory and rename it into place."""
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_', suffix=os.path.basename(file_path))
+    try:
+        with (os.fdopen(fd, 'wb') if binary else os.fdopen(fd, 'w', encoding='utf-8', newline=newline)) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def read_json_unlocked(file_path: str) -> dict:
+    """Load JSON (or any format common.codec writes); the caller holds the lock."""
     if os.path.exists(file_path):
         try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                portalocker.lock(file, portalocker.LOCK_SH)
-                data = json.load(file)
-                portalocker.unlock(file)
-                return data
-        except json.JSONDecodeError:
-            print(f"Error: Could not decode JSON from {file_path}")
+            return codec.load_file(file_path)
+        except codec.CodecUnavailable as e:
+            logging.error(f"Could not read {file_path}: {e}")
+            return {}
+        except ValueError:
+            logging.error(f"Could not decode JSON from {file_path}")
             return {}
     return {}
 
+def write_store_unlocked(file_path: str, data: dict, store_codec: codec.Codec) -> None:
+    """Atomically save data with the given codec; the caller holds the lock."""
+    _write_atomic(file_path, lambda f: store_codec.dump(data, f), binary=True)
 
-def save_json(file_path: str, data: dict) -> None:
-    """Save JSON data to a file with file locking."""
-    with open(file_path, 'w', encoding='utf-8') as f:
-        portalocker.lock(f, portalocker.LOCK_EX)
-        json.dump(data, f, ensure_ascii=False, indent=4)
-        portalocker.unlock(f)
+def write_store_items_unlocked(file_path: str, items, store_codec: codec.Codec) -> None:
+    """Like write_store_unlocked, but from an iterable of (key, value) pairs, written as they come."""
+    _write_atomic(file_path, lambda f: store_codec.dump_items(items, f), binary=True)
 
+def write_json_unlocked(file_path: str, data: dict) -> None:
+    """Atomically save JSON data; the caller holds the lock."""
+    if os.path.abspath(file_path) in CODEC_FILES:
+        write_store_unlocked(file_path, data, codec.configured_codec())
+        return
+    _write_atomic(file_path, lambda f: json.dump(data, f, ensure_ascii=False, indent=4))
 
-def load_csv(file_path: str) -> List[Dict[str, str]]:
-    """Load CSV data from a file with file locking."""
+def read_csv_unlocked(file_path: str) -> List[Dict[str, str]]:
+    """Load CSV data; the caller holds the lock."""
     if os.path.exists(file_path):
         try:
             with open(file_path, newline='', encoding='utf-8') as file:
-                portalocker.lock(file, portalocker.LOCK_SH)
-                data = list(csv.DictReader(file))
-                portalocker.unlock(file)
-                return data
+                return list(csv.DictReader(file))
         except Exception as e:
-            print(f"Error reading CSV: {e}")
+            logging.error(f"Error reading CSV: {e}")
             return []
     return []
 
+def write_csv_unlocked(file_path: str, rows: List[Dict[str, str]]) -> None:
+    """Atomically save CSV rows; the caller holds the lock."""
+    def write(f):
+        writer = csv.DictWriter(f, fieldnames=rows[0].keys())
+        writer.writeheader()
+        writer.writerows(rows)
+    _write_atomic(file_path, write, newline='')
 
-def update_game_csv(game_id: str, spots_registered: int) -> None:
-    """Update the game CSV with new registration data."""
-    rows = load_csv(GAMES_CSV_FILE)
-    updated = False
+
+def load_json(file_path: str) -> dict:
+    """Load JSON data from a file with file locking."""
+    if not os.path.exists(file_path):
+        return {}
+    with file_lock(file_path, exclusive=False):
+        return read_json_unlocked(file_path)
+
+
+def save_json(file_path: str, data: dict) -> None:
+    """Save JSON data to a file with file locking."""
+    with file_lock(file_path):
+        write_json_unlocked(file_path, data)
+
+
+def load_csv(file_path: str) -> List[Dict[str, str]]:
+    """Load CSV data from a file with file locking."""
+    if not os.path.exists(file_path):
+        return []
+    with file_lock(file_path, exclusive=False):
+        return read_csv_unlocked(file_path)
+
+
+def update_game_csv_unlocked(game_id: str, spots_registered: int) -> bool:
+    """Update one game's spots in games.csv; the caller holds the lock."""
+    rows = read_csv_unlocked(GAMES_CSV_FILE)
     for row in rows:
         if row['game_id'] == game_id:
             logging.info(f"Updating game {game_id}: spots_registered={spots_registered}")
             row['spots_registered'] = str(max(0,spots_registered))
             row['spots_left'] = str(max(0, int(row['spots_all']) - spots_registered))
-            updated = True
-            break
+            write_csv_unlocked(GAMES_CSV_FILE, rows)
+            logging.info(f"Game {game_id} updated successfully in games.csv.")
+            return True
+    logging.warning(f"Game ID {game_id} not found in {GAMES_CSV_FILE}.")
+    return False
+
+
+def update_game_csv(game_id: str, spots_registered: int) -> None:
+    """Update the game CSV with new registration data."""
+    try:
+        with file_lock(GAMES_CSV_FILE):
+            update_game_csv_unlocked(game_id, spots_registered)
+    except Exception as e:
+        logging.error(f"Error updating CSV: {e}")
 
-    if updated:
-        try:
-            with open(GAMES_CSV_FILE, 'w', newline='',
-                      encoding='utf-8') as file:
-                portalocker.lock(file, portalocker.LOCK_EX)
-                writer = csv.DictWriter(file, fieldnames=rows[0].keys())
-                writer.writeheader()
-                writer.writerows(rows)
-                portalocker.unlock(file)
-                logging.info(f"Game {game_id} updated successfully in games.csv.")
-        except Exception as e:
-            print(f"Error updating CSV: {e}")
-    else:
-        logging.warning(f"Game ID {game_id} not found in {GAMES_CSV_FILE}.")
+
+def reserve_game_spots(game_id: str, spots: int) -> bool:
+    """Add spots to a game's registered count as it is in games.csv now.
+
+    Returns False without changing anything if the game doesn't have that many spots left.
+    """
+    with file_lock(GAMES_CSV_FILE):
+        game = next((row for row in read_csv_unlocked(GAMES_CSV_FILE) if row['game_id'] == game_id), None)
+        if not game:
+            logging.warning(f"Game ID {game_id} not found in {GAMES_CSV_FILE}.")
+            return False
+        spots_registered = int(game.get('spots_registered') or 0) + spots
+        if spots_registered > int(game.get('spots_all') or 0):
+            logging.info(f"Game {game_id} has no room for {spots} more spots.")
+            return False
+        return update_game_csv_unlocked(game_id, spots_registered)
+
+
+def release_game_spots(game_id: str, spots: int) -> bool:
+    """Give back spots taken by reserve_game_spots."""
+    with file_lock(GAMES_CSV_FILE):
+        game = next((row for row in read_csv_unlocked(GAMES_CSV_FILE) if row['game_id'] == game_id), None)
+        if not game:
+            logging.warning(f"Game ID {game_id} not found in {GAMES_CSV_FILE}.")
+            return False
+        return update_game_csv_unlocked(game_id, int(game.get('spots_registered') or 0) - spots)
 
 
 def store_user_data(user_id: str, user_info: dict) -> None:
     """Store user data in a JSON file."""
-    data = load_json(USER_DATA_FILE)
-    if user_id not in data:
-        data[user_id] = []
-    data[user_id].append(user_info)
-    save_json(USER_DATA_FILE, data)
+    with file_lock(USER_DATA_FILE):
+        data = read_json_unlocked(USER_DATA_FILE)
+        if user_id not in data:
+            data[user_id] = []
+        data[user_id].append(user_info)
+        write_json_unlocked(USER_DATA_FILE, data)
+
+
+def load_user(file_path: str, user_id: str) -> List[dict]:
+    """One user's registrations, streamed out of the file without loading the other users."""
+    if not os.path.exists(file_path):
+        return []
+    with file_lock(file_path, exclusive=False):
+        try:
+            for key, registrations in codec.iter_users(file_path):
+                if key == user_id:
+                    return registrations
+        except codec.CodecUnavailable as e:
+            logging.error(f"Could not read {file_path}: {e}")
+        except ValueError:
+            logging.error(f"Could not decode JSON from {file_path}")
+    return []
+
+
+def update_user(file_path: str, user_id: str, update: Callable[[List[dict]], List[dict]]) -> None:
+    """Replace one user's registrations with ``update(stored)``, streaming the rest of the store through.
+
+    A new user is added at the end. Raises ValueError if the store can't be read.
+    """
+    def items():
+        found = False
+        for key, registrations in codec.iter_users(file_path):
+            if key == user_id:
+                found = True
+                registrations = update(registrations)
+            yield key, registrations
+        if not found:
+            yield user_id, update([])
+
+    with file_lock(file_path):
+        write_store_items_unlocked(file_path, items(), codec.configured_codec())
+
+
+def find_registrations(file_path: str, predicate: Callable[[dict], bool]) -> List[Tuple[str, dict]]:
+    """(user_id, registration) pairs matching ``predicate``, streamed; only the matches are kept."""
+    if not os.path.exists(file_path):
+        return []
+    found = []
+    with file_lock(file_path, exclusive=False):
+        try:
+            for user_id, registrations in codec.iter_users(file_path):
+                found.extend((user_id, registration) for registration in registrations if predicate(registration))
+        except codec.CodecUnavailable as e:
+            logging.error(f"Could not read {file_path}: {e}")
+        except ValueError:
+            logging.error(f"Could not decode JSON from {file_path}")
+    return found
 
 
 def get_user_data(user_id: str) -> List[dict]:
-    """Retrieve user data from the JSON file."""
-    user_data = load_json(USER_DATA_FILE)
-    return user_data.get(user_id, {})
+    """Retrieve one user's registrations without loading the other users."""
+    return load_user(USER_DATA_FILE, user_id)
 
 
 def get_game_info(game_id: str) -> Optional[Dict[str, str]]:
@@ -104,37 +246,55 @@ def get_game_info(game_id: str) -> Optional[Dict[str, str]]:
             return game
     return None
 
-def cancel_registration_fun(user_id: str, invoice_number: str) -> bool:
-    """Cancel a registration based on invoice number."""
-    user_data = load_json(USER_DATA_FILE) #Make sure to modify the global variable
+def cancel_registration_fun(user_id: str, invoice_number: str, canceled_at: Optional[str] = None) -> Optional[dict]:
+    """Cancel a registration based on invoice number (canceled_at: when, for the report day buckets).
 
-    games = load_csv(GAMES_CSV_FILE)
+    Returns the registration as stored once canceled (read under the lock, so
+    e.g. whether its payment was already recorded is settled), or None.
+    """
+    # Lock order is always user_data.json, then games.csv
+    with file_lock(USER_DATA_FILE):
+        # Stream the store: only this user's registrations are held in memory
+        try:
+            registrations = next((value for key, value in codec.iter_users(USER_DATA_FILE) if key == user_id), [])
+        except ValueError as e:
+            logging.error(f"Could not read {USER_DATA_FILE}: {e}")
+            return None
+
+        user_registration = None
+        for registration in registrations:
+            if registration.get('invoice_number') == invoice_number:
+                user_registration = registration
+                break
+        if not user_registration:
+            logging.error(f"Registration with invoice number {invoice_number} not found for user {user_id}.")
+            return None
+        if user_registration.get('canceled'):
+            # Its spots were given back by the first cancellation
+            logging.info(f"Registration {invoice_number} of user {user_id} is already canceled.")
+            return user_registration
 
-    user_registration = None
-    for registration in user_data.get(user_id, []):
-        if registration.get('invoice_number') == invoice_number:
-            user_registration = registration
-            break
-    if user_registration:
         # Update user_data with canceled flag
         user_registration['canceled'] = "canceled"
+        if canceled_at:
+            user_registration['canceled_at'] = canceled_at
 
         # Update games.csv if spots were registered
         game_id = user_registration.get('game_details', {}).get('game_id')
         if game_id:
             spots_registered = int(user_registration.get('cust_amount', 0))
-            # Search for the game by game_id in the games list
-            game = next((game for game in games if game['game_id'] == game_id), None)
+            with file_lock(GAMES_CSV_FILE):
+                games = read_csv_unlocked(GAMES_CSV_FILE)
+                # Search for the game by game_id in the games list
+                game = next((game for game in games if game['game_id'] == game_id), None)
 
-            if game:
+                if not game:
+                    logging.error(f"Game with ID {game_id} not found in games.csv.")
+                    return None
                 # Adjust the spots_registered and update games.csv
                 updated_spots_registered = int(game['spots_registered']) - spots_registered
-                update_game_csv(game_id, updated_spots_registered)
-            else:
-                logging.error(f"Game with ID {game_id} not found in games.csv.")
-                return False
-        save_json(USER_DATA_FILE, user_data)  # Save user data
-        return True
-    else:
-        logging.error(f"Registration with invoice number {invoice_number} not found for user {user_id}.")
-        return False
+                update_game_csv_unlocked(game_id, updated_spots_registered)
+        # Save user data: copy the store through, swapping in this user's registrations
+        items = ((key, registrations if key == user_id else value) for key, value in codec.iter_users(USER_DATA_FILE))
+        write_store_items_unlocked(USER_DATA_FILE, items, codec.configured_codec())
+        return user_registration
@@ -0,0 +1,254 @@
+"""In-memory search index over the game catalog for inline queries.
+
+Every game gets a lowercase search text (id, name, place, date in both
+``YYYY-MM-DD`` and ``DD.MM`` form, time). The index keeps, sorted by date:
+
+* a posting list per 1-2 character token prefix, for very short queries,
+* a posting list per trigram of the search text, for everything longer.
+
+A query term of three or more characters is looked up by its rarest
+trigram, so both prefixes ("gam") and infixes ("ame3") match; candidates
+are then checked against the full search text. Posting lists are walked in
+date order from today, so a lookup stops as soon as ``limit`` games match.
+
+When the shared catalog reloads ``games.csv``, only added, changed or
+removed games are re-indexed; a change to one known game (a registration or
+cancellation) re-indexes just that game. Answers are cached per query until
+the next change.
+"""
+
+import base64
+import re
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote_plus
+
+SEARCH_FIELDS = ('game_id', 'game_name', 'place', 'date', 'time')
+_TOKEN_RE = re.compile(r"[^\W_]+", re.UNICODE)
+_DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def deeplink_payload(game_id: str) -> str:
+    """The /start payload the registration bot decodes (same as the announcement links)."""
+    return base64.urlsafe_b64encode(f"game_id={quote_plus(game_id)}".encode()).decode()
+
+
+def search_text(game: Dict[str, str]) -> str:
+    parts = [game.get(field, '') for field in SEARCH_FIELDS]
+    date = game.get('date', '')
+    if _DATE_RE.fullmatch(date):
+        parts.append(f"{date[8:10]}.{date[5:7]}")
+    return " ".join(parts).casefold()
+
+
+def trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class GameIndex:
+    """Prefix/trigram index of games, kept sorted by (date, time, name)."""
+
+    def __init__(self):
+        # game_id -> (posting entry, row, index keys)
+        self.games: Dict[str, tuple] = {}
+        self.postings: Dict[str, list] = {}
+        self.version = 0
+
+    def __len__(self) -> int:
+        return len(self.games)
+
+    @staticmethod
+    def _entry(game: Dict[str, str]) -> tuple:
+        # Posting entry: sorts by date, time and name, and carries the search
+        # text so candidates are checked without another lookup
+        return (game.get('date', ''), game.get('time', ''), game.get('game_name', ''), game['game_id'],
+                search_text(game))
+
+    @staticmethod
+    def _keys(text: str) -> set:
+        keys = trigrams(text)
+        for token in _TOKEN_RE.findall(text):
+            keys.add(token[:1])
+            keys.add(token[:2])
+        return keys
+
+    def _add(self, game: Dict[str, str], bulk: bool = False) -> None:
+        entry = self._entry(game)
+        keys = self._keys(entry[4])
+        self.games[game['game_id']] = (entry, game, keys)
+        for key in keys:
+            posting = self.postings.setdefault(key, [])
+            if bulk:
+                posting.append(entry)
+            else:
+                insort(posting, entry)
+
+    def _remove(self, game_id: str) -> None:
+        entry, _, keys = self.games.pop(game_id)
+        for key in keys:
+            posting = self.postings[key]
+            del posting[bisect_left(posting, entry)]
+            if not posting:
+                del self.postings[key]
+
+    def build(self, games: List[Dict[str, str]]) -> None:
+        self.games, self.postings = {}, {}
+        # Adding in rank order leaves every posting list sorted
+        for game in sorted((game for game in games if game.get('game_id')), key=self._entry):
+            self._add(game, bulk=True)
+        self.version += 1
+
+    def sync(self, games: List[Dict[str, str]]) -> Tuple[int, int, int]:
+        """Re-index only what changed; returns (added, changed, removed)."""
+        current = {game['game_id']: game for game in games if game.get('game_id')}
+        added = changed = 0
+        for game_id, game in current.items():
+            entry = self.games.get(game_id)
+            if entry is None:
+                added += 1
+            elif entry[1] != game:
+                changed += 1
+                self._remove(game_id)
+            else:
+                continue
+            self._add(game)
+        removed = [game_id for game_id in self.games if game_id not in current]
+        for game_id in removed:
+            self._remove(game_id)
+        if added or changed or removed:
+            self.version += 1
+        return added, changed, len(removed)
+
+    def update(self, game_id: str, game: Optional[Dict[str, str]]) -> bool:
+        """Re-index one game (None: it was removed); returns whether it changed."""
+        indexed = self.games.get(game_id)
+        if indexed is None and not game or indexed is not None and indexed[1] == game:
+            return False
+        if indexed is not None:
+            self._remove(game_id)
+        if game:
+            self._add(game)
+        self.version += 1
+        return True
+
+    def _posting(self, term: str) -> list:
+        if len(term) < 3:
+            return self.postings.get(term, [])
+        return min((self.postings.get(gram, []) for gram in trigrams(term)), key=len)
+
+    def search(self, query: str, since: str = '', limit: int = 50) -> List[Dict[str, str]]:
+        """Games matching every term of the query, from date ``since`` on, soonest first."""
+        terms = query.casefold().split()
+        if not terms:
+            return []
+        posting = min((self._posting(term) for term in terms), key=len)
+        results = []
+        for position in range(bisect_left(posting, (since,)), len(posting)):
+            entry = posting[position]
+            if all(term in entry[4] for term in terms):
+                results.append(self.games[entry[3]][1])
+                if len(results) >= limit:
+                    break
+        return results
+
+
+def build_index(games: List[Dict[str, str]]) -> GameIndex:
+    """A fresh index of a catalog snapshot; touches no shared state, so it can run in a worker thread."""
+    index = GameIndex()
+    index.build(games)
+    return index
+
+
+class GameSearch:
+    """GameIndex over the catalog snapshots it is given, with a per-query cache."""
+
+    def __init__(self, cache_size: int = 1000):
+        self.cache_size = cache_size
+        self.index = GameIndex()
+        self._cache: 'OrderedDict[tuple, list]' = OrderedDict()
+
+    def load(self, games: List[Dict[str, str]]) -> None:
+        """Index a catalog snapshot: a full build the first time, then only the changes.
+
+        The first build may run in a worker thread (the new index is swapped
+        in when done); later calls update the index in place and belong on
+        the event loop that serves searches.
+        """
+        if not len(self.index):
+            self.index = build_index(games)
+        else:
+            self.index.sync(games)
+        self._cache.clear()
+
+    def replace(self, index: GameIndex) -> None:
+        """Swap in an index built by build_index (on the event loop that serves searches)."""
+        self.index = index
+        self._cache.clear()
+
+    def update(self, game_id: str, game: Optional[Dict[str, str]]) -> None:
+        """Re-index one game after it changed; cheap enough for the event loop."""
+        if self.index.update(game_id, game):
+            self._cache.clear()
+
+    def matches(self, term: str) -> bool:
+        """Whether any game, past or future, matches the term; bypasses the cache."""
+        return bool(self.index.search(term, limit=1))
+
+    def search(self, query: str, limit: int = 50, since: Optional[str] = None) -> List[Dict[str, str]]:
+        since = datetime.now().strftime("%Y-%m-%d") if since is None else since
+        key = (query.casefold().strip(), since, limit)
+        results = self._cache.get(key)
+        if results is None:
+            results = self.index.search(query, since, limit)
+            self._cache[key] = results
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        return results
+
+
+def _benchmark(count: int = 50000, queries: int = 2000) -> None:
+    """Build and query a synthetic catalog."""
+    import random
+    random.seed(1)
+    places = [f"Street{chr(65 + i)}" for i in range(26)] + ["Arena Riga", "Park Central", "Old Town Hall"]
+    games = [{
+        'game_id': f"OP{i}",
+        'game_name': f"{random.choice(['Game', 'Quiz', 'Match', 'Cup', 'Night'])}{i}",
+        'place': random.choice(places),
+        'date': f"2025-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}",
+        'time': random.choice(["18:00", "19:30", "21:00"]),
+        'price_per_person': "10", 'spots_left': "20",
+    } for i in range(count)]
+
+    index = GameIndex()
+    started = time.perf_counter()
+    index.build(games)
+    print(f"build {count} games: {(time.perf_counter() - started) * 1000:.0f} ms, {len(index.postings)} keys")
+
+    samples = ["g", "qu", "game1", "ame12", "arena", "street", "riga 21:00", "14.03", "2025-06", "cup 19:30 park", "zzz"]
+    for sample in samples:
+        started = time.perf_counter()
+        for _ in range(queries):
+            found = index.search(sample, "2025-01-01", 50)
+        elapsed = (time.perf_counter() - started) / queries * 1e6
+        print(f"{sample!r:18} {len(found):3} results  {elapsed:8.1f} us/query")
+
+    changed = [dict(game, place="Moved Arena") if i % 1000 == 0 else game for i, game in enumerate(games)]
+    started = time.perf_counter()
+    result = index.sync(changed)
+    print(f"sync {result[1]} changed games: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+    booked = dict(changed[count // 2], spots_left="19")
+    started = time.perf_counter()
+    index.update(booked['game_id'], booked)
+    print(f"update 1 game: {(time.perf_counter() - started) * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    import sys
+    _benchmark(*(int(arg) for arg in sys.argv[1:3]))
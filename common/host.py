@@ -0,0 +1,161 @@
+"""Run several bots in one asyncio process.
+
+Every bot module exposes ``build_application(host)`` and gets from the
+host:
+
+* ``host.catalog`` - one shared copy of games.csv with change events,
+* ``host.request()`` - a Bot API request object on one shared httpx
+  connection pool,
+* ``host.metrics`` - one metrics registry.
+
+    python -m common.host reg_bot1 anno_bot1
+
+Running ``reg_bot1.py`` or ``anno_bot1.py`` directly starts a host with
+just that bot.
+"""
+
+import asyncio
+import importlib
+import logging
+import signal
+import time
+from typing import List, Tuple
+import httpx
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+from telegram.request import HTTPXRequest
+from common.catalog import Catalog
+from common.file_manager import GAMES_CSV_FILE
+from common import log
+from common.metrics import Metrics
+
+HTTP_POOL_SIZE = 32
+CATALOG_POLL_INTERVAL = 30.0
+
+
+class SharedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest on a client owned by the host.
+
+    The client is closed by the host, not when one bot shuts down.
+    """
+
+    def __init__(self, client: httpx.AsyncClient, metrics: Metrics):
+        self._shared_client = client
+        self._metrics = metrics
+        super().__init__()
+
+    def _build_client(self) -> httpx.AsyncClient:
+        return self._shared_client
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        # The URL ends with the Bot API method; the token is never recorded
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.monotonic()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            self._metrics.inc('telegram_errors', method=api_method, error=type(e).__name__)
+            raise
+        self._metrics.observe('telegram_seconds', time.monotonic() - started, method=api_method)
+        self._metrics.inc('telegram_requests', method=api_method, status=code)
+        return code, payload
+
+
+class BotHost:
+    def __init__(self, games_csv_file: str = GAMES_CSV_FILE, pool_size: int = HTTP_POOL_SIZE,
+                 catalog_poll_interval: float = CATALOG_POLL_INTERVAL):
+        self.metrics = Metrics()
+        self.metrics.add_source('logging', log.stats)
+        self.catalog = Catalog(games_csv_file, metrics=self.metrics)
+        self.catalog_poll_interval = catalog_poll_interval
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(connect=5.0, read=5.0, write=5.0, pool=1.0),
+        )
+        # (name, application, poll for updates)
+        self.applications: List[Tuple[str, Application, bool]] = []
+        self._stop = asyncio.Event()
+
+    def request(self) -> SharedHTTPXRequest:
+        """Request object for ``Application.builder().request(...)``."""
+        return SharedHTTPXRequest(self.http, self.metrics)
+
+    def add(self, name: str, application: Application, polling: bool = True) -> None:
+        async def count_update(update: object, context) -> None:
+            self.metrics.inc('updates', bot=name)
+
+        application.add_handler(TypeHandler(Update, count_update), group=-2)
+        self.applications.append((name, application, polling))
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Windows: Ctrl+C cancels asyncio.run instead
+                pass
+
+        await self.catalog.refresh()
+        watcher = asyncio.create_task(self.catalog.watch(self.catalog_poll_interval))
+        started = []
+        try:
+            for name, application, polling in self.applications:
+                await application.initialize()
+                started.append((name, application, polling))
+                # post_init is only called by run_polling, which the host doesn't use
+                if application.post_init:
+                    await application.post_init(application)
+                if polling:
+                    await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+                await application.start()
+                logging.info(f"Bot {name} started")
+            await self._stop.wait()
+        finally:
+            watcher.cancel()
+            for name, application, polling in reversed(started):
+                try:
+                    if polling and application.updater.running:
+                        await application.updater.stop()
+                    if application.running:
+                        await application.stop()
+                    await application.shutdown()
+                    if application.post_shutdown:
+                        await application.post_shutdown(application)
+                except Exception as e:
+                    logging.error(f"Error stopping bot {name}: {e}")
+            await self.http.aclose()
+
+
+def run(*modules) -> None:
+    """Start a host with the bots of the given modules (each has build_application(host))."""
+    log.setup_logging()
+
+    async def main():
+        host = BotHost()
+        for module in modules:
+            name = getattr(module, 'BOT_NAME', module.__name__)
+            host.add(name, module.build_application(host), polling=getattr(module, 'POLLING', True))
+        await host.run()
+
+    try:
+        asyncio.run(main())
+    except (KeyboardInterrupt, SystemExit):
+        logging.info("Host stopped.")
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 2:
+        print("Usage: python -m common.host <bot module> [<bot module> ...]")
+    else:
+        run(*(importlib.import_module(name) for name in sys.argv[1:]))
@@ -0,0 +1,259 @@
+"""Invoice archive.
+
+Invoices are stored content-addressed under date shards:
+
+    invoice_store/<YYYY>/<MM>/<sha256>.pdf[.gz]
+
+Identical PDFs are stored once. ``manifest.json`` maps invoice numbers
+(``OG_<ddmmyy>_<n>``) to their blob and keeps per-day invoice counters so
+new numbers can be issued without listing the directory. A blob's age for
+retention counts from the last invoice that referenced it.
+"""
+
+import gzip
+import hashlib
+import os
+import shutil
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Tuple
+from common.file_manager import load_json, file_lock, read_json_unlocked, write_json_unlocked
+
+ARCHIVE_DIR = "./invoice_store"
+MANIFEST_FILE = os.path.join(ARCHIVE_DIR, "manifest.json")
+CACHE_DIR = os.path.join(ARCHIVE_DIR, "cache")
+PDF_SETTINGS_FILE = "./store/pdf_settings.json"
+
+DEFAULT_POLICY = {
+    "compress_after_days": 30,  # gzip blobs older than this
+    "retain_days": 365,         # offload (or delete) blobs older than this
+    "offload_dir": "",          # empty - delete expired blobs instead of moving
+}
+
+
+def _with_defaults(manifest: dict) -> dict:
+    manifest.setdefault('invoices', {})
+    manifest.setdefault('blobs', {})
+    manifest.setdefault('counters', {})
+    return manifest
+
+
+# (mtime_ns, size) of the manifest file -> parsed manifest; lookups are read-only
+_manifest_cache: Tuple[Optional[tuple], Optional[dict]] = (None, None)
+
+
+def load_manifest() -> dict:
+    """Load the archive manifest, creating the empty structure if missing.
+
+    The parsed manifest is reused until the file changes; don't modify it.
+    """
+    global _manifest_cache
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    try:
+        stat = os.stat(MANIFEST_FILE)
+        # Writes replace the file, so the inode changes even within one mtime tick
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        stamp = None
+    if stamp is not None and _manifest_cache[0] == stamp:
+        return _manifest_cache[1]
+    manifest = _with_defaults(load_json(MANIFEST_FILE))
+    _manifest_cache = (stamp, manifest)
+    return manifest
+
+
+def load_policy() -> dict:
+    """Retention policy from pdf_settings.json ("archive" section) over defaults."""
+    policy = dict(DEFAULT_POLICY)
+    policy.update(load_json(PDF_SETTINGS_FILE).get('archive', {}))
+    return policy
+
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def next_invoice_number(day: Optional[str] = None) -> int:
+    """Next invoice number for the day (ddmmyy) using the manifest counters."""
+    day = day or datetime.now().strftime("%d%m%y")
+    return load_manifest()['counters'].get(day, 0) + 1
+
+
+def store_invoice(invoice_number: str, pdf_path: str, filename: Optional[str] = None) -> str:
+    """Move a freshly rendered PDF into the archive and return its archived path.
+
+    If a blob with the same content already exists the new file is dropped and
+    the invoice is pointed at the existing blob.
+    """
+    sha = file_sha256(pdf_path)
+    now = datetime.now()
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with file_lock(MANIFEST_FILE):
+        manifest = _with_defaults(read_json_unlocked(MANIFEST_FILE))
+        return _store_locked(manifest, sha, now, invoice_number, pdf_path, filename)
+
+
+def _store_locked(manifest: dict, sha: str, now: datetime, invoice_number: str,
+                  pdf_path: str, filename: Optional[str]) -> str:
+    blob = manifest['blobs'].get(sha)
+    if blob:
+        os.remove(pdf_path)
+        blob['refs'] += 1
+        # A new invoice keeps the shared blob from being compressed or expired early
+        blob['referenced_at'] = now.isoformat()
+    else:
+        rel_path = os.path.join(now.strftime("%Y"), now.strftime("%m"), f"{sha}.pdf")
+        abs_path = os.path.join(ARCHIVE_DIR, rel_path)
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        shutil.move(pdf_path, abs_path)
+        blob = {'path': rel_path, 'refs': 1, 'compressed': False,
+                'offloaded': False, 'stored_at': now.isoformat()}
+        manifest['blobs'][sha] = blob
+
+    manifest['invoices'][invoice_number] = {
+        'sha256': sha,
+        'filename': filename or os.path.basename(pdf_path),
+        'stored_at': now.isoformat(),
+    }
+
+    # OG_<ddmmyy>_<n> - keep the day counter at the highest number issued
+    parts = invoice_number.split('_')
+    if len(parts) >= 3 and parts[2].isdigit():
+        counters = manifest['counters']
+        counters[parts[1]] = max(counters.get(parts[1], 0), int(parts[2]))
+
+    write_json_unlocked(MANIFEST_FILE, manifest)
+    return os.path.join(ARCHIVE_DIR, blob['path'])
+
+
+def _materialize(blob: dict, policy: dict) -> Optional[str]:
+    """Return a readable plain PDF path for a blob, decompressing if needed."""
+    base = policy['offload_dir'] if blob.get('offloaded') else ARCHIVE_DIR
+    if not base:
+        return None
+    abs_path = os.path.join(base, blob['path'])
+    if not blob.get('compressed'):
+        return abs_path if os.path.exists(abs_path) else None
+
+    gz_path = abs_path + '.gz'
+    if not os.path.exists(gz_path):
+        return None
+    cached = os.path.join(CACHE_DIR, os.path.basename(blob['path']))
+    if not os.path.exists(cached):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with gzip.open(gz_path, 'rb') as src, open(cached + '.tmp', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(cached + '.tmp', cached)
+    return cached
+
+
+def lookup_invoice(invoice_number: str) -> Optional[Tuple[str, str, str]]:
+    """(readable PDF path, sha256, download filename) of an invoice, or None."""
+    manifest = load_manifest()
+    entry = manifest['invoices'].get(invoice_number)
+    if not entry:
+        return None
+    blob = manifest['blobs'].get(entry['sha256'])
+    path = _materialize(blob, load_policy()) if blob else None
+    return (path, entry['sha256'], entry['filename']) if path else None
+
+
+def get_invoice_path(invoice_number: str) -> Optional[str]:
+    """Look up an invoice by number and return a readable PDF path."""
+    found = lookup_invoice(invoice_number)
+    return found[0] if found else None
+
+
+def resolve_invoice_path(pdf_path: Optional[str], invoice_number: Optional[str] = None) -> Optional[str]:
+    """Resolve a stored ``pdf_path`` that may since have been compressed or offloaded."""
+    if pdf_path and os.path.exists(pdf_path):
+        return pdf_path
+    if invoice_number:
+        return get_invoice_path(invoice_number)
+    return None
+
+
+def apply_retention(now: Optional[datetime] = None) -> Dict[str, int]:
+    """Compress cold blobs and offload/delete expired ones. Returns counts."""
+    now = now or datetime.now()
+    policy = load_policy()
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    with file_lock(MANIFEST_FILE):
+        manifest = _with_defaults(read_json_unlocked(MANIFEST_FILE))
+        stats = _retention_locked(manifest, policy, now)
+        write_json_unlocked(MANIFEST_FILE, manifest)
+    logging.info(f"Invoice retention applied: {stats}")
+    return stats
+
+
+def _retention_locked(manifest: dict, policy: dict, now: datetime) -> Dict[str, int]:
+    compress_before = now - timedelta(days=policy['compress_after_days'])
+    expire_before = now - timedelta(days=policy['retain_days'])
+    stats = {'compressed': 0, 'offloaded': 0, 'deleted': 0}
+
+    for sha, blob in list(manifest['blobs'].items()):
+        if blob.get('offloaded'):
+            continue
+        stored_at = datetime.fromisoformat(blob.get('referenced_at') or blob['stored_at'])
+        abs_path = os.path.join(ARCHIVE_DIR, blob['path'])
+        current = abs_path + '.gz' if blob['compressed'] else abs_path
+
+        if stored_at < expire_before:
+            if policy['offload_dir']:
+                target = os.path.join(policy['offload_dir'], blob['path'])
+                target += '.gz' if blob['compressed'] else ''
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if os.path.exists(current):
+                    shutil.move(current, target)
+                blob['offloaded'] = True
+                stats['offloaded'] += 1
+            else:
+                if os.path.exists(current):
+                    os.remove(current)
+                del manifest['blobs'][sha]
+                for number in [n for n, e in manifest['invoices'].items() if e['sha256'] == sha]:
+                    del manifest['invoices'][number]
+                stats['deleted'] += 1
+        elif stored_at < compress_before and not blob['compressed'] and os.path.exists(abs_path):
+            with open(abs_path, 'rb') as src, gzip.open(abs_path + '.gz', 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(abs_path)
+            blob['compressed'] = True
+            stats['compressed'] += 1
+
+    # Decompressed copies are only a read cache
+    if os.path.isdir(CACHE_DIR):
+        shutil.rmtree(CACHE_DIR, ignore_errors=True)
+
+    return stats
+
+
+def migrate_flat_store() -> int:
+    """Import legacy ``invoice_store/OG_<date>_<n>_<first>_<last>.pdf`` files."""
+    migrated = 0
+    if not os.path.isdir(ARCHIVE_DIR):
+        return migrated
+    for filename in os.listdir(ARCHIVE_DIR):
+        path = os.path.join(ARCHIVE_DIR, filename)
+        if not (filename.startswith('OG_') and filename.endswith('.pdf') and os.path.isfile(path)):
+            continue
+        invoice_number = '_'.join(filename.split('_')[:3])
+        store_invoice(invoice_number, path, filename)
+        migrated += 1
+    return migrated
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "retention"
+    if command == "migrate":
+        print(f"Migrated {migrate_flat_store()} invoices.")
+    elif command == "retention":
+        print(apply_retention())
+    else:
+        print("Usage: python -m common.invoice_archive [migrate|retention]")
@@ -0,0 +1,269 @@
+"""Invoice downloads over HTTP with signed, expiring links.
+
+Emails and the bot send a link instead of the PDF:
+
+    https://invoices.example.com/invoices/OG_210924_7?exp=1727000000&sig=...
+
+The signature is an HMAC of the invoice number and expiry with
+``INVOICE_LINK_SECRET``, so a link can't be changed to fetch someone
+else's invoice, and stops working after ``INVOICE_LINK_TTL_DAYS``.
+
+The server is a small asyncio HTTP/1.1 server running in the bot process
+(``INVOICE_SERVER_PORT``), meant to sit behind the reverse proxy that
+serves ``INVOICE_BASE_URL``. File bodies go out with ``loop.sendfile``,
+i.e. ``os.sendfile`` on a plain TCP socket, so the PDF isn't copied
+through Python. Archived blobs are content-addressed, so their sha256 is
+a strong ETag; ``If-None-Match`` and single ``Range`` requests are
+supported.
+
+    python -m common.invoice_server            # serve on INVOICE_SERVER_PORT
+    python -m common.invoice_server link OG_210924_7
+"""
+
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+import time
+from email.utils import formatdate
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+from common.async_storage import run_io
+from common.invoice_archive import lookup_invoice
+
+# Settings come from the environment when used, i.e. after the bot has loaded .env
+DEFAULT_LINK_TTL_DAYS = 30
+DEFAULT_HOST = "127.0.0.1"
+MAX_CONNECTIONS = 64
+HEADER_TIMEOUT = 10.0
+MAX_HEADER_BYTES = 8192
+KEEPALIVE_REQUESTS = 100
+
+_REASONS = {200: "OK", 206: "Partial Content", 304: "Not Modified", 400: "Bad Request",
+            403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+            416: "Range Not Satisfiable", 503: "Service Unavailable"}
+
+
+def links_enabled() -> bool:
+    return bool(os.getenv("INVOICE_BASE_URL") and os.getenv("INVOICE_LINK_SECRET"))
+
+
+def _signature(invoice_number: str, expires: int, secret: str) -> str:
+    message = f"{invoice_number}:{expires}".encode()
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+
+def sign_invoice_link(invoice_number: str, ttl_days: Optional[float] = None, base_url: Optional[str] = None,
+                      secret: Optional[str] = None, now: Optional[float] = None) -> str:
+    if ttl_days is None:
+        ttl_days = float(os.getenv("INVOICE_LINK_TTL_DAYS", DEFAULT_LINK_TTL_DAYS))
+    base_url = (base_url or os.getenv("INVOICE_BASE_URL", "")).rstrip('/')
+    secret = secret or os.getenv("INVOICE_LINK_SECRET", "")
+    expires = int((now or time.time()) + ttl_days * 86400)
+    sig = _signature(invoice_number, expires, secret)
+    return f"{base_url}/invoices/{quote(invoice_number)}?exp={expires}&sig={sig}"
+
+
+def verify_link(invoice_number: str, expires: str, sig: str, secret: str, now: Optional[float] = None) -> bool:
+    if not (secret and expires.isdigit() and sig):
+        return False
+    if int(expires) < (now or time.time()):
+        return False
+    return hmac.compare_digest(_signature(invoice_number, int(expires), secret), sig)
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """(start, end inclusive) for a single ``bytes=`` range; None if unsatisfiable or unsupported."""
+    if not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[6:].strip().partition('-')
+    try:
+        if first == '':
+            # Suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                return None
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class InvoiceServer:
+    def __init__(self, host: Optional[str] = None, port: Optional[int] = None, secret: Optional[str] = None,
+                 max_connections: int = MAX_CONNECTIONS):
+        """Unset arguments come from INVOICE_SERVER_HOST, INVOICE_SERVER_PORT (0: not served)
+        and INVOICE_LINK_SECRET."""
+        self.host = host or os.getenv("INVOICE_SERVER_HOST", DEFAULT_HOST)
+        self.port = int(os.getenv("INVOICE_SERVER_PORT") or 0) if port is None else port
+        self.secret = secret or os.getenv("INVOICE_LINK_SECRET", "")
+        self._connections = asyncio.Semaphore(max_connections)
+        self._server: Optional[asyncio.AbstractServer] = None
+        self.counts: Dict[str, int] = {'requests': 0, 'bytes_sent': 0, 'not_modified': 0,
+                                       'partial': 0, 'forbidden': 0, 'not_found': 0}
+
+    def stats(self) -> Dict[str, int]:
+        return dict(self.counts)
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=MAX_HEADER_BYTES)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logging.info(f"Invoice server listening on {self.host}:{self.port}")
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str]]]:
+        head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEADER_TIMEOUT)
+        lines = head.decode('latin-1').split("\r\n")
+        parts = lines[0].split(' ')
+        if len(parts) != 3:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name:
+                headers[name.strip().lower()] = value.strip()
+        return parts[0], parts[1], headers
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await asyncio.wait_for(self._connections.acquire(), HEADER_TIMEOUT)
+        except asyncio.TimeoutError:
+            await self._send_status(writer, 503, keep_alive=False)
+            writer.close()
+            return
+        try:
+            for _ in range(KEEPALIVE_REQUESTS):
+                try:
+                    request = await self._read_request(reader)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+                    break
+                if request is None:
+                    await self._send_status(writer, 400, keep_alive=False)
+                    break
+                method, target, headers = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                keep_alive = await self._serve(writer, method, target, headers, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, OSError) as e:
+            logging.info(f"Invoice download aborted: {e}")
+        finally:
+            self._connections.release()
+            writer.close()
+
+    async def _send_status(self, writer: asyncio.StreamWriter, status: int, keep_alive: bool = True,
+                           headers: Optional[Dict[str, str]] = None) -> None:
+        body = b"" if status == 304 else f"{status} {_REASONS[status]}\n".encode()
+        self._write_head(writer, status, {'Content-Type': 'text/plain', 'Content-Length': str(len(body)),
+                                          **(headers or {})}, keep_alive)
+        writer.write(body)
+        await writer.drain()
+
+    def _write_head(self, writer: asyncio.StreamWriter, status: int, headers: Dict[str, str],
+                    keep_alive: bool) -> None:
+        lines = [f"HTTP/1.1 {status} {_REASONS[status]}", f"Date: {formatdate(usegmt=True)}",
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+    async def _serve(self, writer: asyncio.StreamWriter, method: str, target: str,
+                     headers: Dict[str, str], keep_alive: bool) -> bool:
+        """Answer one request; returns whether the connection stays open."""
+        self.counts['requests'] += 1
+        if method not in ('GET', 'HEAD'):
+            await self._send_status(writer, 405, keep_alive, {'Allow': 'GET, HEAD'})
+            return keep_alive
+        url = urlsplit(target)
+        if not url.path.startswith('/invoices/'):
+            self.counts['not_found'] += 1
+            await self._send_status(writer, 404, keep_alive)
+            return keep_alive
+        invoice_number = unquote(url.path[len('/invoices/'):])
+        query = parse_qs(url.query)
+        if not verify_link(invoice_number, query.get('exp', [''])[0], query.get('sig', [''])[0], self.secret):
+            self.counts['forbidden'] += 1
+            await self._send_status(writer, 403, keep_alive)
+            return keep_alive
+
+        found = await run_io(lookup_invoice, invoice_number)
+        if found is None:
+            self.counts['not_found'] += 1
+            await self._send_status(writer, 404, keep_alive)
+            return keep_alive
+        path, sha, filename = found
+        etag = f'"{sha}"'
+        common = {'ETag': etag, 'Accept-Ranges': 'bytes', 'Cache-Control': 'private, max-age=86400'}
+        if etag in (tag.strip() for tag in headers.get('if-none-match', '').split(',')):
+            self.counts['not_modified'] += 1
+            await self._send_status(writer, 304, keep_alive, common)
+            return keep_alive
+
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            # Retention removed it between the lookup and now
+            self.counts['not_found'] += 1
+            await self._send_status(writer, 404, keep_alive)
+            return keep_alive
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            status, start, count = 200, 0, size
+            range_header = headers.get('range')
+            # A Range for an older version of the file (If-Range) gets the whole file
+            if range_header and headers.get('if-range', etag) == etag:
+                byte_range = parse_range(range_header, size)
+                if byte_range is None:
+                    await self._send_status(writer, 416, keep_alive, {'Content-Range': f"bytes */{size}"})
+                    return keep_alive
+                status, start, count = 206, byte_range[0], byte_range[1] - byte_range[0] + 1
+                common['Content-Range'] = f"bytes {byte_range[0]}-{byte_range[1]}/{size}"
+                self.counts['partial'] += 1
+
+            self._write_head(writer, status, {
+                **common,
+                'Content-Type': 'application/pdf',
+                'Content-Length': str(count),
+                'Content-Disposition': f"inline; filename*=UTF-8''{quote(filename)}",
+            }, keep_alive)
+            await writer.drain()
+            if method == 'GET' and count:
+                # os.sendfile on plain sockets; asyncio falls back to reads for TLS
+                await asyncio.get_running_loop().sendfile(writer.transport, file, start, count)
+                self.counts['bytes_sent'] += count
+        return keep_alive
+
+
+def _serve_forever() -> None:
+    async def main():
+        server = InvoiceServer()
+        server.port = server.port or 8081
+        await server.start()
+        await asyncio.Event().wait()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 2 and sys.argv[1] == "link":
+        if not links_enabled():
+            print("Set INVOICE_BASE_URL and INVOICE_LINK_SECRET first.")
+        else:
+            print(sign_invoice_link(sys.argv[2]))
+    else:
+        _serve_forever()
@@ -0,0 +1,55 @@
+"""Process-wide counters and timings shared by every bot in the host.
+
+    metrics.inc('telegram_requests', method='sendMessage')
+    metrics.observe('telegram_seconds', 0.12, method='sendMessage')
+
+Components that already keep their own counters (admission control, the
+registration pipeline) are added as sources and read on ``snapshot()``.
+"""
+
+from typing import Callable, Dict
+
+
+def _key(name: str, labels: dict) -> str:
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={v}" for k, v in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        # key -> [count, total, max]
+        self.timings: Dict[str, list] = {}
+        self._sources: Dict[str, Callable[[], dict]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = _key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = _key(name, labels)
+        timing = self.timings.get(key)
+        if timing is None:
+            self.timings[key] = [1, seconds, seconds]
+        else:
+            timing[0] += 1
+            timing[1] += seconds
+            if seconds > timing[2]:
+                timing[2] = seconds
+
+    def add_source(self, name: str, func: Callable[[], dict]) -> None:
+        self._sources[name] = func
+
+    def snapshot(self) -> Dict[str, object]:
+        result: Dict[str, object] = dict(self.counters)
+        for key, (count, total, longest) in self.timings.items():
+            result[f"{key} avg_ms"] = round(total / count * 1000, 1)
+            result[f"{key} max_ms"] = round(longest * 1000, 1)
+        for name, func in self._sources.items():
+            for key, value in func().items():
+                result[f"{name}.{key}"] = value
+        return result
+
+    def format(self) -> str:
+        return "\n".join(f"{key}: {value}" for key, value in sorted(self.snapshot().items()))
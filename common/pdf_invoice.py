@@ -1,5 +1,4 @@
 import os
-import re
 import logging
 import inflect
 from datetime import datetime, timedelta
@@ -10,6 +9,7 @@ from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase import pdfmetrics
 from reportlab.lib.units import cm
 from reportlab.lib.styles import getSampleStyleSheet
+from common.invoice_archive import ARCHIVE_DIR, next_invoice_number, store_invoice
 
 # Load the font that supports Latvian characters
 pdfmetrics.registerFont(TTFont('DejaVuSans', 'DejaVuSans.ttf'))
@@ -44,20 +44,8 @@ def number_to_latvian_words(num):
     return ' '.join(filter(bool, words)).strip()
 
 def get_invoice_number() -> int:
-    today = datetime.now().strftime("%d%m%y")
-    folder = "./invoice_store"
-    pattern = re.compile(fr"OG_{today}_(\d+)_.*\.pdf")
-    numbers = []
-
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
-    for filename in os.listdir(folder):
-        match = pattern.match(filename)
-        if match:
-            numbers.append(int(match.group(1)))
-
-    return max(numbers) + 1 if numbers else 1
+    # Served from the archive manifest counters instead of listing invoice_store
+    return next_invoice_number(datetime.now().strftime("%d%m%y"))
 
 def user_invoice_num() -> str:
     today_str = datetime.now().strftime("%d%m%y")
@@ -65,6 +53,11 @@ def user_invoice_num() -> str:
     user_invoice = f"OG_{today_str}_{invoice_number}"
     return user_invoice
 
+def payer_name(user_info: dict) -> str:
+    """The payer as the handlers store it (full_name); first/last name for older records."""
+    full_name = user_info.get('full_name') or f"{user_info.get('first_name', '')} {user_info.get('last_name', '')}"
+    return ' '.join(full_name.split()) or "Customer"
+
 def generate_pdf(user_info: dict, game_info: dict, lang: str) -> str:
     today_str = datetime.now().strftime("%d%m%y")
     invoice_number = get_invoice_number()
@@ -99,9 +92,13 @@ def generate_pdf(user_info: dict, game_info: dict, lang: str) -> str:
 
     logging.info(f"Game Name: {game_name}, Game Date: {formatted_game_date}, Unit Price: {unit_price}, Total Amount: {total_amount}")
 
-    pdf_filename = f"OG_{today_str}_{invoice_number}_{user_info['first_name']}_{user_info['last_name']}.pdf"
+    payer = payer_name(user_info)
+    # The name goes into a path: keep it to one segment
+    file_name = payer.replace(' ', '_').replace('/', '_').replace('\\', '_')
+    pdf_filename = f"OG_{today_str}_{invoice_number}_{file_name}.pdf"
     user_invoice = f"OG_{today_str}_{invoice_number}"
-    pdf_path = os.path.join("./invoice_store", pdf_filename)
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    pdf_path = os.path.join(ARCHIVE_DIR, pdf_filename)
 
     # Create the PDF document
     doc = SimpleDocTemplate(pdf_path, pagesize=A4)
@@ -111,7 +108,7 @@ def generate_pdf(user_info: dict, game_info: dict, lang: str) -> str:
     styles = getSampleStyleSheet()
     header_data = [ 
     ["Maksātājs"],
-    [f"{user_info.get('first_name', 'First Name')} {user_info.get('last_name', 'Last Name')}"],
+    [payer],
     ["", " ", " "],  
     ["", " ", " "], 
     ["Piegādātājs", " ", f"RĒĶINS Nr OG/{today_str}/{invoice_number}"],
@@ -168,4 +165,4 @@ def generate_pdf(user_info: dict, game_info: dict, lang: str) -> str:
     elements.append(total_table)
 
     doc.build(elements)
-    return pdf_path
+    return store_invoice(user_invoice, pdf_path, pdf_filename)
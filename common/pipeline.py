@@ -0,0 +1,186 @@
+"""Persistent background pipeline for registration side effects.
+
+A handler does the fast part of a request itself and submits a job; the
+job's stages (PDF render, channel post, email, ...) then run in the
+background. Each stage has its own concurrency limit, retry policy and
+dependencies, and every status change is written to a JSON file so
+unfinished jobs resume after a restart.
+
+    pipeline = Pipeline("./store/pipeline_jobs.json")
+
+    @pipeline.stage('pdf', concurrency=1)
+    async def render(data, bot): ...
+
+    @pipeline.stage('email', depends_on=('pdf',))
+    async def email(data, bot): ...
+
+A stage's ``on_failure(data, bot)`` runs when its last attempt fails, e.g.
+to undo what the job reserved and tell the user. It runs before the stage is
+saved as failed, so after a crash in between it runs again on resume and has
+to tolerate that.
+
+    await pipeline.submit(job_id, {...})
+"""
+
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+from common.async_storage import aload_json, asave_json
+from common.log import bind
+
+PENDING, RUNNING, DONE, FAILED, BLOCKED = 'pending', 'running', 'done', 'failed', 'blocked'
+FINISHED = (DONE, FAILED, BLOCKED)
+
+StageHandler = Callable[[dict, object], Awaitable[Optional[dict]]]
+FailureHandler = Callable[[dict, object], Awaitable[None]]
+
+
+class Stage:
+    def __init__(self, name: str, handler: StageHandler, concurrency: int,
+                 max_attempts: int, backoff: float, depends_on: Tuple[str, ...],
+                 on_failure: Optional[FailureHandler] = None):
+        self.name = name
+        self.handler = handler
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.depends_on = depends_on
+        self.on_failure = on_failure
+
+
+class Pipeline:
+    def __init__(self, jobs_file: str, keep_finished: int = 1000):
+        self.jobs_file = jobs_file
+        self.keep_finished = keep_finished
+        self.stages: Dict[str, Stage] = {}
+        self.jobs: Dict[str, dict] = {}
+        self.bot = None
+        self._save_lock = asyncio.Lock()
+        self._tasks = set()
+
+    def stage(self, name: str, concurrency: int = 4, max_attempts: int = 3,
+              backoff: float = 5.0, depends_on: Tuple[str, ...] = (),
+              on_failure: Optional[FailureHandler] = None):
+        """Register a stage handler. It receives the job data and the bot and
+        may return a dict that is merged into the job data for later stages."""
+        def register(handler: StageHandler) -> StageHandler:
+            self.stages[name] = Stage(name, handler, concurrency, max_attempts, backoff, depends_on, on_failure)
+            return handler
+        return register
+
+    async def start(self, bot) -> None:
+        """Attach the bot and resume every unfinished job from the jobs file."""
+        self.bot = bot
+        stored = await aload_json(self.jobs_file)
+        for job_id, job in stored.items():
+            for state in job['stages'].values():
+                if state['status'] == RUNNING:
+                    state['status'] = PENDING
+            self.jobs[job_id] = job
+            self._spawn(job_id)
+        if stored:
+            logging.info(f"Resumed {len(stored)} pipeline jobs.")
+
+    async def submit(self, job_id: str, data: dict) -> None:
+        self.jobs[job_id] = {
+            'data': data,
+            'created': datetime.now().isoformat(),
+            'stages': {name: {'status': PENDING, 'attempts': 0, 'error': None} for name in self.stages},
+        }
+        await self._persist()
+        self._spawn(job_id)
+
+    def status(self, job_id: str) -> Optional[Dict[str, str]]:
+        job = self.jobs.get(job_id)
+        return {name: state['status'] for name, state in job['stages'].items()} if job else None
+
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        """Count of jobs per stage and status."""
+        counts = {name: {} for name in self.stages}
+        for job in self.jobs.values():
+            for name, state in job['stages'].items():
+                counts.setdefault(name, {})
+                counts[name][state['status']] = counts[name].get(state['status'], 0) + 1
+        return counts
+
+    def _spawn(self, job_id: str) -> None:
+        task = asyncio.create_task(self._run_job(job_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _persist(self) -> None:
+        # Finished jobs stay in memory for status queries but aren't resumed
+        async with self._save_lock:
+            unfinished = {job_id: job for job_id, job in self.jobs.items()
+                          if any(state['status'] not in FINISHED for state in job['stages'].values())}
+            await asave_json(self.jobs_file, unfinished)
+
+    async def _run_job(self, job_id: str) -> None:
+        # The job task inherits the fields of the update that submitted it
+        bind(job=job_id)
+        job = self.jobs[job_id]
+        states = job['stages']
+        finished = {name: asyncio.Event() for name in states}
+
+        async def run(name: str) -> None:
+            state = states[name]
+            stage = self.stages.get(name)
+            if state['status'] not in FINISHED:
+                if stage is None:
+                    state['status'] = BLOCKED
+                else:
+                    # Each stage starts as soon as its own dependencies are done
+                    for dep in stage.depends_on:
+                        if dep in finished:
+                            await finished[dep].wait()
+                    if all(states.get(dep, {}).get('status') == DONE for dep in stage.depends_on):
+                        await self._run_stage(job_id, job, stage)
+                    else:
+                        state['status'] = BLOCKED
+            finished[name].set()
+
+        await asyncio.gather(*(run(name) for name in states))
+        self._prune_finished()
+        await self._persist()
+
+    def _prune_finished(self) -> None:
+        """Drop the oldest finished jobs beyond keep_finished."""
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if all(state['status'] in FINISHED for state in job['stages'].values())]
+        for job_id in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job_id]
+
+    async def _run_stage(self, job_id: str, job: dict, stage: Stage) -> None:
+        state = job['stages'][stage.name]
+        while state['attempts'] < stage.max_attempts:
+            # A slot is held per attempt, not through the backoff, so failing jobs
+            # don't keep the stage from running others
+            async with stage.semaphore:
+                state['status'] = RUNNING
+                state['attempts'] += 1
+                try:
+                    result = await stage.handler(job['data'], self.bot)
+                    if result:
+                        job['data'].update(result)
+                    state['status'] = DONE
+                    state['error'] = None
+                    await self._persist()
+                    return
+                except Exception as e:
+                    state['error'] = str(e)
+                    logging.error(f"Pipeline job {job_id} stage {stage.name} attempt {state['attempts']} failed: {e}")
+                    if state['attempts'] < stage.max_attempts:
+                        state['status'] = PENDING
+                    await self._persist()
+            if state['attempts'] < stage.max_attempts:
+                await asyncio.sleep(stage.backoff * 2 ** (state['attempts'] - 1))
+        # The last attempt left the stage saved as running, so a restart before
+        # it is saved as failed resumes here and runs on_failure again
+        if stage.on_failure is not None:
+            try:
+                await stage.on_failure(job['data'], self.bot)
+            except Exception as e:
+                logging.exception(f"Pipeline job {job_id} stage {stage.name} failure handler failed: {e}")
+        state['status'] = FAILED
+        await self._persist()
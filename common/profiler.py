@@ -0,0 +1,203 @@
+"""On-demand sampling profiler for the running bot process.
+
+Nothing runs until a profile is requested, so there is no cost while idle.
+During a profile a background thread samples the stack of every thread
+(the event loop, the storage and guard executors, ``asyncio.to_thread``
+workers rendering PDFs) every ``interval`` seconds. Consecutive busy samples
+of the event loop thread inside the same callback are reported as a slow
+callback once they add up to ``slow_callback`` seconds; asyncio debug mode
+is not used, as its per-callback tracebacks would distort the profile.
+
+The result is written in folded-stack format, one line per distinct stack:
+
+    MainThread;run (asyncio/runners.py:118);...;render (pdf_invoice.py:40) 17
+
+which ``flamegraph.pl``, speedscope or inferno turn into a flamegraph.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+PROFILE_DIR = "./store/profiles"
+MAX_SECONDS = 120
+
+# Leaf frames of threads that are waiting, not working
+_IDLE_LEAVES = {
+    ('threading.py', 'wait'), ('selectors.py', 'select'), ('queue.py', 'get'),
+    ('thread.py', '_worker'), ('windows_events.py', 'select'), ('socket.py', 'accept'),
+}
+
+
+def _frame_label(code) -> str:
+    name = getattr(code, 'co_qualname', code.co_name)
+    path = code.co_filename.replace('\\', '/')
+    # Last two path parts are enough to tell files apart and keep lines short
+    short = '/'.join(path.rsplit('/', 2)[-2:])
+    return f"{name} ({short}:{code.co_firstlineno})".replace(';', ':')
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.01, profile_dir: str = PROFILE_DIR):
+        self.interval = interval
+        self.profile_dir = profile_dir
+        self.running = False
+
+    def _sample(self, stop: threading.Event, loop_ident: int, slow_callback: float, result: dict) -> None:
+        own = threading.get_ident()
+        stacks, idle, slow = result['stacks'], result['idle'], result['slow_callbacks']
+        names: Dict[int, str] = {}
+        # Current run of busy loop samples: [callback, first seen, last seen]
+        streak = None
+
+        def end_streak():
+            duration = streak[2] - streak[1] + self.interval
+            if duration >= slow_callback:
+                slow.append((streak[0], duration))
+
+        while not stop.wait(self.interval):
+            now = time.monotonic()
+            if result['samples'] % 100 == 0:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            result['samples'] += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                leaf = frame.f_code
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, f"thread-{ident}"))
+                stack.reverse()
+                is_idle = (os.path.basename(leaf.co_filename), leaf.co_name) in _IDLE_LEAVES
+                (idle if is_idle else stacks)[';'.join(stack)] += 1
+
+                if ident != loop_ident:
+                    continue
+                callback = _running_callback(stack) if not is_idle else None
+                if streak is not None and callback != streak[0]:
+                    end_streak()
+                    streak = None
+                if callback is not None:
+                    if streak is None:
+                        streak = [callback, now, now]
+                    else:
+                        streak[2] = now
+        if streak is not None:
+            end_streak()
+
+    def profile(self, seconds: float, slow_callback: float = 0.05, include_idle: bool = False) -> asyncio.Task:
+        """Claim the profiler and start the task that samples for ``seconds``.
+
+        Claiming is synchronous, so a second request fails with RuntimeError
+        even before the first task has started. The claim is released when the
+        task ends, however it ends. Call it from the event loop; the task
+        returns a summary plus the path of the folded output.
+        """
+        if self.running:
+            raise RuntimeError("A profile is already running.")
+        task = asyncio.get_running_loop().create_task(
+            self._profile(min(seconds, MAX_SECONDS), slow_callback, include_idle))
+        self.running = True
+        task.add_done_callback(self._release)
+        return task
+
+    def _release(self, task: asyncio.Task) -> None:
+        self.running = False
+
+    async def _profile(self, seconds: float, slow_callback: float, include_idle: bool) -> dict:
+        result = {'samples': 0, 'stacks': Counter(), 'idle': Counter(), 'slow_callbacks': []}
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample, name="profiler", daemon=True,
+                                   args=(stop, threading.get_ident(), slow_callback, result))
+        started = time.monotonic()
+        try:
+            sampler.start()
+            await asyncio.sleep(seconds)
+        finally:
+            stop.set()
+            await asyncio.to_thread(sampler.join)
+
+        stacks, idle = result['stacks'], result['idle']
+        folded = stacks + idle if include_idle else stacks
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded")
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in folded.most_common():
+                f.write(f"{stack} {count}\n")
+
+        return {
+            'path': path,
+            'seconds': round(time.monotonic() - started, 1),
+            'samples': result['samples'],
+            'busy_samples': sum(stacks.values()),
+            'idle_samples': sum(idle.values()),
+            'top': top_functions(stacks),
+            'slow_callbacks': sorted(result['slow_callbacks'], key=lambda item: -item[1]),
+        }
+
+
+def _is_handle_run(label: str) -> bool:
+    # Handle._run from asyncio/events.py; labelled "_run" before Python 3.11 (no co_qualname)
+    name, _, where = label.partition(' (')
+    return name.rsplit('.', 1)[-1] == '_run' and where.startswith('asyncio/events.py:')
+
+
+def _running_callback(stack: List[str]) -> Optional[str]:
+    """The callback the event loop is running: the frame just inside Handle._run."""
+    for position, label in enumerate(stack):
+        if _is_handle_run(label) and position + 1 < len(stack):
+            return stack[position + 1]
+    return None
+
+
+def top_functions(stacks: Counter, limit: int = 10) -> List[tuple]:
+    """(leaf function, share of busy samples) sorted by self time."""
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    total = sum(leaves.values()) or 1
+    return [(label, count / total) for label, count in leaves.most_common(limit)]
+
+
+def format_summary(result: dict, limit_callbacks: int = 5) -> str:
+    lines = [
+        f"Profile: {result['seconds']}s, {result['samples']} samples "
+        f"({result['busy_samples']} busy / {result['idle_samples']} idle thread samples)",
+        "",
+        "Top functions (self time):",
+    ]
+    lines += [f"{share:6.1%}  {label}" for label, share in result['top']]
+    callbacks = result['slow_callbacks']
+    lines += ["", f"Slow callbacks: {len(callbacks)}"]
+    lines += [f"{duration * 1000:6.0f} ms  {callback}" for callback, duration in callbacks[:limit_callbacks]]
+    return "\n".join(lines)
+
+
+def _demo(seconds: float = 3.0) -> None:
+    """Profile a small workload: a blocking callback on the loop and a busy worker thread."""
+    def busy_worker(n: int) -> int:
+        return sum(i * i for i in range(n))
+
+    async def main():
+        profiler = SamplingProfiler()
+        task = profiler.profile(seconds)
+        for _ in range(int(seconds * 4)):
+            await asyncio.to_thread(busy_worker, 200000)
+            busy_worker(1000000)  # blocks the loop
+            await asyncio.sleep(0.2)
+        result = await task
+        print(format_summary(result))
+        print(f"\nFolded stacks: {result['path']}")
+
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    _demo(float(sys.argv[1]) if len(sys.argv) > 1 else 3.0)
@@ -0,0 +1,125 @@
+"""Inbound admission control for the registration bot.
+
+Token buckets are checked by ``PerUserUpdateProcessor`` (``admit=``) before
+an update waits for its user's turn, so an over-limit update is rejected
+before it queues and before any handler (and therefore any CSV scan, Stripe
+call or PDF render) runs:
+
+* every user has a bucket for all of their updates,
+* ``/start`` (a new registration from a deeplink) has a stricter per-user
+  bucket,
+* ``/start`` also draws from one global bucket, so a spike of new sessions is
+  shed while users already in a conversation keep being served,
+* inline queries (sent on every keystroke of a search) have a per-user
+  bucket of their own, so typing a search can't use up the tokens of the
+  user's conversation.
+"""
+
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from telegram import Update
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float, cost: float = 1.0) -> bool:
+        self.refill(now)
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+
+class AdmissionControl:
+    def __init__(self, user_rate: float = 1.0, user_burst: float = 10,
+                 start_rate: float = 0.1, start_burst: float = 3,
+                 global_start_rate: float = 20.0, global_start_burst: float = 50,
+                 inline_rate: float = 2.0, inline_burst: float = 20,
+                 max_tracked_users: int = 50000, notify_interval: float = 30.0,
+                 exempt_user_ids=()):
+        self.user_rate, self.user_burst = user_rate, user_burst
+        self.start_rate, self.start_burst = start_rate, start_burst
+        self.inline_rate, self.inline_burst = inline_rate, inline_burst
+        self.global_start = TokenBucket(global_start_rate, global_start_burst, time.monotonic())
+        self.max_tracked_users = max_tracked_users
+        self.notify_interval = notify_interval
+        self.exempt_user_ids = {str(user_id) for user_id in exempt_user_ids}
+        # user_id -> [all-updates bucket, /start bucket, last "slow down" notice, inline bucket], LRU order
+        self._users: 'OrderedDict[str, list]' = OrderedDict()
+        self.admitted = 0
+        self.shed: Dict[str, int] = {'user': 0, 'user_start': 0, 'global_start': 0, 'inline': 0}
+
+    def _user_state(self, user_id: str, now: float) -> list:
+        state = self._users.get(user_id)
+        if state is None:
+            state = [TokenBucket(self.user_rate, self.user_burst, now),
+                     TokenBucket(self.start_rate, self.start_burst, now), 0.0,
+                     TokenBucket(self.inline_rate, self.inline_burst, now)]
+            self._users[user_id] = state
+            if len(self._users) > self.max_tracked_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return state
+
+    def admit(self, user_id: str, is_start: bool, now: Optional[float] = None,
+              is_inline: bool = False) -> Optional[str]:
+        """Return None if the update may proceed, otherwise the reason it was shed."""
+        now = time.monotonic() if now is None else now
+        if user_id in self.exempt_user_ids:
+            self.admitted += 1
+            return None
+        state = self._user_state(user_id, now)
+        buckets = [('inline', state[3])] if is_inline else [('user', state[0])]
+        if is_start:
+            buckets += [('user_start', state[1]), ('global_start', self.global_start)]
+        # Check every bucket before taking from any, so a shed update costs nothing
+        for reason, bucket in buckets:
+            bucket.refill(now)
+            if bucket.tokens < 1.0:
+                self.shed[reason] += 1
+                return reason
+        for _, bucket in buckets:
+            bucket.tokens -= 1.0
+        self.admitted += 1
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return {'admitted': self.admitted, **{f"shed_{reason}": count for reason, count in self.shed.items()},
+                'tracked_users': len(self._users)}
+
+    async def screen(self, update: object) -> bool:
+        """Whether the update is within the limits; tells a shed user to slow down now and then."""
+        if not isinstance(update, Update) or not update.effective_user:
+            return True
+        message = update.effective_message
+        is_start = bool(message and message.text and message.text.startswith('/start'))
+        user_id = str(update.effective_user.id)
+        reason = self.admit(user_id, is_start, is_inline=update.inline_query is not None)
+        if reason is None:
+            return True
+        logging.info(f"Shed update from user {user_id}: {reason} limit", extra={'event': 'update_shed'})
+
+        # Tell the user at most once per notify_interval; everything else is silent
+        now = time.monotonic()
+        state = self._users.get(user_id)
+        if message and state is not None and now - state[2] >= self.notify_interval:
+            state[2] = now
+            try:
+                await message.reply_text("Too many requests, please try again in a moment.")
+            except Exception as e:
+                logging.warning(f"Could not tell user {user_id} to slow down: {e}")
+        return False
@@ -0,0 +1,91 @@
+"""game_id -> registered users index.
+
+Kept up to date on registration and cancellation so "who is registered
+for this game" never scans ``user_data.json``.
+
+``game_registrants.json`` shape::
+
+    {game_id: {user_id: [registration key, ...]}}
+
+A registration key is its commit token, which every registration gets when
+it is committed (even before it has a payment session or invoice). Older
+registrations fall back to the Stripe session id or the invoice number.
+"""
+
+from typing import Dict, List, Optional
+from common.file_manager import (
+    GAMES_CSV_FILE, file_lock, load_csv, load_json, read_json_unlocked, write_json_unlocked,
+)
+
+REGISTRANTS_FILE = "./store/game_registrants.json"
+
+
+def registration_key(registration) -> Optional[str]:
+    return (registration.get('commit_token') or registration.get('session_id')
+            or registration.get('invoice_number'))
+
+
+def add_registrant(game_id: str, user_id: str, key: str) -> None:
+    if not game_id or not key:
+        return
+    with file_lock(REGISTRANTS_FILE):
+        index = read_json_unlocked(REGISTRANTS_FILE)
+        keys = index.setdefault(game_id, {}).setdefault(user_id, [])
+        if key not in keys:
+            keys.append(key)
+        write_json_unlocked(REGISTRANTS_FILE, index)
+
+
+def remove_registrant(game_id: str, user_id: str, key: str) -> None:
+    if not game_id or not key:
+        return
+    with file_lock(REGISTRANTS_FILE):
+        index = read_json_unlocked(REGISTRANTS_FILE)
+        users = index.get(game_id, {})
+        keys = users.get(user_id, [])
+        if key in keys:
+            keys.remove(key)
+            if not keys:
+                del users[user_id]
+            write_json_unlocked(REGISTRANTS_FILE, index)
+
+
+def game_registrants(game_id: str) -> List[str]:
+    """User ids with at least one active registration for the game."""
+    return list(load_json(REGISTRANTS_FILE).get(game_id, {}))
+
+
+def rebuild_registrants(user_data: dict) -> Dict[str, Dict[str, List[str]]]:
+    """Rebuild the index from user_data.json.
+
+    Older registrations have no game_id in game_details; those are matched
+    to games.csv by game name and date.
+    """
+    by_name_date = {(game['game_name'], game['date']): game['game_id'] for game in load_csv(GAMES_CSV_FILE)}
+    index = {}
+    for user_id, registrations in user_data.items():
+        for registration in registrations:
+            key = registration_key(registration)
+            if not key or registration.get('canceled'):
+                continue
+            details = registration.get('game_details') or {}
+            game_id = details.get('game_id') or by_name_date.get((details.get('game_name'), details.get('date')))
+            if game_id:
+                index.setdefault(game_id, {}).setdefault(user_id, []).append(key)
+    with file_lock(REGISTRANTS_FILE):
+        write_json_unlocked(REGISTRANTS_FILE, index)
+    return index
+
+
+if __name__ == "__main__":
+    import sys
+    from common.codec import StreamedUserData
+    from common.file_manager import USER_DATA_FILE
+    if sys.argv[1:] == ['rebuild']:
+        # Streamed, so a large user_data file is never loaded whole
+        index = rebuild_registrants(StreamedUserData(USER_DATA_FILE))
+        print(f"Indexed {sum(len(users) for users in index.values())} registrants across {len(index)} games.")
+    elif len(sys.argv) == 2:
+        print("\n".join(game_registrants(sys.argv[1])))
+    else:
+        print("Usage: python -m common.registrants [rebuild | <game_id>]")
@@ -0,0 +1,209 @@
+"""Compact in-memory registration model.
+
+Registrations live in ``user_data`` as one ``Registration`` per entry instead
+of a free-form dict. Records use ``__slots__`` so field names are not stored
+per record, and ``game_details`` is interned: every registration for the same
+game points at one shared, read-only ``GameRef``. The intern table is keyed
+by game_id and holds weak references, so a game's entry goes away with its
+last registration, and changed details for a game make a new ref.
+
+Records keep the dict-style access the handlers already use
+(``reg['email']``, ``reg.get('lang')``, ``reg['game_details'] = {...}``) and
+convert losslessly to and from the ``user_data.json`` shape. Game details
+are changed by assigning a new dict; ``reg.get('game_details')`` is a
+read-only mapping.
+"""
+
+import sys
+import weakref
+from collections.abc import Mapping
+from typing import Dict, Optional, Tuple
+
+# Known registration keys, in the order they are written back to JSON
+FIELDS = (
+    'lang', 'first_name', 'last_name', 'full_name', 'email', 'cust_amount',
+    'total_price', 'invoice_number', 'pdf_path', 'payment_link', 'session_id',
+    'game_details', 'payment_status', 'notified', 'canceled', 'commit_token',
+    'registered_at', 'canceled_at', 'paid_at',
+)
+_FIELD_SET = frozenset(FIELDS)
+_INTERNED = frozenset(('lang', 'payment_status', 'canceled'))
+_MISSING = object()
+
+
+class GameRef(Mapping):
+    """Shared, read-only ``game_details`` of a game; ``to_dict()`` gives a plain copy."""
+    __slots__ = ('game_id', 'fields', '__weakref__')
+
+    def __init__(self, fields: Tuple[Tuple[str, object], ...]):
+        self.fields = fields
+        self.game_id = dict(fields).get('game_id')
+
+    def to_dict(self) -> dict:
+        return dict(self.fields)
+
+    def get(self, key, default=None):
+        for name, value in self.fields:
+            if name == key:
+                return value
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        return (name for name, _ in self.fields)
+
+    def __len__(self) -> int:
+        return len(self.fields)
+
+    def __repr__(self) -> str:
+        return f"GameRef({self.to_dict()!r})"
+
+
+# game_id -> the latest GameRef of that game, held only while registrations use it
+_game_refs: 'weakref.WeakValueDictionary[str, GameRef]' = weakref.WeakValueDictionary()
+
+
+def intern_game(details) -> GameRef:
+    """Return the shared GameRef for a game_details dict (or a GameRef itself)."""
+    if isinstance(details, GameRef):
+        return details
+    fields = tuple((sys.intern(k), sys.intern(v) if isinstance(v, str) else v) for k, v in details.items())
+    game_id = details.get('game_id')
+    ref = _game_refs.get(game_id) if game_id else None
+    if ref is None or ref.fields != fields:
+        # New game, or its details changed: older registrations keep the ref they had
+        ref = GameRef(fields)
+        if game_id:
+            _game_refs[game_id] = ref
+    return ref
+
+
+def games_by_id() -> Dict[str, GameRef]:
+    """Interned games still referenced by a registration, by game_id."""
+    return dict(_game_refs)
+
+
+class Registration:
+    """One registration record with dict-style access."""
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, **fields):
+        self.extra = None
+        for key, value in fields.items():
+            self[key] = value
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Registration':
+        return cls(**data)
+
+    def to_dict(self) -> dict:
+        result = {}
+        for name in FIELDS:
+            value = getattr(self, name, _MISSING)
+            if value is _MISSING:
+                continue
+            result[name] = value.to_dict() if name == 'game_details' else value
+        if self.extra:
+            result.update(self.extra)
+        return result
+
+    @property
+    def game_id(self) -> Optional[str]:
+        ref = getattr(self, 'game_details', None)
+        return ref.game_id if ref else None
+
+    def __setitem__(self, key: str, value) -> None:
+        if key == 'game_details':
+            value = intern_game(value)
+        elif key in _INTERNED and isinstance(value, str):
+            value = sys.intern(value)
+        if key in _FIELD_SET:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __getitem__(self, key: str):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key: str, default=None):
+        if key in _FIELD_SET:
+            value = getattr(self, key, _MISSING)
+            return default if value is _MISSING else value
+        if self.extra:
+            return self.extra.get(key, default)
+        return default
+
+    def __repr__(self) -> str:
+        return f"Registration({self.to_dict()!r})"
+
+
+def _benchmark(count: int = 100000) -> None:
+    """Compare traced memory of dict registrations vs Registration records."""
+    import gc
+    import tracemalloc
+
+    def synthetic():
+        for i in range(count):
+            game = i % 200
+            yield str(100000000 + i // 3), {
+                'lang': ('en', 'lv', 'ru')[i % 3],
+                'full_name': f"User {i}",
+                'email': f"user{i}@example.com",
+                'cust_amount': i % 5 + 1,
+                'total_price': float((i % 5 + 1) * 15),
+                'invoice_number': f"OG_200924_{i}",
+                'pdf_path': f"./invoice_store/2024/09/{i:064x}.pdf",
+                'game_details': {
+                    'game_id': f"OP{game}",
+                    'game_name': f"Game{game}",
+                    'place': "StreetB",
+                    'date': "2024-09-21",
+                    'time': "21:00",
+                    'price_per_person': "15",
+                },
+            }
+
+    def measure(build):
+        gc.collect()
+        tracemalloc.start()
+        data = build()
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del data
+        gc.collect()
+        return current
+
+    def build_dicts():
+        data = {}
+        for user_id, reg in synthetic():
+            data.setdefault(user_id, []).append(reg)
+        return data
+
+    def build_records():
+        data = {}
+        for user_id, reg in synthetic():
+            data.setdefault(sys.intern(user_id), []).append(Registration.from_dict(reg))
+        return data
+
+    dict_bytes = measure(build_dicts)
+    record_bytes = measure(build_records)
+    print(f"{count} registrations")
+    print(f"dicts:   {dict_bytes / 2**20:8.1f} MiB")
+    print(f"records: {record_bytes / 2**20:8.1f} MiB ({record_bytes / dict_bytes:.0%} of dicts)")
+
+
+if __name__ == "__main__":
+    _benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
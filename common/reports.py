@@ -0,0 +1,264 @@
+"""Running per-game report totals.
+
+Totals are kept per ``game_id`` (and per day the event happened) and updated
+incrementally when a registration is made, canceled or paid, so revenue,
+attendance and paid/unpaid queries never scan ``user_data.json``. Queries
+reuse the parsed totals until the file changes.
+
+The day of an event is the date of its stamp on the registration
+(``registered_at``, ``canceled_at``, ``paid_at``), or today for one being
+recorded now; ``rebuild`` uses the same stamps, so it reproduces the live
+day buckets. Records from before the stamps go to an ``unknown`` day.
+
+A registration that was paid and then canceled stays in ``payments`` and
+``paid_revenue`` and is also counted in ``canceled_payments`` and
+``canceled_paid_revenue``, so the unpaid figures subtract it only once.
+
+A registration is counted once per invoice number, so a retried or resumed
+pipeline job doesn't count it twice.
+
+``report_totals.json`` shape::
+
+    {game_id: {"total": {counter: value}, "days": {"YYYY-MM-DD": {counter: value}},
+               "invoices": [invoice_number, ...]}}
+"""
+
+import csv
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Optional, Dict, List, Tuple
+from common.file_manager import load_json, save_json, file_lock, read_json_unlocked, write_json_unlocked
+
+REPORTS_FILE = "./store/report_totals.json"
+UNKNOWN_DAY = 'unknown'
+
+COUNTERS = (
+    'registrations', 'attendees', 'revenue',
+    'cancellations', 'canceled_attendees', 'canceled_revenue',
+    'payments', 'paid_revenue',
+    'canceled_payments', 'canceled_paid_revenue',
+)
+
+
+# (file stamp, parsed totals)
+_totals_cache: Tuple[Optional[tuple], Optional[dict]] = (None, None)
+
+
+def _empty() -> Dict[str, float]:
+    return {counter: 0 for counter in COUNTERS}
+
+
+def now_stamp() -> str:
+    """Timestamp for registered_at / canceled_at / paid_at."""
+    return datetime.now().isoformat(timespec='seconds')
+
+
+def event_day(stamp: Optional[str]) -> str:
+    """Day bucket of an event stamped with now_stamp()."""
+    return stamp[:10] if stamp else UNKNOWN_DAY
+
+
+def _file_stamp() -> Optional[tuple]:
+    try:
+        stat = os.stat(REPORTS_FILE)
+    except FileNotFoundError:
+        return None
+    # Writes replace the file, so the inode changes even within one mtime tick
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def load_totals() -> dict:
+    """The totals, parsed once and reused until the file changes; don't modify them."""
+    global _totals_cache
+    stamp = _file_stamp()
+    if stamp is None:
+        return {}
+    if _totals_cache[0] == stamp:
+        return _totals_cache[1]
+    totals = load_json(REPORTS_FILE)
+    _totals_cache = (stamp, totals)
+    return totals
+
+
+def _apply(game_id: str, day: Optional[str], invoice_number: Optional[str] = None, **deltas) -> None:
+    """Add deltas to a game's total and day buckets and persist them.
+
+    With an invoice number, nothing changes if that invoice was already counted.
+    """
+    global _totals_cache
+    if not game_id:
+        return
+    day = day or event_day(now_stamp())
+    with file_lock(REPORTS_FILE):
+        totals = read_json_unlocked(REPORTS_FILE)
+        if invoice_number and not _claim_invoice(totals, game_id, invoice_number):
+            logging.info(f"Invoice {invoice_number} is already in the {game_id} totals.")
+            return
+        _add(totals, game_id, day, deltas)
+        write_json_unlocked(REPORTS_FILE, totals)
+        _totals_cache = (_file_stamp(), totals)
+
+
+def _add(totals: dict, game_id: str, day: str, deltas: dict) -> None:
+    game = totals.setdefault(game_id, {'total': _empty(), 'days': {}})
+    bucket = game['days'].setdefault(day, _empty())
+    for counter, delta in deltas.items():
+        game['total'][counter] = round(game['total'].get(counter, 0) + delta, 2)
+        bucket[counter] = round(bucket.get(counter, 0) + delta, 2)
+
+
+def _claim_invoice(totals: dict, game_id: str, invoice_number: str) -> bool:
+    """Mark an invoice counted; False if it already was."""
+    invoices = totals.setdefault(game_id, {'total': _empty(), 'days': {}}).setdefault('invoices', [])
+    if invoice_number in invoices:
+        return False
+    invoices.append(invoice_number)
+    return True
+
+
+def record_registration(game_id: str, attendees: int, revenue: float, day: Optional[str] = None,
+                        invoice_number: Optional[str] = None) -> None:
+    """invoice_number: count the registration only once."""
+    _apply(game_id, day, invoice_number, registrations=1, attendees=attendees, revenue=revenue)
+
+
+def record_cancellation(game_id: str, attendees: int, revenue: float, day: Optional[str] = None,
+                        paid: bool = False) -> None:
+    """paid: its payment was already recorded."""
+    deltas = {'cancellations': 1, 'canceled_attendees': attendees, 'canceled_revenue': revenue}
+    if paid:
+        deltas.update(canceled_payments=1, canceled_paid_revenue=revenue)
+    _apply(game_id, day, **deltas)
+
+
+def record_payment(game_id: str, amount: float, day: Optional[str] = None, canceled: bool = False) -> None:
+    """canceled: the registration was canceled before its payment was recorded."""
+    deltas = {'payments': 1, 'paid_revenue': amount}
+    if canceled:
+        deltas.update(canceled_payments=1, canceled_paid_revenue=amount)
+    _apply(game_id, day, **deltas)
+
+
+def _summary(counters: dict) -> dict:
+    """Derive net figures from raw counters."""
+    active = counters['registrations'] - counters['cancellations']
+    active_paid = counters['payments'] - counters['canceled_payments']
+    net_revenue = counters['revenue'] - counters['canceled_revenue']
+    return {
+        **counters,
+        'net_attendees': counters['attendees'] - counters['canceled_attendees'],
+        'net_revenue': round(net_revenue, 2),
+        'unpaid': max(0, active - active_paid),
+        'unpaid_revenue': round(max(0, net_revenue - (counters['paid_revenue'] - counters['canceled_paid_revenue'])), 2),
+    }
+
+
+def game_report(game_id: str, totals: Optional[dict] = None) -> Optional[dict]:
+    """All-time figures for one game."""
+    totals = totals if totals is not None else load_totals()
+    game = totals.get(game_id)
+    if not game:
+        return None
+    return _summary({**_empty(), **game['total']})
+
+
+def period_report(game_id: str, days: int = 7, end: Optional[datetime] = None, totals: Optional[dict] = None) -> Optional[dict]:
+    """Figures for one game over the last ``days`` day buckets."""
+    totals = totals if totals is not None else load_totals()
+    game = totals.get(game_id)
+    if not game:
+        return None
+    end = end or datetime.now()
+    counters = _empty()
+    for offset in range(days):
+        bucket = game['days'].get((end - timedelta(days=offset)).strftime('%Y-%m-%d'))
+        if bucket:
+            for counter in COUNTERS:
+                counters[counter] = round(counters[counter] + bucket.get(counter, 0), 2)
+    return _summary(counters)
+
+
+def snapshot_rows(totals: Optional[dict] = None) -> List[dict]:
+    """One row per game and day, straight from the running totals."""
+    totals = totals if totals is not None else load_totals()
+    rows = []
+    for game_id, game in sorted(totals.items()):
+        for day, bucket in sorted(game['days'].items()):
+            rows.append({'game_id': game_id, 'day': day, **_empty(), **bucket})
+    return rows
+
+
+def export_snapshot(path: str) -> int:
+    """Write the totals to CSV, or Parquet when the path ends in .parquet."""
+    rows = snapshot_rows()
+    if path.endswith('.parquet'):
+        import pandas as pd  # needs pyarrow or fastparquet
+        pd.DataFrame(rows, columns=['game_id', 'day', *COUNTERS]).to_parquet(path, index=False)
+    else:
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=['game_id', 'day', *COUNTERS])
+            writer.writeheader()
+            writer.writerows(rows)
+    logging.info(f"Exported {len(rows)} report rows to {path}")
+    return len(rows)
+
+
+def rebuild_from_user_data(user_data: dict) -> dict:
+    """One-off bootstrap of the totals from existing registrations.
+
+    Each event goes to the day of its stamp, as when it was recorded live.
+    """
+    totals = {}
+    for registrations in user_data.values():
+        for reg in registrations:
+            details = reg.get('game_details') or {}
+            game_id = details.get('game_id')
+            if not game_id or not reg.get('invoice_number'):
+                continue
+            if not _claim_invoice(totals, game_id, reg['invoice_number']):
+                continue
+            attendees = int(reg.get('cust_amount', 0))
+            revenue = float(reg.get('total_price', 0))
+            _add(totals, game_id, event_day(reg.get('registered_at')),
+                 {'registrations': 1, 'attendees': attendees, 'revenue': revenue})
+            if reg.get('canceled'):
+                _add(totals, game_id, event_day(reg.get('canceled_at')),
+                     {'cancellations': 1, 'canceled_attendees': attendees, 'canceled_revenue': revenue})
+            if reg.get('payment_status') == 'complete':
+                _add(totals, game_id, event_day(reg.get('paid_at')), {'payments': 1, 'paid_revenue': revenue})
+                if reg.get('canceled'):
+                    # Live, this is counted by whichever of the two came second
+                    stamps = [stamp for stamp in (reg.get('canceled_at'), reg.get('paid_at')) if stamp]
+                    _add(totals, game_id, event_day(max(stamps) if stamps else None),
+                         {'canceled_payments': 1, 'canceled_paid_revenue': revenue})
+    save_json(REPORTS_FILE, totals)
+    return totals
+
+
+def format_report(game_id: str, report: dict, title: str) -> str:
+    return (
+        f"📊 {title} - {game_id}\n"
+        f"Registrations: {report['registrations']} (canceled {report['cancellations']})\n"
+        f"Attendees: {report['net_attendees']}\n"
+        f"Revenue: €{report['net_revenue']:.2f}\n"
+        f"Paid: {report['payments']} (€{report['paid_revenue']:.2f})\n"
+        f"Unpaid: {report['unpaid']} (€{report['unpaid_revenue']:.2f})\n"
+    )
+
+
+if __name__ == "__main__":
+    import sys
+    args = sys.argv[1:]
+    if args[:1] == ['export'] and len(args) == 2:
+        print(f"Exported {export_snapshot(args[1])} rows.")
+    elif args[:1] == ['rebuild']:
+        from common.codec import StreamedUserData
+        from common.file_manager import USER_DATA_FILE
+        print(f"Rebuilt totals for {len(rebuild_from_user_data(StreamedUserData(USER_DATA_FILE)))} games.")
+    elif args:
+        report = game_report(args[0])
+        print(format_report(args[0], report, "All time") if report else f"No data for {args[0]}.")
+    else:
+        for game_id in sorted(load_totals()):
+            print(format_report(game_id, game_report(game_id), "All time"))
@@ -0,0 +1,231 @@
+"""Timeouts, circuit breakers and bulkheads for calls to external services.
+
+Every external dependency (Stripe, SMTP, the Bot API) gets one Guard:
+
+    stripe_guard = Guard('stripe', timeout=10, max_concurrent=8)
+    session = await stripe_guard.call(stripe.checkout.Session.create, ...)
+
+* a call that takes longer than ``timeout`` raises ``DependencyTimeout``,
+* at most ``max_concurrent`` calls run at once; a caller that can't get a
+  slot within ``queue_timeout`` gets ``BulkheadFull``,
+* after ``failure_threshold`` failures in a row the circuit opens and calls
+  fail at once with ``CircuitOpen`` for ``reset_timeout`` seconds, then one
+  trial call decides whether it closes again.
+
+All three derive from ``DependencyUnavailable``; callers catch that and fall
+back (defer the work, reply without the result), or use ``call_or`` to get
+a default instead.
+
+Blocking functions run on the guard's own threads, so a hung dependency
+can only tie up its own slots, never the event loop or the shared default
+executor. A blocking call that timed out keeps its slot until the thread
+returns.
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Tuple, Type
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class DependencyUnavailable(Exception):
+    """The dependency could not be used; the caller should fall back."""
+
+
+class DependencyTimeout(DependencyUnavailable):
+    pass
+
+
+class CircuitOpen(DependencyUnavailable):
+    pass
+
+
+class BulkheadFull(DependencyUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+
+    def allow(self, now: float) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN and not self._trial_running:
+            self._trial_running = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self._trial_running = False
+
+    def record_failure(self, now: float) -> bool:
+        """Count a failure; returns True if this opened the circuit."""
+        self.failures += 1
+        self._trial_running = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            opened = self.state != OPEN
+            self.state = OPEN
+            self.opened_at = now
+            return opened
+        return False
+
+
+class Guard:
+    def __init__(self, name: str, timeout: float, max_concurrent: int = 4, queue_timeout: float = 1.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 ignore: Tuple[Type[BaseException], ...] = ()):
+        """``ignore``: exceptions that are the caller's fault (e.g. a rejected
+        card) and don't count against the dependency."""
+        self.name = name
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self.ignore = ignore
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix=f"guard-{name}")
+        self.counts: Dict[str, int] = {
+            'calls': 0, 'ok': 0, 'errors': 0, 'timeouts': 0, 'rejected_open': 0, 'rejected_full': 0,
+        }
+
+    def stats(self) -> Dict[str, object]:
+        return {**self.counts, 'state': self.breaker.state,
+                'in_flight': self.max_concurrent - self._slots._value}
+
+    def _failure(self, kind: str) -> None:
+        self.counts[kind] += 1
+        if self.breaker.record_failure(time.monotonic()):
+            logging.warning(f"{self.name}: circuit opened after {self.breaker.failures} failures")
+
+    def _release(self, future: asyncio.Future) -> None:
+        self._slots.release()
+        # Retrieve the result of a call nobody waits for any more
+        if not future.cancelled():
+            future.exception()
+
+    async def call(self, func, *args, **kwargs):
+        """Run ``func(*args, **kwargs)`` (sync or async) under the guard."""
+        self.counts['calls'] += 1
+        if not self.breaker.allow(time.monotonic()):
+            self.counts['rejected_open'] += 1
+            raise CircuitOpen(f"{self.name} is unavailable (circuit open)")
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.counts['rejected_full'] += 1
+            # Give back the half-open trial this call was granted
+            self.breaker._trial_running = False
+            raise BulkheadFull(f"{self.name} is busy ({self.max_concurrent} calls in flight)")
+
+        blocking = not asyncio.iscoroutinefunction(func)
+        if blocking:
+            future = asyncio.get_running_loop().run_in_executor(self._executor, partial(func, *args, **kwargs))
+        else:
+            future = asyncio.ensure_future(func(*args, **kwargs))
+        # The slot is freed when the call really ends, not when we stop waiting
+        future.add_done_callback(self._release)
+
+        try:
+            result = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            # A coroutine can be stopped; a thread is left to finish on its own.
+            # Cancelling its future would free the slot while the thread still runs.
+            if not blocking:
+                future.cancel()
+            self._failure('timeouts')
+            raise DependencyTimeout(f"{self.name} did not answer within {self.timeout}s")
+        except self.ignore:
+            self.breaker.record_success()
+            raise
+        except Exception:
+            self._failure('errors')
+            raise
+        self.counts['ok'] += 1
+        self.breaker.record_success()
+        return result
+
+    async def call_or(self, default, func, *args, **kwargs):
+        """``call()``, returning ``default`` when the dependency is unavailable."""
+        try:
+            return await self.call(func, *args, **kwargs)
+        except DependencyUnavailable as e:
+            logging.warning(f"{self.name}: falling back: {e}")
+            return default
+
+
+def _benchmark(requests: int = 100, concurrency: int = 20) -> None:
+    """Fault injection: handler latency against a dependency that degrades.
+
+    The dependency answers in 50 ms, or hangs for 2 s per call, or fails.
+    Unguarded handlers wait it out on a thread pool of the same size as the
+    guard's; guarded ones time out after 0.5 s or fail fast on an open
+    circuit and take their fallback.
+    """
+    def dependency(mode: str) -> str:
+        if mode == 'slow':
+            time.sleep(2.0)
+        elif mode == 'error':
+            time.sleep(0.05)
+            raise ConnectionError("injected failure")
+        else:
+            time.sleep(0.05)
+        return 'ok'
+
+    async def scenario(mode: str, guarded: bool):
+        guard = Guard('dep', timeout=0.5, max_concurrent=16, queue_timeout=1.0,
+                      failure_threshold=5, reset_timeout=30)
+        direct = ThreadPoolExecutor(max_workers=16)
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies, fallbacks = [], 0
+
+        async def handler():
+            nonlocal fallbacks
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    if guarded:
+                        await guard.call(dependency, mode)
+                    else:
+                        await loop.run_in_executor(direct, dependency, mode)
+                except (DependencyUnavailable, ConnectionError):
+                    fallbacks += 1
+                latencies.append(time.monotonic() - started)
+
+        started = time.monotonic()
+        await asyncio.gather(*(handler() for _ in range(requests)))
+        total = time.monotonic() - started
+        latencies.sort()
+        p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99) - 1]
+        label = f"{mode:7} {'guarded' if guarded else 'direct':8}"
+        print(f"{label} p50 {p50 * 1000:7.0f} ms  p99 {p99 * 1000:7.0f} ms  max {latencies[-1] * 1000:7.0f} ms  "
+              f"fallbacks {fallbacks:3}  total {total:5.1f} s  {guard.stats() if guarded else ''}")
+        guard._executor.shutdown(wait=False)
+        direct.shutdown(wait=False)
+
+    async def main():
+        for mode in ('healthy', 'error', 'slow'):
+            for guarded in (False, True):
+                await scenario(mode, guarded)
+
+    print(f"{requests} handler calls, {concurrency} at a time")
+    asyncio.run(main())
+
+
+if __name__ == "__main__":
+    import sys
+    _benchmark(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,238 @@
+"""Precompiled translations and message templates.
+
+``store/translations.json`` is compiled once at startup into per-language
+``str.format`` templates (labels already substituted, only the per-message
+fields left open) and prebuilt reply keyboards, so handlers render a whole
+message with a single ``format_map`` call instead of one ``t()`` lookup per
+line.
+"""
+
+import json
+import logging
+import os
+import timeit
+from typing import Dict, Set
+from telegram import KeyboardButton, ReplyKeyboardMarkup
+
+TRANSLATIONS_FILE = "./store/translations.json"
+BOT_CONFIG_FILE = "./common/bot_config.json"
+
+DEFAULT_LANG = 'en'
+LANGUAGES = ('en', 'lv', 'ru')
+
+# Every key the handlers look up; checked for each language at load time
+REQUIRED_KEYS = {
+    'start', 'select_language', 'register', 'retrieve', 'change_language',
+    'canceled', 'cancel_registration', 'ask_full_name', 'ask_email',
+    'ask_cust_amount', 'invalid_number', 'invalid_option', 'invalid_email',
+    'no_registrations', 'full_name', 'email', 'attendees', 'new_registration',
+    'main_menu', 'registering_for', 'game', 'place', 'date', 'time',
+    'price_per_person', 'total_price', 'registration_complete',
+    'game_info_missing', 'summary', 'not_enough_spots', 'provide_invoice',
+    'invoice_number', 'invalid_invoice', 'cancellation_successful',
+    'cancellation_failed', 'pdf_not_found', 'registration_confirmation',
+    'payment_link_deferred', 'invoice_link', 'payment_link_failed',
+}
+
+# Message layouts: translation keys in <>, per-message fields in {}
+LAYOUTS = {
+    'game_info': (
+        "📢 <registering_for>\n"
+        "🏆 <game>: {game_name}\n"
+        "📍 <place>: {place}\n"
+        "🕒 <date>: {date}\n"
+        "🕒 <time>: {time}\n"
+        "🎟️ <price_per_person>: €{price_per_person}\n"
+    ),
+    'summary': (
+        "📢 <summary>\n"
+        "🏆 <game>: {game_name}\n"
+        "📍 <place>: {place}\n"
+        "🕒 <date>: {date}\n"
+        "🕒 <time>: {time}\n"
+        "🎟️ <price_per_person>: €{price_per_person}\n"
+        "👤 <full_name>: {full_name}\n"
+        "✉️ <email>: {email}\n"
+        "🧑‍🤝‍🧑 <attendees>: {cust_amount}\n"
+        "💶 <total_price>: €{total_price:.2f}\n"
+    ),
+    'registration': (
+        "👤 <full_name>: {full_name}\n"
+        "✉️ <email>: {email}\n"
+        "🧑‍🤝‍🧑 <attendees>: {cust_amount}\n"
+        "💶 <total_price>: €{total_price:.2f}\n"
+        "🏆 <game>: {game_name}\n"
+        "📍 <place>: {place}\n"
+        "🕒 <date>: {date}\n"
+        "🕒 <time>: {time}\n"
+        "📄 <invoice_number>: {invoice_number}\n"
+    ),
+    'email': (
+        "📢 <summary>\n"
+        "👤 <full_name>: {full_name}\n"
+        "✉️ <email>: {email}\n"
+        "🧑‍🤝‍🧑 <attendees>: {cust_amount}\n"
+        "💶 <total_price>: €{total_price:.2f}\n"
+        "🏆 <game>: {game_name}\n"
+        "📍 <place>: {place}\n"
+        "🕒 <date>: {date}\n"
+        "🕒 <time>: {time}\n"
+        "📄 <invoice_number>: {invoice_number}\n"
+    ),
+    'canceled': "⚠️ <canceled>: <canceled>\n",
+}
+
+GAME_FIELDS = ('game_name', 'place', 'date', 'time', 'price_per_person')
+
+# MarkdownV2 escaping through a single str.translate table
+MARKDOWN_SPECIAL = '_*[]()~`>#+-=|{}.!'
+_MARKDOWN_TABLE = str.maketrans({char: '\\' + char for char in MARKDOWN_SPECIAL})
+
+
+def escape_markdown(text) -> str:
+    """Escape MarkdownV2 special characters."""
+    if text is None:
+        return ''
+    return str(text).translate(_MARKDOWN_TABLE)
+
+
+def find_missing_keys(translations: dict) -> Dict[str, Set[str]]:
+    """Return {lang: missing keys} for every language that lacks a required key."""
+    missing = {}
+    for lang in LANGUAGES:
+        keys = set(translations.get(lang, {}))
+        absent = REQUIRED_KEYS - keys
+        if absent:
+            missing[lang] = absent
+    return missing
+
+
+def _compile_layout(layout: str, texts: dict) -> str:
+    """Substitute translated labels into a layout, leaving {fields} open."""
+    compiled = layout
+    for key in REQUIRED_KEYS:
+        if f"<{key}>" in compiled:
+            label = texts.get(key, key).replace('{', '{{').replace('}', '}}')
+            compiled = compiled.replace(f"<{key}>", label)
+    return compiled
+
+
+class MessageTemplates:
+    """Translations, compiled message templates and keyboards for all languages."""
+
+    def __init__(self, translations: dict, bot_config: dict):
+        self.missing = find_missing_keys(translations)
+        for lang, keys in self.missing.items():
+            logging.warning(f"Translations for '{lang}' are missing keys: {', '.join(sorted(keys))}")
+
+        fallback = translations.get(DEFAULT_LANG, {})
+        self.texts = {lang: {**fallback, **translations.get(lang, {})} for lang in LANGUAGES}
+        self.templates = {
+            name: {lang: _compile_layout(layout, self.texts[lang]) for lang in LANGUAGES}
+            for name, layout in LAYOUTS.items()
+        }
+
+        self.welcome_all = ''.join(f"{self.texts[lang].get('start', 'start')}\n\n" for lang in LANGUAGES)
+        self.select_language_all = ''.join(
+            f"{self.texts[lang].get('select_language', 'select_language')}\n\n" for lang in LANGUAGES
+        )
+
+        language_buttons = bot_config.get('language_buttons', ["English", "Latviešu", "Русский"])
+        self.language_keyboard = ReplyKeyboardMarkup(
+            [[KeyboardButton(btn) for btn in language_buttons]],
+            resize_keyboard=True, one_time_keyboard=True
+        )
+        self.main_menu_keyboards = {lang: self._build_main_menu(lang) for lang in LANGUAGES}
+
+    def _build_main_menu(self, lang: str) -> ReplyKeyboardMarkup:
+        keyboard = [
+            [KeyboardButton(self.t("register", lang)), KeyboardButton(self.t("retrieve", lang))],
+            [KeyboardButton(self.t("change_language", lang))], [KeyboardButton(self.t("cancel_registration", lang))]
+        ]
+        return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+
+    def t(self, key: str, lang: str = DEFAULT_LANG) -> str:
+        return self.texts.get(lang, self.texts[DEFAULT_LANG]).get(key, key)
+
+    def main_menu_keyboard(self, lang: str) -> ReplyKeyboardMarkup:
+        return self.main_menu_keyboards.get(lang, self.main_menu_keyboards[DEFAULT_LANG])
+
+    def button_labels(self) -> set:
+        """Text of every reply keyboard button (language choice and main menu)."""
+        keyboards = [self.language_keyboard, *self.main_menu_keyboards.values()]
+        return {button.text for keyboard in keyboards for row in keyboard.keyboard for button in row}
+
+    def render(self, name: str, lang: str, **fields) -> str:
+        """Fill a compiled template. Fields are passed through as given."""
+        per_lang = self.templates[name]
+        return per_lang.get(lang, per_lang[DEFAULT_LANG]).format_map(fields)
+
+    def game_fields(self, game_info: dict, escape: bool = True) -> dict:
+        """Game fields for a template, MarkdownV2-escaped unless escape=False."""
+        if escape:
+            return {field: escape_markdown(game_info.get(field, '')) for field in GAME_FIELDS}
+        return {field: game_info.get(field, '') for field in GAME_FIELDS}
+
+
+def load_templates(translations_file: str = TRANSLATIONS_FILE, bot_config_file: str = BOT_CONFIG_FILE) -> MessageTemplates:
+    """Load and compile translations and bot config from disk."""
+    def read(path):
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return MessageTemplates(read(translations_file), read(bot_config_file))
+
+
+def _benchmark(number: int = 20000) -> None:
+    """Compare the per-line t()/list-comprehension summary with the compiled one."""
+    templates = load_templates()
+    translations = {lang: templates.texts[lang] for lang in LANGUAGES}
+    game = {'game_name': 'Game2', 'place': 'StreetB', 'date': '2024-09-21',
+            'time': '21:00', 'price_per_person': '15'}
+    escape_chars = list(MARKDOWN_SPECIAL)
+
+    def legacy_escape(text):
+        return ''.join(['\\' + char if char in escape_chars else char for char in text])
+
+    def t(key, lang):
+        return translations.get(lang, translations['en']).get(key, key)
+
+    def legacy(lang='lv'):
+        return (
+            f"📢 {t('summary', lang)}\n"
+            f"🏆 {t('game', lang)}: {legacy_escape(game['game_name'])}\n"
+            f"📍 {t('place', lang)}: {legacy_escape(game['place'])}\n"
+            f"🕒 {t('date', lang)}: {legacy_escape(game['date'])}\n"
+            f"🕒 {t('time', lang)}: {legacy_escape(game['time'])}\n"
+            f"🎟️ {t('price_per_person', lang)}: €{legacy_escape(game['price_per_person'])}\n"
+            f"👤 {t('full_name', lang)}: {legacy_escape('Jānis Bērziņš')}\n"
+            f"✉️ {t('email', lang)}: {legacy_escape('janis.berzins@example.com')}\n"
+            f"🧑‍🤝‍🧑 {t('attendees', lang)}: {2}\n"
+            f"💶 {t('total_price', lang)}: €{30.0:.2f}\n"
+        )
+
+    def compiled(lang='lv'):
+        return templates.render(
+            'summary', lang, **templates.game_fields(game),
+            full_name=escape_markdown('Jānis Bērziņš'),
+            email=escape_markdown('janis.berzins@example.com'),
+            cust_amount=2, total_price=30.0
+        )
+
+    assert legacy() == compiled()
+    legacy_time = timeit.timeit(legacy, number=number)
+    compiled_time = timeit.timeit(compiled, number=number)
+    print(f"legacy:   {legacy_time / number * 1e6:.2f} us/message")
+    print(f"compiled: {compiled_time / number * 1e6:.2f} us/message")
+    print(f"speedup:  {legacy_time / compiled_time:.2f}x")
+
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == "check":
+        missing = load_templates().missing
+        for lang, keys in missing.items():
+            print(f"{lang}: {', '.join(sorted(keys))}")
+        sys.exit(1 if missing else 0)
+    _benchmark()
@@ -0,0 +1,500 @@
+"""Record real update traffic and replay it against a build of the bot.
+
+Recording is opt-in: with ``RECORD_UPDATES=./store/traffic/capture.jsonl``
+set, reg_bot1 writes every incoming update as one JSON line
+
+    {"t": 12.345, "u": {...update, anonymized...}}
+
+where ``t`` is seconds since the recording started. Each run needs a new
+file: the pseudonym key and the clock start per run, so the recorder
+refuses to append to an existing capture. Lines are written by a
+background thread, never on the event loop.
+
+User and chat ids are replaced with keyed pseudonyms (the same user keeps
+the same pseudonym, so per-user ordering and conversations survive), names
+and usernames are dropped, e-mails become ``user<n>@example.com``, numbers
+longer than four digits (phone numbers) become keyed digits of the same
+length, and free text that isn't a command, keyboard button, short number
+or invoice number becomes "Anon User". Inline query terms that match no
+game are replaced with "#anon".
+
+The replayer feeds a capture into a fresh copy of the bot, on the original
+timing or faster, with Stripe, SMTP and the Bot API replaced by stubs that
+answer after a fixed delay, and reports latency per update kind and
+throughput:
+
+    python -m common.traffic replay capture.jsonl --speed 10 --label main --out main.json
+    python -m common.traffic compare main.json branch.json
+
+The bot runs in a temporary copy of ./store and ./common/bot_config.json,
+so replays never touch real data.
+"""
+
+import argparse
+import asyncio
+import atexit
+import hashlib
+import hmac
+import importlib
+import json
+import os
+import queue
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+from telegram import Update
+from telegram.ext import CallbackContext
+from telegram.request import BaseRequest, RequestData
+
+ANON_TEXT = "Anon User"
+# Never a substring of a game's search text, so the query still matches nothing
+ANON_TERM = "#anon"
+# Spot counts and amounts are kept; longer numbers may be phone numbers
+MAX_KEPT_DIGITS = 4
+QUEUE_SIZE = 10000
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+_INVOICE_RE = re.compile(r"^OG_\d+_\d+$")
+# Keys of Telegram objects that identify a person
+_PERSON_KEYS = {'from', 'chat', 'user', 'sender_chat'}
+# Message fields a replay needs; everything else (contacts, media, replies) is dropped
+_MESSAGE_KEYS = {'message_id', 'date', 'chat', 'from', 'text', 'entities'}
+
+
+class Anonymizer:
+    def __init__(self, salt: bytes, keep_texts: Iterable[str] = (),
+                 known_term: Optional[Callable[[str], bool]] = None):
+        self.salt = salt
+        self.keep_texts = set(keep_texts)
+        # Whether an inline query term matches a game; without it every term is replaced
+        self.known_term = known_term
+
+    def _digest(self, value) -> bytes:
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha256).digest()
+
+    def pseudonym(self, value) -> int:
+        # Positive, below 2**52 like real ids, and never equal to a real admin id by chance
+        return int.from_bytes(self._digest(value)[:6], 'big') + 10**15
+
+    def digits(self, text: str) -> str:
+        """Keyed digits of the same length, so the text still parses as a number."""
+        return str(int.from_bytes(self._digest(text), 'big')).zfill(len(text))[-len(text):]
+
+    def query(self, query: str) -> str:
+        return " ".join(term if self.known_term is not None and self.known_term(term) else ANON_TERM
+                        for term in query.split())
+
+    def person(self, entity: dict) -> dict:
+        result = {'id': self.pseudonym(entity['id'])}
+        for key in ('type', 'is_bot', 'language_code'):
+            if key in entity:
+                result[key] = entity[key]
+        if 'is_bot' in entity or 'first_name' in entity:
+            result['first_name'] = "User"
+        return result
+
+    def text(self, text: str) -> Optional[str]:
+        """The text to record, or None if it was replaced (its entities no longer fit)."""
+        if text.startswith('/') or text in self.keep_texts or _INVOICE_RE.match(text):
+            return text
+        if text.isdigit():
+            return text if len(text) <= MAX_KEPT_DIGITS else self.digits(text)
+        if _EMAIL_RE.match(text):
+            return f"user{self.pseudonym(text) % 100000}@example.com"
+        return None
+
+    def message(self, message: dict) -> dict:
+        result = {}
+        for key, value in message.items():
+            if key not in _MESSAGE_KEYS:
+                continue
+            result[key] = self.person(value) if key in _PERSON_KEYS else value
+        if 'text' in result:
+            kept = self.text(result['text'])
+            if kept is None:
+                result['text'] = ANON_TEXT
+                result.pop('entities', None)
+            else:
+                result['text'] = kept
+        return result
+
+    def update(self, update: dict) -> dict:
+        result = {}
+        for key, value in update.items():
+            if key in ('message', 'edited_message'):
+                result[key] = self.message(value)
+            elif key == 'inline_query':
+                result[key] = {'id': value['id'], 'from': self.person(value['from']),
+                               'query': self.query(value.get('query', '')), 'offset': value.get('offset', '')}
+            elif key == 'callback_query':
+                callback = {'id': value['id'], 'from': self.person(value['from']),
+                            'chat_instance': value.get('chat_instance', ''), 'data': value.get('data')}
+                if 'message' in value:
+                    callback['message'] = self.message(value['message'])
+                result[key] = callback
+            elif key == 'update_id':
+                result[key] = value
+        return result
+
+
+class UpdateRecorder:
+    """TypeHandler callback that writes anonymized updates to a new capture file.
+
+    Raises FileExistsError if the capture already exists: its pseudonyms and
+    timestamps belong to another run.
+    """
+
+    def __init__(self, path: str, salt: Optional[bytes] = None, keep_texts: Iterable[str] = (),
+                 known_term: Optional[Callable[[str], bool]] = None):
+        self.path = path
+        # A fresh salt per capture unless one is given: pseudonyms can't be linked across captures
+        self.anonymizer = Anonymizer(salt or os.urandom(16), keep_texts, known_term)
+        self.recorded = 0
+        self.dropped = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'x', encoding='utf-8')
+        self.started = time.monotonic()
+        self._queue: queue.Queue = queue.Queue(QUEUE_SIZE)
+        self._writer = threading.Thread(target=self._write_lines, name="update-recorder", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    async def __call__(self, update: object, context: CallbackContext) -> None:
+        if not isinstance(update, Update):
+            return
+        line = {'t': round(time.monotonic() - self.started, 3),
+                'u': self.anonymizer.update(update.to_dict())}
+        try:
+            self._queue.put_nowait(json.dumps(line, ensure_ascii=False, separators=(',', ':')) + "\n")
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.recorded += 1
+
+    def _write_lines(self) -> None:
+        while True:
+            line = self._queue.get()
+            if line is None:
+                break
+            self._file.write(line)
+            # Flush once the backlog is written: a crash loses at most what was still queued
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    def stats(self) -> Dict[str, object]:
+        return {'recorded': self.recorded, 'dropped': self.dropped, 'queued': self._queue.qsize(),
+                'path': self.path}
+
+    def close(self) -> None:
+        """Write what is queued and close the file; safe to call more than once."""
+        if self._writer.is_alive():
+            self._queue.put(None, timeout=5)
+            self._writer.join(timeout=5)
+
+
+def read_capture(path: str) -> List[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def update_kind(data: dict) -> str:
+    """Group for latency stats: the command, 'text', 'inline_query', ..."""
+    message = data.get('message') or data.get('edited_message')
+    if message is not None:
+        text = message.get('text', '')
+        if text.startswith('/'):
+            return text.split()[0].split('@')[0]
+        return 'text'
+    for kind in ('inline_query', 'callback_query'):
+        if kind in data:
+            return kind
+    return 'other'
+
+
+class StubRequest(BaseRequest):
+    """Bot API that answers every call after ``latency`` seconds without a network."""
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _result(self, api_method: str, parameters: dict):
+        if api_method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': "Replay", 'username': "replay_bot",
+                    'can_join_groups': False, 'can_read_all_group_messages': False,
+                    'supports_inline_queries': True}
+        if api_method.startswith('send') or api_method.startswith('edit'):
+            self._message_id += 1
+            chat_id = parameters.get('chat_id', 0)
+            chat_id = chat_id if isinstance(chat_id, int) or str(chat_id).lstrip('-').isdigit() else 0
+            return {'message_id': self._message_id, 'date': int(time.time()),
+                    'chat': {'id': int(chat_id), 'type': 'private'}, 'text': parameters.get('text', '')}
+        return True
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if api_method != 'getMe':
+            await asyncio.sleep(self.latency)
+        parameters = request_data.parameters if request_data is not None else {}
+        payload = {'ok': True, 'result': self._result(api_method, parameters)}
+        return 200, json.dumps(payload).encode()
+
+
+class ReplayHost:
+    """Stand-in for BotHost: same catalog and metrics, stubbed Bot API."""
+
+    def __init__(self, latency: float):
+        from common.catalog import Catalog
+        from common.file_manager import GAMES_CSV_FILE
+        from common.metrics import Metrics
+        self.metrics = Metrics()
+        self.catalog = Catalog(GAMES_CSV_FILE, metrics=self.metrics)
+        self.stub = StubRequest(latency)
+
+    def request(self) -> StubRequest:
+        return self.stub
+
+
+def stub_dependencies(stripe_latency: float, smtp_latency: float) -> Dict[str, int]:
+    """Replace Stripe and SMTP with deterministic stubs; returns their call counters."""
+    import stripe
+    import yagmail
+    calls = {'stripe': 0, 'smtp': 0}
+
+    class Session:
+        def __init__(self, number: int):
+            self.id = f"cs_replay_{number}"
+            self.url = f"https://checkout.example.com/{self.id}"
+
+    def create_session(**kwargs):
+        calls['stripe'] += 1
+        time.sleep(stripe_latency)
+        return Session(calls['stripe'])
+
+    class SMTP:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        def send(self, *args, **kwargs):
+            calls['smtp'] += 1
+            time.sleep(smtp_latency)
+
+    stripe.checkout.Session.create = create_session
+    yagmail.SMTP = SMTP
+    return calls
+
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+async def _replay(module, capture: List[dict], speed: float, args) -> dict:
+    host = ReplayHost(args.telegram_latency)
+    dependency_calls = stub_dependencies(args.stripe_latency, args.smtp_latency)
+    await host.catalog.refresh()
+    app = module.build_application(host)
+
+    sent: Dict[int, float] = {}
+    kinds: Dict[int, str] = {}
+    latencies: Dict[str, List[float]] = {}
+    process_update = app.process_update
+
+    async def timed_process_update(update: object) -> None:
+        try:
+            await process_update(update)
+        finally:
+            if isinstance(update, Update) and update.update_id in sent:
+                latency = time.monotonic() - sent.pop(update.update_id)
+                latencies.setdefault(kinds.pop(update.update_id), []).append(latency)
+
+    # Application.start feeds the update queue through self.process_update
+    app.process_update = timed_process_update
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+
+    started = time.monotonic()
+    for number, line in enumerate(capture):
+        if speed > 0:
+            delay = started + line['t'] / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        data = dict(line['u'])
+        # Captures may be concatenated; keep update ids unique within a replay
+        data['update_id'] = number + 1
+        update = Update.de_json(data, app.bot)
+        sent[update.update_id] = time.monotonic()
+        kinds[update.update_id] = update_kind(data)
+        await app.update_queue.put(update)
+
+    # Duplicates and rate-limited updates dropped by the update processor never reach process_update
+    handle_deadline = time.monotonic() + args.handle_timeout
+    while (len(sent) > getattr(app.update_processor, 'dropped', 0)
+           and time.monotonic() < handle_deadline):
+        await asyncio.sleep(0.01)
+    handled = time.monotonic() - started
+    unfinished = len(sent) - getattr(app.update_processor, 'dropped', 0)
+    if unfinished > 0:
+        print(f"Warning: {unfinished} updates not handled within {args.handle_timeout}s", file=sys.stderr)
+
+    # Confirmation e-mails, PDFs and payment links run after the reply
+    pipeline = getattr(module, 'registration_pipeline', None)
+    drain_deadline = time.monotonic() + args.drain_timeout
+    while pipeline is not None and pipeline._tasks and time.monotonic() < drain_deadline:
+        await asyncio.sleep(0.05)
+    drained = time.monotonic() - started
+
+    await app.stop()
+    await app.shutdown()
+
+    handled_count = sum(len(values) for values in latencies.values())
+    result = {
+        'label': args.label,
+        'capture': args.capture,
+        'speed': speed,
+        'updates': len(capture),
+        'handled': handled_count,
+        'dropped': len(sent),
+        'unfinished': max(unfinished, 0),
+        'seconds': round(handled, 3),
+        'throughput': round(handled_count / handled, 1) if handled else 0.0,
+        'drain_seconds': round(drained, 3),
+        'latency_ms': {},
+        'telegram_calls': dict(host.stub.calls),
+        'dependency_calls': dependency_calls,
+        'metrics': {key: value for key, value in host.metrics.snapshot().items()
+                    if isinstance(value, (int, float, str))},
+    }
+    for kind, values in sorted(latencies.items()) + [('all', [v for vs in latencies.values() for v in vs])]:
+        values.sort()
+        result['latency_ms'][kind] = {
+            'count': len(values),
+            'p50': round(percentile(values, 0.5) * 1000, 1),
+            'p90': round(percentile(values, 0.9) * 1000, 1),
+            'p99': round(percentile(values, 0.99) * 1000, 1),
+            'max': round(values[-1] * 1000, 1) if values else 0.0,
+        }
+    return result
+
+
+def replay(args) -> dict:
+    capture = read_capture(args.capture)
+    repo = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="replay_")
+    try:
+        shutil.copytree(os.path.join(repo, 'store'), os.path.join(workdir, 'store'),
+                        ignore=shutil.ignore_patterns('traffic', 'profiles', 'broadcasts', '*.lock'))
+        os.makedirs(os.path.join(workdir, 'common'))
+        if os.path.exists(os.path.join(repo, 'common', 'bot_config.json')):
+            shutil.copy(os.path.join(repo, 'common', 'bot_config.json'), os.path.join(workdir, 'common'))
+        for font in ('DejaVuSans.ttf',):
+            if os.path.exists(os.path.join(repo, font)):
+                shutil.copy(os.path.join(repo, font), workdir)
+        # Recorded ids are pseudonyms, so no replayed user is an admin
+        os.environ['BOT_TOKEN'] = "123456:replay"
+        os.environ.pop('RECORD_UPDATES', None)
+        sys.path.insert(0, repo)
+        os.chdir(workdir)
+        module = importlib.import_module(args.bot)
+        return asyncio.run(_replay(module, capture, args.speed, args))
+    finally:
+        os.chdir(repo)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def format_result(result: dict) -> str:
+    lines = [
+        f"{result['label']}: {result['handled']}/{result['updates']} updates in {result['seconds']}s "
+        f"({result['throughput']}/s, speed x{result['speed']}), {result['dropped']} dropped "
+        f"({result.get('unfinished', 0)} unfinished), "
+        f"pipeline drained at {result['drain_seconds']}s",
+        f"{'kind':24} {'count':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}",
+    ]
+    for kind, stats in result['latency_ms'].items():
+        lines.append(f"{kind:24} {stats['count']:6} {stats['p50']:8} {stats['p90']:8} "
+                     f"{stats['p99']:8} {stats['max']:8}")
+    return "\n".join(lines)
+
+
+def compare(base: dict, other: dict) -> str:
+    def change(before: float, after: float) -> str:
+        if not before:
+            return "    n/a"
+        return f"{(after - before) / before:+7.1%}"
+
+    lines = [
+        f"{base['label']} -> {other['label']}",
+        f"throughput {base['throughput']}/s -> {other['throughput']}/s ({change(base['throughput'], other['throughput'])})",
+        f"drain      {base['drain_seconds']}s -> {other['drain_seconds']}s",
+        f"dropped    {base['dropped']} -> {other['dropped']}",
+        f"{'kind (ms)':24} {'p50':>8}{'new':>9} {'':7} {'p99':>8}{'new':>9}",
+    ]
+    for kind, before in base['latency_ms'].items():
+        after = other['latency_ms'].get(kind)
+        if after is None:
+            continue
+        lines.append(f"{kind:24} {before['p50']:8}{after['p50']:9} {change(before['p50'], after['p50'])} "
+                     f"{before['p99']:8}{after['p99']:9} {change(before['p99'], after['p99'])}")
+    if base['updates'] != other['updates']:
+        lines.append(f"Warning: different captures ({base['updates']} vs {other['updates']} updates)")
+    return "\n".join(lines)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m common.traffic")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    replay_parser = commands.add_parser('replay', help="replay a capture against the current build")
+    replay_parser.add_argument('capture')
+    replay_parser.add_argument('--bot', default='reg_bot1', help="bot module to load")
+    replay_parser.add_argument('--speed', type=float, default=1.0, help="time scale; 0 sends as fast as possible")
+    replay_parser.add_argument('--label', default='build')
+    replay_parser.add_argument('--out', help="write the result as JSON for compare")
+    replay_parser.add_argument('--telegram-latency', type=float, default=0.05)
+    replay_parser.add_argument('--stripe-latency', type=float, default=0.3)
+    replay_parser.add_argument('--smtp-latency', type=float, default=0.5)
+    replay_parser.add_argument('--handle-timeout', type=float, default=60.0,
+                               help="seconds to wait for outstanding updates after the last one is sent")
+    replay_parser.add_argument('--drain-timeout', type=float, default=60.0)
+
+    compare_parser = commands.add_parser('compare', help="compare two replay results")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('other')
+
+    args = parser.parse_args()
+    if args.command == 'replay':
+        result = replay(args)
+        print(format_result(result))
+        if args.out:
+            with open(args.out, 'w', encoding='utf-8') as f:
+                json.dump(result, f, indent=2)
+    else:
+        with open(args.base, 'r', encoding='utf-8') as f:
+            base = json.load(f)
+        with open(args.other, 'r', encoding='utf-8') as f:
+            other = json.load(f)
+        print(compare(base, other))
+
+
+if __name__ == "__main__":
+    main()
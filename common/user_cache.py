@@ -0,0 +1,151 @@
+"""Bounded in-memory cache of per-user registration state.
+
+Only recently active users are kept in memory. A user's registrations are
+loaded from ``user_data.json`` on first access and dropped again after
+``idle_ttl`` seconds of inactivity or when more than ``max_users`` users are
+cached (least recently used first), so memory stays flat no matter how many
+users have ever talked to the bot.
+
+A registration in progress exists only here, so users whose newest entry is
+partial are not evicted for size, only once idle; the conversation timeout
+must be shorter than ``idle_ttl``.
+
+Storage is read only by ``await cache.load(user_id)``, off the event loop,
+streaming just that user's entry out of the file; the dict-style accessors
+see loaded users only. Writes are per user: the file is streamed through
+under its lock and only that user's entry is merged, keeping its order;
+abandoned partial registrations (no payment session and no invoice) are not
+kept, except the newest entry, which holds the user's language choice.
+"""
+
+import time
+from collections import OrderedDict
+from typing import List
+from common.file_manager import load_user
+from common.registration import Registration
+from common.registrants import registration_key
+from common.async_storage import aupdate_user, run_io
+
+
+def is_partial(registration) -> bool:
+    """A registration the user started but never committed."""
+    return (not registration.get('session_id') and not registration.get('invoice_number')
+            and registration.get('payment_status') not in ('deferred', 'failed'))
+
+
+def compact_registrations(registrations: list) -> list:
+    """Drop partial registrations except the newest entry."""
+    return [reg for index, reg in enumerate(registrations)
+            if not is_partial(reg) or index == len(registrations) - 1]
+
+
+def merge_registrations(stored: List[dict], registrations: List[dict]) -> List[dict]:
+    """Stored entries in their order, updated from the cached ones; new ones go last.
+
+    Stored partial entries are dropped: the cache holds the user's current one.
+    """
+    stored_keys = {registration_key(reg) for reg in stored} - {None}
+    cached = {registration_key(reg): reg for reg in registrations if registration_key(reg) in stored_keys}
+    merged = []
+    for reg in stored:
+        key = registration_key(reg)
+        if key is None:
+            continue
+        # Keep fields written by others (e.g. payment_status) for the same registration
+        merged.append({**reg, **cached[key]} if key in cached else reg)
+    merged += [reg for reg in registrations if registration_key(reg) not in stored_keys]
+    return merged
+
+
+class UserStateCache:
+    """user_id -> list of Registration, with LRU/TTL eviction and lazy loading.
+
+    Supports the dict-style access the handlers use (``cache[user_id]``,
+    ``get``, ``in``) for users brought in by ``load()``.
+    """
+
+    def __init__(self, data_file: str, max_users: int = 10000, idle_ttl: float = 3600.0):
+        self.data_file = data_file
+        self.max_users = max_users
+        self.idle_ttl = idle_ttl
+        # user_id -> (last access time, registrations), least recent first
+        self._users: 'OrderedDict[str, tuple]' = OrderedDict()
+        self.loads = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def _read_user(self, user_id: str) -> List[Registration]:
+        stored = load_user(self.data_file, user_id)
+        return [Registration.from_dict(reg) for reg in compact_registrations(stored)]
+
+    def _evict(self, now: float) -> None:
+        while self._users:
+            last_access = next(iter(self._users.values()))[0]
+            if now - last_access <= self.idle_ttl:
+                break
+            self._users.popitem(last=False)
+            self.evictions += 1
+        excess = len(self._users) - self.max_users
+        if excess <= 0:
+            return
+        # Over max_users: least recently used first, skipping registrations in progress
+        evicted = []
+        for user_id, (_, registrations) in self._users.items():
+            if not (registrations and is_partial(registrations[-1])):
+                evicted.append(user_id)
+                if len(evicted) == excess:
+                    break
+        for user_id in evicted:
+            del self._users[user_id]
+        self.evictions += len(evicted)
+
+    def _put(self, user_id: str, registrations: list) -> list:
+        now = time.monotonic()
+        self._users[user_id] = (now, registrations)
+        self._users.move_to_end(user_id)
+        self._evict(now)
+        return registrations
+
+    def _lookup(self, user_id: str) -> list:
+        entry = self._users.get(user_id)
+        if entry is None:
+            # Not loaded: storage is never read on the event loop
+            return []
+        return self._put(user_id, entry[1])
+
+    async def load(self, user_id: str) -> list:
+        """Make sure a user is cached, reading storage off the event loop on a miss."""
+        entry = self._users.get(user_id)
+        if entry is not None:
+            return self._put(user_id, entry[1])
+        self.loads += 1
+        registrations = await run_io(self._read_user, user_id)
+        # Another coroutine may have loaded the user meanwhile
+        entry = self._users.get(user_id)
+        return self._put(user_id, entry[1] if entry is not None else registrations)
+
+    def __getitem__(self, user_id: str) -> list:
+        registrations = self._lookup(user_id)
+        if not registrations:
+            raise KeyError(user_id)
+        return registrations
+
+    def __contains__(self, user_id: str) -> bool:
+        return bool(self._lookup(user_id))
+
+    def get(self, user_id: str, default=None):
+        registrations = self._lookup(user_id)
+        return registrations if registrations else default
+
+    async def save(self, user_id: str) -> None:
+        """Merge a user's cached registrations into the data file."""
+        entry = self._users.get(user_id)
+        if entry is None:
+            return
+        registrations = entry[1]
+        registrations[:] = compact_registrations(registrations)
+        # Snapshot now: handlers may change the cached records while the file is written
+        snapshot = [reg.to_dict() for reg in registrations]
+        await aupdate_user(self.data_file, user_id, lambda stored: merge_registrations(stored, snapshot))
@@ -1,6 +1,7 @@
 import csv
 import json
 import os
+import sys
 import base64
 import httpx
 import logging
@@ -9,20 +10,37 @@ import yagmail
 import httpx
 import stripe
 import threading
+import uuid
 import pandas as pd
 from flask import Flask, request, jsonify
 from flask_socketio import SocketIO
 from urllib.parse import parse_qs, urlparse
 from apscheduler.schedulers.background import BackgroundScheduler
-from telegram import Update, KeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackContext
+from telegram import Update, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from telegram.error import Forbidden, TelegramError
+from telegram.ext import Application, CommandHandler, MessageHandler, InlineQueryHandler, filters, ConversationHandler, CallbackContext
 from common.pdf_invoice import generate_pdf, user_invoice_num
-from common.file_manager import get_game_info, update_game_csv, store_user_data, get_user_data, cancel_registration_fun, save_json
+from common.invoice_archive import resolve_invoice_path, apply_retention
+from common.invoice_server import InvoiceServer, links_enabled, sign_invoice_link
+from common.file_manager import get_game_info, update_game_csv, reserve_game_spots, release_game_spots, store_user_data, get_user_data, cancel_registration_fun, save_json, read_json_unlocked, find_registrations
+from common.templates import load_templates, escape_markdown, LANGUAGES
+from common.registration import Registration
+from common.user_cache import UserStateCache, is_partial
+from common.reports import record_registration, record_cancellation, record_payment, game_report, period_report, format_report, now_stamp, event_day
+from common.pipeline import Pipeline
+from common.dispatch import PerUserUpdateProcessor, Idempotency
+from common.rate_limit import AdmissionControl
+from common.registrants import add_registrant, remove_registrant, registration_key
+from common.broadcast import Broadcaster
+from common.game_search import GameSearch, build_index, deeplink_payload
+from common.host import BotHost, run as run_host
+from common.resilience import Guard
+from common.profiler import SamplingProfiler, format_summary, MAX_SECONDS
+from common.traffic import UpdateRecorder
+from common.async_storage import run_io, transaction
 from common.validation import is_valid_email, is_valid_attendee_count, is_valid_deeplink, is_valid_invoice
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
-from common.reg_handler import RegistrationHandler
-from common.stripe_handler import StripeHandler
 
 """This bot works with 
 Registration, 
@@ -47,6 +65,11 @@ Optimise performance and refactor code
 
 # Define states for the conversation
 LANGUAGE, MAIN_MENU, FULL_NAME, EMAIL, CUST_AMOUNT, CANCEL_INVOICE = range(6)
+# Idle conversations end after this; shorter than the user cache's idle_ttl,
+# which holds the registration in progress
+CONVERSATION_TIMEOUT = 1800
+# Seconds between checks for payments completed or canceled in Stripe
+PAYMENT_POLL_INTERVAL = 10
 
 # File paths
 DATA_FILE = "./store/user_data.json" #Store and retreave user_data
@@ -54,6 +77,7 @@ TRANSLATIONS_FILE = "./store/translations.json" #Translation Dictionary
 BOT_CONFIG_FILE = "./common/bot_config.json"
 PDF_SETTINGS_FILE = "./store/pdf_settings.json" #TODO adjustments to PDF not via code
 GAMES_CSV_FILE = "./store/games.csv" #Games info storage
+PIPELINE_JOBS_FILE = "./store/pipeline_jobs.json" #Unfinished background registration jobs
 DATABASE = "./common/tg_bot_db.db"
 
 # LOAD TOKEN & CRED DETAILS
@@ -65,9 +89,31 @@ EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 ADMIN_EMAIL = os.getenv("ADMIN_EMAIL")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+BOT_NAME = "reg_bot1"
+ADMIN_IDS = {admin_id.strip() for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id.strip()}
+
+# Per-user and global token buckets checked before any handler runs
+admission_control = AdmissionControl(exempt_user_ids=ADMIN_IDS)
+# Set by build_application when RECORD_UPDATES is set
+update_recorder = None
+
+async def screen_update(update: object) -> bool:
+    """Runs before an update queues for its user's turn: record it, then apply the rate limits."""
+    if update_recorder is not None:
+        await update_recorder(update, None)
+    return await admission_control.screen(update)
 # STRIP Credentials
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")  # Use your test secret key
 
+# Timeouts, circuit breakers and concurrency limits per external service.
+# A rejected card or bad request is not an outage and doesn't trip the breaker.
+SMTP_TIMEOUT = 30
+stripe_guard = Guard('stripe', timeout=10, max_concurrent=8,
+                     ignore=(stripe.error.CardError, stripe.error.InvalidRequestError))
+# Covers one message: each email is its own pipeline stage, so a retry never resends one that went out
+smtp_guard = Guard('smtp', timeout=SMTP_TIMEOUT + 15, max_concurrent=2, reset_timeout=120)
+telegram_guard = Guard('telegram', timeout=60, max_concurrent=8)
+
 # Function to connect to the SQLite database
 def db_connect():
     conn = sqlite3.connect(DATABASE)
@@ -85,8 +131,8 @@ def load_json(file_path):
 
 # Function to load user data
 def load_user_data():
-    with open(DATA_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    # Any storage codec (see common/codec.py)
+    return read_json_unlocked(DATA_FILE)
 
 def load_csv(file_path):
     if os.path.exists(file_path):
@@ -94,40 +140,28 @@ def load_csv(file_path):
             with open(file_path, newline='', encoding='utf-8') as file:
                 return list(csv.DictReader(file))
         except Exception as e:
-            print(f"Error reading CSV: {e}")
+            logging.error(f"Error reading CSV: {e}")
             return []
     return []
 
-user_data = load_json(DATA_FILE)
-translations = load_json(TRANSLATIONS_FILE)
+# Recently active users only; others are loaded from DATA_FILE on access
+user_data = UserStateCache(DATA_FILE, idle_ttl=2 * CONVERSATION_TIMEOUT)
 bot_config = load_json(BOT_CONFIG_FILE)
+templates = load_templates(TRANSLATIONS_FILE, BOT_CONFIG_FILE)
 pdf_settings = load_json(PDF_SETTINGS_FILE)
-games = load_csv(GAMES_CSV_FILE)
 
-# Function to get game information from CSV file
-def get_game_info(game_id: str):
-    try:
-        with open(GAMES_CSV_FILE, mode='r', newline='', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                if row['game_id'] == game_id:
-                    return row
-    except FileNotFoundError:
-        print("The file 'games.csv' was not found.")
-    except Exception as e:
-        print(f"An error occurred while reading the CSV file: {e}")
-    return None
+# Set by build_application: shared catalog, HTTP pool and metrics
+bot_host: BotHost = None
+
+# Function to get game information from the shared catalog
+async def get_game_info(game_id: str):
+    # Reloads games.csv only if it changed since the last read
+    await bot_host.catalog.refresh()
+    return bot_host.catalog.get(game_id)
 
 # Function to retrieve the translation
 def t(key: str, lang: str = 'en') -> str:
-    return translations.get(lang, translations['en']).get(key, key)
-
-# Helper function to escape MarkdownV2 characters
-def escape_markdown(text):
-    if text is None:
-        return ''
-    escape_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-    return ''.join(['\\' + char if char in escape_chars else char for char in text])
+    return templates.t(key, lang)
 
 # Helper function to decode and parse deeplink
 def decode_deeplink(encoded_start_data):
@@ -139,7 +173,7 @@ def decode_deeplink(encoded_start_data):
             params['game_id'] = params['game_id'][0]
         return params
     except Exception as e:
-        print(f"Error decoding start data: {e}")
+        logging.warning(f"Error decoding start data: {e}")
         return {}
 
 async def start(update: Update, context: CallbackContext) -> int:
@@ -150,32 +184,15 @@ async def start(update: Update, context: CallbackContext) -> int:
 
             game_id = params.get('game_id', '')
             if game_id:
-                game_info = get_game_info(game_id)
+                game_info = await get_game_info(game_id)
                 
                 if game_info:
                     context.chat_data['game_info'] = game_info
                     user_id = str(update.message.from_user.id)
-                    lang = user_data.get(user_id, [{}])[-1].get('lang', 'en')
-
-                    welcome_message = (
-                        f"{t('start', 'en')}\n\n"
-                        f"{t('start', 'lv')}\n\n"
-                        f"{t('start', 'ru')}\n\n"
-                    )
-
-                    select_langauge_all = (
-                        f"{t('select_language', 'en')}\n\n"
-                        f"{t('select_language', 'lv')}\n\n"
-                        f"{t('select_language', 'ru')}\n\n"
-                    )
-                    
-                    await update.message.reply_text(welcome_message)
+                    lang = (await user_data.load(user_id) or [{}])[-1].get('lang', 'en')
 
-                    language_buttons = bot_config.get('language_buttons', ["English", "Latviešu", "Русский"])
-                    buttons = [KeyboardButton(btn) for btn in language_buttons]
-                    keyboard = [buttons]
-                    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-                    await update.message.reply_text(select_langauge_all, reply_markup=reply_markup)
+                    await update.message.reply_text(templates.welcome_all)
+                    await update.message.reply_text(templates.select_language_all, reply_markup=templates.language_keyboard)
                     
                     return LANGUAGE
                 else:
@@ -200,49 +217,45 @@ async def select_language(update: Update, context: CallbackContext) -> int:
     lang_selection = update.message.text.lower()
 
     lang = get_language_code(lang_selection)
-    user_data.setdefault(user_id, []).append({'lang': lang})
+    begin_registration(await user_data.load(user_id), lang)
 
     return await main_menu(update, context)
 
+def begin_registration(registrations: list, lang: str) -> None:
+    """Start a new registration as the user's last entry.
+
+    An abandoned partial registration is replaced instead of adding one per
+    /start; a committed one is kept, so its commit token is never reused.
+    """
+    if registrations and is_partial(registrations[-1]):
+        registrations[-1] = Registration(lang=lang)
+    else:
+        registrations.append(Registration(lang=lang))
+
 async def main_menu(update: Update, context: CallbackContext) -> int:
     user_id = str(update.message.from_user.id)
-    lang = user_data[user_id][-1]['lang']
+    lang = (await user_data.load(user_id) or [{}])[-1].get('lang', 'en')
 
     game_info = context.chat_data.get('game_info', {})
 
     if game_info:
-        game_name = escape_markdown(game_info.get('game_name', ''))
-        game_place = escape_markdown(game_info.get('place', ''))
-        game_date = escape_markdown(game_info.get('date', ''))
-        game_time = escape_markdown(game_info.get('time', ''))
-        game_price = escape_markdown(game_info.get('price_per_person', ''))
-
-        await update.message.reply_text(
-            f"📢 {t('registering_for', lang)}\n"
-            f"🏆 {t('game', lang)}: {game_name}\n"
-            f"📍 {t('place', lang)}: {game_place}\n"
-            f"🕒 {t('date', lang)}: {game_date}\n"
-            f"🕒 {t('time', lang)}: {game_time}\n"
-            f"🎟️ {t('price_per_person', lang)}: €{game_price}\n"
-        )
+        await update.message.reply_text(templates.render('game_info', lang, **templates.game_fields(game_info)))
     else:
         await update.message.reply_text("Game information is missing.")
 
-    keyboard = [
-        [KeyboardButton(t("register", lang)), KeyboardButton(t("retrieve", lang))],
-        [KeyboardButton(t("change_language", lang))], [KeyboardButton(t("cancel_registration", lang))]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-    await update.message.reply_text(t("main_menu", lang), reply_markup=reply_markup)
+    await update.message.reply_text(t("main_menu", lang), reply_markup=templates.main_menu_keyboard(lang))
 
     return MAIN_MENU
 
 async def handle_main_menu(update: Update, context: CallbackContext) -> int:
     user_id = str(update.message.from_user.id)
-    lang = user_data[user_id][-1]['lang']
+    registrations = await user_data.load(user_id)
+    lang = (registrations or [{}])[-1].get('lang', 'en')
     selection = update.message.text
 
     if selection == t("register", lang):
+        # Each registration gets its own record and commit token
+        begin_registration(registrations, lang)
         await update.message.reply_text(t("ask_full_name", lang))
         return FULL_NAME
 
@@ -251,16 +264,7 @@ async def handle_main_menu(update: Update, context: CallbackContext) -> int:
         return MAIN_MENU
 
     elif selection == t("change_language", lang):
-        select_langauge_all = (
-                        f"{t('select_language', 'en')}\n\n"
-                        f"{t('select_language', 'lv')}\n\n"
-                        f"{t('select_language', 'ru')}\n\n"
-                    )
-        language_buttons = bot_config.get('language_buttons', ["English", "Latviešu", "Русский"])
-        buttons = [KeyboardButton(btn) for btn in language_buttons]
-        keyboard = [buttons]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-        await update.message.reply_text(select_langauge_all, reply_markup=reply_markup)
+        await update.message.reply_text(templates.select_language_all, reply_markup=templates.language_keyboard)
         return LANGUAGE
     
     elif selection == t("cancel_registration", lang):
@@ -271,20 +275,33 @@ async def handle_main_menu(update: Update, context: CallbackContext) -> int:
         await update.message.reply_text(t("invalid_option", lang))
         return MAIN_MENU
 
+async def registration_lost(update: Update, registrations: list) -> int:
+    """Back to the main menu when the registration in progress is gone, instead
+    of writing into a committed one."""
+    lang = registrations[-1].get('lang', 'en') if registrations else 'en'
+    await update.message.reply_text(t("main_menu", lang), reply_markup=templates.main_menu_keyboard(lang))
+    return MAIN_MENU
+
 async def get_full_name(update: Update, context: CallbackContext) -> int:
     user_id = str(update.message.from_user.id)
-    lang = user_data[user_id][-1]['lang']
+    registrations = await user_data.load(user_id)
+    if not registrations or not is_partial(registrations[-1]):
+        return await registration_lost(update, registrations)
+    lang = registrations[-1]['lang']
     full_name = update.message.text
 
     # Store user's full name
-    user_data[user_id][-1]['full_name'] = full_name
+    registrations[-1]['full_name'] = full_name
 
     await update.message.reply_text(t("ask_email", lang))
     return EMAIL
 
 async def get_email(update: Update, context: CallbackContext) -> int:
     user_id = str(update.message.from_user.id)
-    lang = user_data[user_id][-1]['lang']
+    registrations = await user_data.load(user_id)
+    if not registrations or not is_partial(registrations[-1]):
+        return await registration_lost(update, registrations)
+    lang = registrations[-1]['lang']
     email = update.message.text
 
     # Validate the email
@@ -293,14 +310,46 @@ async def get_email(update: Update, context: CallbackContext) -> int:
         return EMAIL
 
     # Store user's email
-    user_data[user_id][-1]['email'] = email
+    registrations[-1]['email'] = email
 
     await update.message.reply_text(t("ask_cust_amount", lang))
     return CUST_AMOUNT
 
+class NotEnoughSpots(Exception):
+    """The game filled up before these spots could be reserved."""
+
+def create_checkout_session(game_info: dict, total_price: float, user_id: str, commit_token: str):
+    """Stripe Checkout session for a registration (blocking; call through stripe_guard).
+
+    The commit token is the idempotency key, so a retry after a timeout gets
+    the session Stripe may already have created.
+    """
+    return stripe.checkout.Session.create(
+        payment_method_types=['card'],
+        line_items=[{
+            'price_data': {
+                'currency': 'eur',
+                'product_data': {
+                    'name': game_info.get('game_name', ''),
+                    # Optionally add additional product details here
+                },
+                'unit_amount': int(round(total_price * 100)),  # Convert to cents
+            },
+            'quantity': 1,  # Assuming one item for the purchase
+        }],
+        mode='payment',
+        metadata={'user_id': user_id},
+        success_url='https://romanmamrukov.github.io/tg-bot-reg-pdf?status=success&session_id={CHECKOUT_SESSION_ID}&user_id={USER_ID}',
+        cancel_url='https://romanmamrukov.github.io/tg-bot-reg-pdf?status=failed&session_id={CHECKOUT_SESSION_ID}&user_id={USER_ID}',
+        idempotency_key=commit_token,
+    )
+
 async def get_cust_amount(update: Update, context: CallbackContext) -> int:
     user_id = str(update.message.from_user.id)
-    lang = user_data[user_id][-1]['lang']
+    registrations = await user_data.load(user_id)
+    if not registrations or 'email' not in registrations[-1]:
+        return await registration_lost(update, registrations)
+    lang = registrations[-1]['lang']
     cust_amount = update.message.text
 
     try:
@@ -324,268 +373,534 @@ async def get_cust_amount(update: Update, context: CallbackContext) -> int:
         # Calculate total price
         price_per_person = float(game_info.get('price_per_person', 0))
         total_price = price_per_person * cust_amount
-        print(f"Total price: {total_price}")
-
-        user_data[user_id][-1]['cust_amount'] = cust_amount
-        user_data[user_id][-1]['total_price'] = total_price
-
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'eur',
-                    'product_data': {
-                        'name': game_info.get('game_name', ''),
-                        # Optionally add additional product details here
-                    },
-                    'unit_amount': int(round(total_price * 100)),  # Convert to cents
-                },
-                'quantity': 1,  # Assuming one item for the purchase
-            }],
-            mode='payment',
-            metadata={'user_id': user_id},
-            success_url='https://romanmamrukov.github.io/tg-bot-reg-pdf?status=success&session_id={CHECKOUT_SESSION_ID}&user_id={USER_ID}',
-            cancel_url='https://romanmamrukov.github.io/tg-bot-reg-pdf?status=failed&session_id={CHECKOUT_SESSION_ID}&user_id={USER_ID}',
-        )
-
-        # Store the session URL and session ID in user data
-        user_data[user_id][-1]['payment_link'] = session.url  # Use session.url for the payment link
-        user_data[user_id][-1]['session_id'] = session.id  # Store the Stripe session ID
-
-        # Generate the registration summary
-        summary = (
-            f"📢 {t('summary', lang)}\n"
-            f"🏆 {t('game', lang)}: {escape_markdown(game_info.get('game_name', ''))}\n"
-            f"📍 {t('place', lang)}: {escape_markdown(game_info.get('place', ''))}\n"
-            f"🕒 {t('date', lang)}: {escape_markdown(game_info.get('date', ''))}\n"
-            f"🕒 {t('time', lang)}: {escape_markdown(game_info.get('time', ''))}\n"
-            f"🎟️ {t('price_per_person', lang)}: €{escape_markdown(game_info.get('price_per_person', ''))}\n"
-            f"👤 {t('full_name', lang)}: {escape_markdown(user_data[user_id][-1]['full_name'])}\n"
-            f"✉️ {t('email', lang)}: {escape_markdown(user_data[user_id][-1]['email'])}\n"
-            f"🧑‍🤝‍🧑 {t('attendees', lang)}: {cust_amount}\n"
-            f"💶 {t('total_price', lang)}: €{total_price:.2f}\n"
-        )
-
-        # Send payment link with summary and PDF
-        await update.message.reply_text(
-            f"Your registration summary:\n\n{summary}\n\n"
-            f"Click this link to pay: {session.url}"
-        )
-
-        user_data[user_id][-1]['game_details'] = {
-                'game_name': game_info.get('game_name', ''),
-                'place': game_info.get('place', ''),
-                'date': game_info.get('date', ''),
-                'time': game_info.get('time', ''),
-                'price_per_person': game_info.get('price_per_person', '')
-            }
-        
-        # Generate PDF invoice
-        pdf_file_path = generate_pdf(user_data[user_id][-1], game_info, lang)
-        user_invoice = user_invoice_num()
-        user_data[user_id][-1]['invoice_number'] = user_invoice
-
-        if not os.path.exists(pdf_file_path):
-            await update.message.reply_text("Error: PDF file not found.")
-        else:
-            user_data[user_id][-1]['pdf_path'] = pdf_file_path
-        
-        if os.path.exists(pdf_file_path) and os.path.getsize(pdf_file_path) > 0:
+        logging.debug(f"Total price: {total_price}")
+
+        registration = registrations[-1]
+        registration['cust_amount'] = cust_amount
+        registration['total_price'] = total_price
+
+        # One commit per registration: a resent attendee count reuses the
+        # result, and Stripe dedupes the session on the same key
+        commit_token = registration.get('commit_token')
+        if not commit_token:
+            commit_token = uuid.uuid4().hex
+            registration['commit_token'] = commit_token
+
+        async def commit_registration():
+            # Fast path: seat reservation, payment link and reply. PDF, channel post,
+            # email and report totals run afterwards in registration_pipeline.
+            # Seats are counted under the games.csv lock from the current file, not
+            # the game_info snapshot taken at /start, so two users can't both get the last ones
+            game_id = game_info['game_id']
+            if not await run_io(reserve_game_spots, game_id, cust_amount):
+                raise NotEnoughSpots(game_id)
             try:
-                # Send PDF to the user
-                with open(pdf_file_path, 'rb') as pdf_file:
-                    await update.message.reply_document(pdf_file)
-                
-                # Send PDF to the channel
-                with open(pdf_file_path, 'rb') as pdf_file:
-                    await context.bot.send_message(chat_id=CHANNEL_ID, text=f"{t('new_registration', lang)}:\n\n" + summary)
-                    await context.bot.send_document(chat_id=CHANNEL_ID, document=pdf_file)
-
-            except Exception as e:
-                logging.error(f"Error sending PDF: {e}")
-                await update.message.reply_text(f"Error occurred while sending PDF: {e}")
-
-        # Update game CSV with new spots
-        update_game_csv(game_info['game_id'], spots_registered=int(game_info.get('spots_registered', 0)) + cust_amount)
-
-        # Save user data to user_data.json
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=4)
+                return await checkout_registration()
+            except Exception:
+                # A failed commit is retried with the same token and reserves again, so give these back
+                await run_io(release_game_spots, game_id, cust_amount)
+                raise
+            finally:
+                await bot_host.catalog.changed(game_id, 'registration')
+
+        async def checkout_registration():
+            # Stripe is down or slow (None): take the registration now and send the
+            # link from the pipeline's payment stage once Stripe answers
+            session = await stripe_guard.call_or(None, create_checkout_session, game_info, total_price, user_id, commit_token)
+            if session is None:
+                logging.warning(f"Deferring payment link for user {user_id}")
+
+            # Store the session URL and session ID in user data
+            if session is not None:
+                registration['payment_link'] = session.url  # Use session.url for the payment link
+                registration['session_id'] = session.id  # Store the Stripe session ID
+            else:
+                registration['payment_status'] = 'deferred'
+            registration['registered_at'] = now_stamp()
+            registration['game_details'] = {
+                    'game_id': game_info.get('game_id', ''),
+                    'game_name': game_info.get('game_name', ''),
+                    'place': game_info.get('place', ''),
+                    'date': game_info.get('date', ''),
+                    'time': game_info.get('time', ''),
+                    'price_per_person': game_info.get('price_per_person', '')
+                }
+
+            # Generate the registration summary
+            summary = templates.render(
+                'summary', lang, **templates.game_fields(game_info),
+                full_name=escape_markdown(registration['full_name']),
+                email=escape_markdown(registration['email']),
+                cust_amount=cust_amount, total_price=total_price
+            )
 
-        # Send registration summary email
-        send_registration_email(user_data[user_id][-1], lang)
+            # Save the registration before confirming
+            await user_data.save(user_id)
+
+            session_id = session.id if session is not None else None
+            await registration_pipeline.submit(session_id or commit_token, {
+                'user_id': user_id,
+                'session_id': session_id,
+                'commit_token': commit_token,
+                'lang': lang,
+                'summary': summary,
+                'game_info': game_info,
+                'registration': registration.to_dict(),
+            })
+            return (session.url if session is not None else None), summary
+
+        payment_link, summary = await registration_commits.once(commit_token, commit_registration)
+
+        # Send payment link with summary
+        if payment_link:
+            await update.message.reply_text(
+                f"Your registration summary:\n\n{summary}\n\n"
+                f"Click this link to pay: {payment_link}"
+            )
+        else:
+            await update.message.reply_text(
+                f"Your registration summary:\n\n{summary}\n\n{t('payment_link_deferred', lang)}"
+            )
 
-        
         await update.message.reply_text(t("registration_complete", lang))
-        keyboard = [
-            [KeyboardButton(t("register", lang)), KeyboardButton(t("retrieve", lang))],
-            [KeyboardButton(t("change_language", lang))], [KeyboardButton(t("cancel_registration", lang))]
-        ]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-
-        await update.message.reply_text(t("main_menu", lang), reply_markup=reply_markup)
+        await update.message.reply_text(t("main_menu", lang), reply_markup=templates.main_menu_keyboard(lang))
         return MAIN_MENU
 
+    except NotEnoughSpots:
+        await update.message.reply_text(t("not_enough_spots", lang))
+        return CUST_AMOUNT
+
     except Exception as e:
-        logging.error(f"Error: {e}")
+        logging.exception(f"Error: {e}")
         await update.message.reply_text(t("invalid_number", lang))
         return CUST_AMOUNT
 
-def send_registration_email(user_data: dict, lang: str):
-    """Sends a registration summary email to the user and the admin."""
-    try:
-        yag = yagmail.SMTP(EMAIL_USER, EMAIL_PASSWORD, host=EMAIL_HOST)
-        game_details = user_data.get('game_details', {})
-
-        user_summary = (
-            f"📢 {t('summary', lang)}\n"
-            f"👤 {t('full_name', lang)}: {escape_markdown(user_data[user_id][-1]['full_name'])}\n"
-            f"✉️ {t('email', lang)}: {reg.get('email', '')}\n"
-            f"🧑‍🤝‍🧑 {t('attendees', lang)}: {reg.get('cust_amount', 1)}\n"
-            f"💶 {t('total_price', lang)}: €{reg.get('total_price', 0):.2f}\n"
-            f"🏆 {t('game', lang)}: {game_details.get('game_name', '')}\n"
-            f"📍 {t('place', lang)}: {game_details.get('place', '')}\n"
-            f"🕒 {t('date', lang)}: {game_details.get('date', '')}\n"
-            f"🕒 {t('time', lang)}: {game_details.get('time', '')}\n"
-            f"📄 {t('invoice_number', lang)}: {user_data.get('invoice_number', '')}\n"
-        )
+def send_registration_email(user_data: dict, lang: str, admin: bool = False):
+    """Sends the registration summary email to the user, or with admin=True to the admin.
+
+    Errors propagate so the pipeline's email stage can retry.
+    """
+    yag = yagmail.SMTP(EMAIL_USER, EMAIL_PASSWORD, host=EMAIL_HOST, timeout=SMTP_TIMEOUT)
+    game_details = user_data.get('game_details', {})
+
+    user_summary = templates.render(
+        'email', lang, **templates.game_fields(game_details, escape=False),
+        full_name=user_data.get('full_name', ''),
+        email=user_data.get('email', ''),
+        cust_amount=user_data.get('cust_amount', 1),
+        total_price=user_data.get('total_price', 0),
+        invoice_number=user_data.get('invoice_number', '')
+    )
 
-        # Send email to user
-        yag.send(
-            to=user_data.get('email', ''),
-            subject=f"{t('registration_confirmation', lang)}",
-            contents=user_summary,
-            attachments=[user_data.get('pdf_path')] 
-        )
+    # A signed download link keeps the PDF out of the message when the invoice server is set up
+    attachments = [user_data.get('pdf_path')]
+    if links_enabled() and user_data.get('invoice_number'):
+        user_summary += f"\n{t('invoice_link', lang)}: {sign_invoice_link(user_data['invoice_number'])}\n"
+        attachments = None
 
-        # Send email to admin
+    if admin:
         yag.send(
             to=ADMIN_EMAIL,
             subject=f"{t('new_registration', lang)}",
             contents=user_summary,
-            attachments=[user_data.get('pdf_path')] 
+            attachments=attachments
+        )
+    else:
+        yag.send(
+            to=user_data.get('email', ''),
+            subject=f"{t('registration_confirmation', lang)}",
+            contents=user_summary,
+            attachments=attachments
         )
 
-        print("Registration confirmation emails sent successfully.")
-
-    except Exception as e:
-        print(f"Error sending email: {e}")
-
-# Function to process payment updates
-async def check_payment_updates():
-    while True:
-        user_data = load_json(DATA_FILE)
-        
-        # Iterate over users and check for payment updates
-        for user_id, registrations in user_data.items():
+    logging.info(f"Registration {'admin' if admin else 'confirmation'} email sent successfully.")
+
+# Registration commits already made, keyed by the registration's commit_token
+registration_commits = Idempotency()
+
+def find_registration(user_id: str, commit_token: str = None, session_id: str = None):
+    """The in-memory registration for a commit token (or, for older jobs, a Stripe session)."""
+    return next((reg for reg in user_data.get(user_id, [])
+                 if (commit_token and reg.get('commit_token') == commit_token)
+                 or (session_id and reg.get('session_id') == session_id)), None)
+
+# Background stages of a registration, submitted by get_cust_amount
+registration_pipeline = Pipeline(PIPELINE_JOBS_FILE)
+
+async def payment_link_failed(data: dict, bot) -> None:
+    """The payment stage gave up: cancel the registration, release its seats and tell the user and admins.
+
+    The later stages never ran (they depend on the payment link), so there is
+    no invoice and nothing in the report totals or registrants index to undo.
+    Runs again if the bot stops before the stage is saved as failed.
+    """
+    user_id, registration = data['user_id'], data['registration']
+    game_id = data['game_info']['game_id']
+
+    await user_data.load(user_id)
+    stored = find_registration(user_id, data['commit_token'])
+    if stored is not None and stored.get('canceled'):
+        logging.info(f"Registration {data['commit_token']} of user {user_id} is already canceled.")
+        return
+    logging.error(f"No payment link for user {user_id} after every attempt; canceling the registration.")
+    # Marked first: a crash before the release leaves the seats held rather than given back twice
+    if stored is not None:
+        stored['payment_status'] = 'failed'
+        stored['canceled'] = "canceled"
+        stored['canceled_at'] = now_stamp()
+        await user_data.save(user_id)
+    await run_io(release_game_spots, game_id, registration['cust_amount'])
+    await bot_host.catalog.changed(game_id, 'cancellation')
+
+    await telegram_guard.call(bot.send_message, chat_id=user_id, text=t('payment_link_failed', data['lang']))
+    for admin_id in ADMIN_IDS:
+        await telegram_guard.call(bot.send_message, chat_id=admin_id,
+                                  text=f"Payment link failed, registration canceled:\n\n{data['summary']}")
+
+@registration_pipeline.stage('payment', concurrency=2, max_attempts=10, backoff=30.0, on_failure=payment_link_failed)
+async def deferred_payment_stage(data: dict, bot) -> dict:
+    """Create the payment link of a registration taken while Stripe was unavailable."""
+    if data.get('session_id'):
+        return None
+    registration = data['registration']
+    session = await stripe_guard.call(create_checkout_session, data['game_info'], registration['total_price'],
+                                      data['user_id'], data['commit_token'])
+
+    await user_data.load(data['user_id'])
+    stored = find_registration(data['user_id'], data['commit_token'])
+    if stored is not None:
+        stored['payment_link'] = session.url
+        stored['session_id'] = session.id
+        stored['payment_status'] = None
+        await user_data.save(data['user_id'])
+    await telegram_guard.call(bot.send_message, chat_id=data['user_id'], text=f"Click this link to pay: {session.url}")
+    return {'session_id': session.id}
+
+# The invoice and everything sent with it wait for the payment link: when it
+# fails the registration is canceled and those stages end up blocked
+@registration_pipeline.stage('pdf', concurrency=1, depends_on=('payment',))
+async def render_invoice_stage(data: dict, bot) -> dict:
+    # The number is taken right before rendering so it matches the one
+    # generate_pdf assigns; concurrency=1 keeps two renders from sharing it
+    user_invoice = await run_io(user_invoice_num)
+    pdf_file_path = await asyncio.to_thread(generate_pdf, data['registration'], data['game_info'], data['lang'])
+
+    await user_data.load(data['user_id'])
+    registration = find_registration(data['user_id'], data.get('commit_token'), data['session_id'])
+    if registration is not None:
+        registration['invoice_number'] = user_invoice
+        registration['pdf_path'] = pdf_file_path
+        await user_data.save(data['user_id'])
+    return {'invoice_number': user_invoice, 'pdf_path': pdf_file_path}
+
+@registration_pipeline.stage('user_pdf', depends_on=('pdf',))
+async def send_user_pdf_stage(data: dict, bot) -> None:
+    with open(data['pdf_path'], 'rb') as pdf_file:
+        await telegram_guard.call(bot.send_document, chat_id=data['user_id'], document=pdf_file)
+
+@registration_pipeline.stage('channel', concurrency=2, depends_on=('pdf',))
+async def post_channel_stage(data: dict, bot) -> None:
+    with open(data['pdf_path'], 'rb') as pdf_file:
+        await telegram_guard.call(bot.send_message, chat_id=CHANNEL_ID,
+                                  text=f"{t('new_registration', data['lang'])}:\n\n" + data['summary'])
+        await telegram_guard.call(bot.send_document, chat_id=CHANNEL_ID, document=pdf_file)
+
+def email_registration(data: dict) -> dict:
+    return {**data['registration'], 'invoice_number': data['invoice_number'], 'pdf_path': data['pdf_path']}
+
+# While SMTP is down the breaker fails attempts at once; the backoff (30 s doubling,
+# ~1 h over 8 attempts) keeps the email queued until the server is back
+@registration_pipeline.stage('email', concurrency=2, max_attempts=8, backoff=30.0, depends_on=('pdf',))
+async def send_email_stage(data: dict, bot) -> None:
+    await smtp_guard.call(send_registration_email, email_registration(data), data['lang'])
+
+@registration_pipeline.stage('admin_email', concurrency=2, max_attempts=8, backoff=30.0, depends_on=('pdf',))
+async def send_admin_email_stage(data: dict, bot) -> None:
+    await smtp_guard.call(send_registration_email, email_registration(data), data['lang'], admin=True)
+
+# Counted once it has an invoice, like rebuild_from_user_data; keyed on the
+# invoice number so a retried or resumed job doesn't count it twice
+@registration_pipeline.stage('catalog', depends_on=('pdf',))
+async def sync_catalog_stage(data: dict, bot) -> None:
+    registration = data['registration']
+    await run_io(record_registration, data['game_info']['game_id'], registration['cust_amount'], registration['total_price'],
+                 event_day(registration.get('registered_at')) if registration.get('registered_at') else None,
+                 data['invoice_number'])
+    await run_io(add_registrant, data['game_info']['game_id'], data['user_id'], registration_key(registration))
+
+# Announcements to a game's attendees, resumed after a restart
+broadcaster = Broadcaster()
+
+# Signed invoice downloads, served when INVOICE_SERVER_PORT is set
+invoice_server = InvoiceServer()
+
+async def start_pipeline(application: Application) -> None:
+    await registration_pipeline.start(application.bot)
+    if invoice_server.port:
+        await invoice_server.start()
+    await broadcaster.start(application.bot)
+    # Full index build off the event loop; later catalog changes are applied incrementally
+    await run_io(game_search.load, bot_host.catalog.games)
+
+async def stop_services(application: Application) -> None:
+    await invoice_server.stop()
+
+# Inline-mode game search (@bot <name, place or date>), indexed from the shared catalog
+game_search = GameSearch()
+
+async def reindex_games(event: dict) -> None:
+    game_id = event.get('game_id')
+    if game_id:
+        # A registration or cancellation changed one game's row
+        game_search.update(game_id, bot_host.catalog.get(game_id))
+    else:
+        # games.csv changed outside the bots: rebuild off the event loop
+        game_search.replace(await run_io(build_index, bot_host.catalog.games))
+
+async def inline_game_search(update: Update, context: CallbackContext) -> None:
+    inline_query = update.inline_query
+    lang = inline_query.from_user.language_code if inline_query.from_user.language_code in LANGUAGES else 'en'
+
+    results = []
+    for game in game_search.search(inline_query.query):
+        link = f"https://t.me/{context.bot.username}?start={deeplink_payload(game['game_id'])}"
+        results.append(InlineQueryResultArticle(
+            id=game['game_id'],
+            title=f"{game['game_name']} · {game['date']} {game['time']}",
+            description=f"{game['place']} · €{game['price_per_person']} · {game.get('spots_left', '')} left",
+            input_message_content=InputTextMessageContent(
+                templates.render('game_info', lang, **templates.game_fields(game, escape=False))),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t('register', lang), url=link)]]),
+        ))
+    await inline_query.answer(results, cache_time=30)
+
+def awaits_notification(registration: dict) -> bool:
+    return registration.get('payment_status') in ('complete', 'canceled') and not registration.get('notified')
+
+# Job: process payment updates every PAYMENT_POLL_INTERVAL seconds
+async def check_payment_updates(context: CallbackContext) -> None:
+    # Streamed off the event loop; only registrations still to notify are kept
+    pending = await run_io(find_registrations, DATA_FILE, awaits_notification)
+    notified = set()
+    paid_at = now_stamp()
+
+    # Iterate over users and check for payment updates
+    for user_id, registration in pending:
+        try:
+            if registration.get('payment_status') == 'complete':
+                await send_success_message(context.bot, user_id)
+            else:
+                await send_cancel_message(context.bot, user_id)
+        except Forbidden:
+            # Blocked the bot; the payment still counts
+            pass
+        except TelegramError as e:
+            logging.warning(f"Could not notify user {user_id} about their payment, retrying later: {e}")
+            continue
+        notified.add((user_id, registration.get('invoice_number')))
+    if not notified:
+        return
+
+    # Mark as notified without overwriting changes made while messages were sent.
+    # Whether a payment counts as canceled is decided here, under the lock
+    # cancel_registration_fun also takes, so exactly one of them counts it.
+    payments = []
+    async with transaction(DATA_FILE) as current:
+        for user_id, registrations in current.items():
             for registration in registrations:
-                if registration.get('payment_status') == 'complete' and not registration.get('notified'):
-                    # Send success message
-                    await send_success_message(user_id)
-                    registration['notified'] = True  # Mark as notified
-
-                elif registration.get('payment_status') == 'canceled' and not registration.get('notified'):
-                    # Send cancel message
-                    await send_cancel_message(user_id)
-                    registration['notified'] = True  # Mark as notified
-
-        # Save the updated user_data with notification status
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(user_data, f, ensure_ascii=False, indent=4)
-
-        # Wait some time before checking again (e.g., every 10 seconds)
-        await asyncio.sleep(10)
-
-async def send_success_message(user_id):
+                if (user_id, registration.get('invoice_number')) in notified and not registration.get('notified'):
+                    registration['notified'] = True
+                    if registration.get('payment_status') == 'complete':
+                        registration.setdefault('paid_at', paid_at)
+                        payments.append((registration.get('game_details', {}).get('game_id'),
+                                         registration.get('total_price', 0), bool(registration.get('canceled'))))
+    for game_id, amount, canceled in payments:
+        await run_io(record_payment, game_id, amount, event_day(paid_at), canceled)
+
+async def send_success_message(bot, user_id):
     """Send a success message to the user via Telegram."""
-    await telegram_app.bot.send_message(chat_id=user_id, text="Your payment was successful!")
+    await bot.send_message(chat_id=user_id, text="Your payment was successful!")
 
-async def send_cancel_message(user_id):
+async def send_cancel_message(bot, user_id):
     """Send a cancel message to the user via Telegram."""
-    await telegram_app.bot.send_message(chat_id=user_id, text="Your payment was canceled.")
-
-def update_game_csv(game_id: str, spots_registered: int):
-    df = pd.read_csv(GAMES_CSV_FILE)
-    # Update the number of spots registered
-    df.loc[df['game_id'] == game_id, 'spots_registered'] = spots_registered
-    # Calculate and update the number of spots left
-    df.loc[df['game_id'] == game_id, 'spots_left'] = df['spots_all'] - df['spots_registered']
-    df.to_csv(GAMES_CSV_FILE, index=False)
+    await bot.send_message(chat_id=user_id, text="Your payment was canceled.")
 
 async def retrieve(update: Update, context: CallbackContext) -> None:
     """Retrieve previous registrations."""
-    user_data = load_json(DATA_FILE)
     user_id = str(update.message.from_user.id)
-    lang = user_data.get(user_id, [{}])[-1].get('lang', 'en')
+    previous_registrations = await run_io(get_user_data, user_id)
+    lang = (previous_registrations or [{}])[-1].get('lang', 'en')
 
-    if user_id not in user_data or not user_data[user_id]:
+    if not previous_registrations:
         await update.message.reply_text(t("no_registrations", lang))
     else:
-        previous_registrations = user_data[user_id]
         for reg in previous_registrations:
-            reg_summary = (
-                f"👤 {t('full_name', lang)}: {escape_markdown(user_data[user_id][-1]['full_name'])}\n"
-                f"✉️ {t('email', lang)}: {reg.get('email', '')}\n"
-                f"🧑‍🤝‍🧑 {t('attendees', lang)}: {reg.get('cust_amount', 1)}\n"
-                f"💶 {t('total_price', lang)}: €{reg.get('total_price', 0):.2f}\n"
-                f"🏆 {t('game', lang)}: {reg.get('game_details', {}).get('game_name', '')}\n"
-                f"📍 {t('place', lang)}: {reg.get('game_details', {}).get('place', '')}\n"
-                f"🕒 {t('date', lang)}: {reg.get('game_details', {}).get('date', '')}\n"
-                f"🕒 {t('time', lang)}: {reg.get('game_details', {}).get('time', '')}\n"
-                f"📄 {t('invoice_number', lang)}: {reg.get('invoice_number', '')}\n"
+            reg_summary = templates.render(
+                'registration', lang, **templates.game_fields(reg.get('game_details', {}), escape=False),
+                full_name=escape_markdown(reg.get('full_name', '')),
+                email=reg.get('email', ''),
+                cust_amount=reg.get('cust_amount', 1),
+                total_price=reg.get('total_price', 0),
+                invoice_number=reg.get('invoice_number', '')
             )
             
             # Only include the "Canceled" line if the registration is canceled
             if reg.get('canceled'):
-                reg_summary += f"⚠️ {t('canceled', lang)}: {t('canceled', lang)}\n"
+                reg_summary += templates.render('canceled', lang)
             await update.message.reply_text(reg_summary)
 
-            # Send PDF if available
-            pdf_path = reg.get('pdf_path')
-            if pdf_path and os.path.exists(pdf_path):
+            # Send a download link, or the PDF itself if the invoice server isn't set up
+            pdf_path = await run_io(resolve_invoice_path, reg.get('pdf_path'), reg.get('invoice_number'))
+            if pdf_path and links_enabled() and reg.get('invoice_number'):
+                await update.message.reply_text(f"{t('invoice_link', lang)}: {sign_invoice_link(reg['invoice_number'])}")
+            elif pdf_path:
                 with open(pdf_path, 'rb') as pdf_file:
                     await update.message.reply_document(pdf_file)
             else:
                 await update.message.reply_text(t("pdf_not_found", lang))
 
-    keyboard = [
-        [KeyboardButton(t("register", lang)), KeyboardButton(t("retrieve", lang))],
-        [KeyboardButton(t("change_language", lang))], [KeyboardButton(t("cancel_registration", lang))]
-        ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-    await update.message.reply_text(t("main_menu", lang), reply_markup=reply_markup)
+    await update.message.reply_text(t("main_menu", lang), reply_markup=templates.main_menu_keyboard(lang))
     return MAIN_MENU
 
 async def cancel_registration(update: Update, context: CallbackContext) -> int:
     user_id = str(update.message.from_user.id)
-    lang = user_data.get(user_id, [{}])[-1].get('lang', 'en')
+    lang = (await user_data.load(user_id) or [{}])[-1].get('lang', 'en')
 
     invoice_number = update.message.text
 
-    if is_valid_invoice(user_data, invoice_number):
-        if cancel_registration_fun(user_id, invoice_number):
+    if is_valid_invoice({user_id: user_data.get(user_id, [])}, invoice_number):
+        registration = next((reg for reg in user_data.get(user_id, []) if reg.get('invoice_number') == invoice_number), None)
+        already_canceled = registration is not None and registration.get('canceled')
+        canceled_at = now_stamp()
+        stored = await run_io(cancel_registration_fun, user_id, invoice_number, canceled_at)
+        if stored:
+            if registration is not None and not already_canceled:
+                registration['canceled'] = "canceled"
+                registration['canceled_at'] = canceled_at
+                game_id = registration.get('game_details', {}).get('game_id')
+                # Its payment is in the totals once the payment job has marked it notified
+                paid = stored.get('payment_status') == 'complete' and bool(stored.get('notified'))
+                await run_io(record_cancellation, game_id,
+                             registration.get('cust_amount', 0), registration.get('total_price', 0),
+                             event_day(canceled_at), paid)
+                await run_io(remove_registrant, game_id, user_id, registration_key(registration))
+                await bot_host.catalog.changed(game_id, 'cancellation')
             await update.message.reply_text(t("cancellation_successful", lang))
         else:
             await update.message.reply_text(t("cancellation_failed", lang))
     else:
         await update.message.reply_text(t("invalid_invoice", lang))
 
-    keyboard = [
-        [KeyboardButton(t("register", lang)), KeyboardButton(t("retrieve", lang))],
-        [KeyboardButton(t("change_language", lang))], [KeyboardButton(t("cancel_registration", lang))]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-    await update.message.reply_text(t("main_menu", lang), reply_markup=reply_markup)
+    await update.message.reply_text(t("main_menu", lang), reply_markup=templates.main_menu_keyboard(lang))
     return MAIN_MENU
 
+async def report(update: Update, context: CallbackContext) -> None:
+    """Admin only: /report <game_id> [days] - revenue, attendees and payments for a game."""
+    if str(update.message.from_user.id) not in ADMIN_IDS:
+        return
+    if not context.args:
+        await update.message.reply_text("Usage: /report <game_id> [days]")
+        return
+
+    game_id = context.args[0]
+    if len(context.args) > 1 and context.args[1].isdigit():
+        days = int(context.args[1])
+        result = await run_io(period_report, game_id, days)
+        title = f"Last {days} days"
+    else:
+        result = await run_io(game_report, game_id)
+        title = "All time"
+
+    if result:
+        await update.message.reply_text(format_report(game_id, result, title))
+    else:
+        await update.message.reply_text(f"No report data for {game_id}.")
+
+async def pipeline_status(update: Update, context: CallbackContext) -> None:
+    """Admin only: /pipeline - background registration job counts per stage."""
+    if str(update.message.from_user.id) not in ADMIN_IDS:
+        return
+    lines = [f"{stage}: " + ", ".join(f"{status} {count}" for status, count in sorted(counts.items()))
+             for stage, counts in registration_pipeline.summary().items()]
+    await update.message.reply_text("\n".join(lines) or "No pipeline jobs.")
+
+async def limits_status(update: Update, context: CallbackContext) -> None:
+    """Admin only: /limits - admitted and shed update counters."""
+    if str(update.message.from_user.id) not in ADMIN_IDS:
+        return
+    stats = admission_control.stats()
+    await update.message.reply_text("\n".join(f"{name}: {value}" for name, value in stats.items()))
+
+async def broadcast(update: Update, context: CallbackContext) -> None:
+    """Admin only: /broadcast <game_id> <text> - message everyone registered for a game."""
+    if str(update.message.from_user.id) not in ADMIN_IDS:
+        return
+    if len(context.args) < 2:
+        await update.message.reply_text("Usage: /broadcast <game_id> <text>")
+        return
+
+    game_id = context.args[0]
+    text = update.message.text.split(None, 2)[2]
+    state = await broadcaster.broadcast(game_id, text, report_chat_id=update.message.chat_id)
+    await update.message.reply_text(f"Broadcast {state['id']} started for {len(state['recipients'])} users.")
+
+async def metrics_status(update: Update, context: CallbackContext) -> None:
+    """Admin only: /metrics - counters and timings of every bot in this process."""
+    if str(update.message.from_user.id) not in ADMIN_IDS:
+        return
+    await update.message.reply_text(bot_host.metrics.format() or "No metrics yet.")
+
+# Started only by /profile; nothing is sampled otherwise
+profiler = SamplingProfiler()
+
+async def profile_command(update: Update, context: CallbackContext) -> None:
+    """Admin only: /profile [seconds] - sample every thread of the process and send the result."""
+    if str(update.message.from_user.id) not in ADMIN_IDS:
+        return
+    seconds = min(int(context.args[0]), MAX_SECONDS) if context.args and context.args[0].isdigit() else 10
+    try:
+        # Claims the profiler and starts sampling now, so a second /profile is refused
+        profiling = profiler.profile(seconds)
+    except RuntimeError as e:
+        await update.message.reply_text(str(e))
+        return
+
+    async def run_profile():
+        result = await profiling
+        await update.message.reply_text(format_summary(result))
+        with open(result['path'], 'rb') as folded:
+            await update.message.reply_document(document=folded, filename=os.path.basename(result['path']),
+                                                caption="Folded stacks for flamegraph.pl / speedscope")
+
+    # Run in the background so the admin's other updates aren't queued behind it
+    context.application.create_task(run_profile())
+    await update.message.reply_text(f"Profiling for {seconds}s...")
+
 # Set up the bot
-def main():
-    # Set up logging
-    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
-    logger = logging.getLogger(__name__)
+def build_application(host: BotHost) -> Application:
+    global bot_host, update_recorder
+    bot_host = host
+    host.catalog.subscribe(reindex_games)
+    host.metrics.add_source('admission', admission_control.stats)
+    host.metrics.add_source('pipeline', registration_pipeline.summary)
+    for guard in (stripe_guard, smtp_guard, telegram_guard):
+        host.metrics.add_source(guard.name, guard.stats)
+    host.metrics.add_source('invoice_server', invoice_server.stats)
 
     # Create the application
-    app_bot = Application.builder().token(BOT_TOKEN).build()
+    # Users are served in parallel; each user's updates run in order, double-tapped
+    # buttons / resent messages are dropped and rate limits apply before queueing
+    update_processor = PerUserUpdateProcessor(admit=screen_update)
+    host.metrics.add_source('dispatch', update_processor.stats)
+    app_bot = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(host.request())
+        .concurrent_updates(update_processor)
+        .post_init(start_pipeline)
+        .post_shutdown(stop_services)
+        .build()
+    )
 
     # Define the conversation handler
     conv_handler = ConversationHandler(
@@ -599,13 +914,50 @@ def main():
             CANCEL_INVOICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, cancel_registration)],
         },
         fallbacks=[CommandHandler("start", start), MessageHandler(filters.COMMAND, start)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
+    # Payment status is set in Stripe, outside the bot
+    if app_bot.job_queue is not None:
+        app_bot.job_queue.run_repeating(check_payment_updates, interval=PAYMENT_POLL_INTERVAL,
+                                        first=PAYMENT_POLL_INTERVAL, name='payment_updates')
+    else:
+        logging.warning('No job queue (pip install "python-telegram-bot[job-queue]"): payments are not checked')
+
+    # Opt-in anonymized capture for `python -m common.traffic replay`; screen_update
+    # records updates before rate limiting
+    record_path = os.getenv("RECORD_UPDATES")
+    if record_path:
+        try:
+            update_recorder = UpdateRecorder(record_path, keep_texts=templates.button_labels(),
+                                             known_term=game_search.matches)
+        except FileExistsError:
+            logging.error(f"Not recording updates: {record_path} already exists, pick a new file")
+        else:
+            host.metrics.add_source('recorder', update_recorder.stats)
+
+    # Admin commands go first so the conversation fallbacks don't swallow them
+    app_bot.add_handler(CommandHandler('report', report))
+    app_bot.add_handler(CommandHandler('pipeline', pipeline_status))
+    app_bot.add_handler(CommandHandler('limits', limits_status))
+    app_bot.add_handler(CommandHandler('broadcast', broadcast))
+    app_bot.add_handler(CommandHandler('metrics', metrics_status))
+    app_bot.add_handler(CommandHandler('profile', profile_command))
+    app_bot.add_handler(InlineQueryHandler(inline_game_search))
+
     # Add the conversation handler to the application
     app_bot.add_handler(conv_handler)
-    
-    # Run the bot
-    app_bot.run_polling()
+
+    # Compress cold invoices and apply the retention policy once a day
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(apply_retention, 'interval', days=1)
+    scheduler.start()
+
+    return app_bot
+
+def main():
+    # Run this bot on its own; `python -m common.host reg_bot1 anno_bot1` runs both in one process
+    run_host(sys.modules[__name__])
 
 if __name__ == "__main__":
     main()
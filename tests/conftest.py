@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Tests import the bot's packages (common.*) from the repository root
+sys.path.insert(0, REPO_ROOT)
+
+# Third-party packages the bot modules import at load time
+BOT_DEPENDENCIES = ('telegram', 'stripe', 'yagmail', 'pandas', 'flask', 'flask_socketio', 'apscheduler',
+                    'dotenv', 'reportlab', 'inflect', 'portalocker')
+
+
+@pytest.fixture
+def bot_dependencies():
+    """Skip unless the bot modules can be imported here."""
+    for module in BOT_DEPENDENCIES:
+        pytest.importorskip(module)
@@ -0,0 +1,135 @@
+"""Broadcast fan-out, flood control, checkpointing and resume after a restart."""
+
+import asyncio
+import json
+import os
+import time
+
+from telegram.error import Forbidden, RetryAfter
+
+import common.broadcast as broadcast_module
+from common.broadcast import Broadcaster
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class FakeBot:
+    """Records sends; ``errors`` maps a chat id to exceptions raised on its next sends."""
+
+    def __init__(self, errors=None, on_send=None):
+        self.sent = []
+        self.errors = {chat_id: list(queue) for chat_id, queue in (errors or {}).items()}
+        self.on_send = on_send
+
+    async def send_message(self, chat_id, text):
+        if self.on_send:
+            self.on_send(chat_id)
+        queue = self.errors.get(chat_id)
+        if queue:
+            raise queue.pop(0)
+        self.sent.append((chat_id, text))
+
+
+async def finish(broadcaster):
+    await asyncio.gather(*list(broadcaster._tasks))
+
+
+def recipients(monkeypatch, user_ids):
+    monkeypatch.setattr(broadcast_module, 'game_registrants', lambda game_id: list(user_ids))
+
+
+def test_fan_out_reaches_everyone_and_records_blocked_users(tmp_path, monkeypatch):
+    users = [str(n) for n in range(20)]
+    recipients(monkeypatch, users)
+    bot = FakeBot(errors={'7': [Forbidden("bot was blocked by the user")]})
+
+    async def scenario():
+        broadcaster = Broadcaster(str(tmp_path), rate=1000, concurrency=5)
+        await broadcaster.start(bot)
+        state = await broadcaster.broadcast('OP1', "Venue changed", report_chat_id='admin')
+        await finish(broadcaster)
+        return broadcaster, state
+
+    broadcaster, state = run(scenario())
+    stats = broadcaster.stats(state)
+    assert state['status'] == 'done'
+    assert sorted(state['sent'], key=int) == [user for user in users if user != '7']
+    assert state['failed'] == {'7': 'blocked'}
+    assert stats['sent'] == 19 and stats['blocked'] == 1 and stats['pending'] == 0
+    # The report goes to the admin chat last
+    assert bot.sent[-1][0] == 'admin'
+    assert os.listdir(tmp_path) == []
+
+
+def test_retry_after_pauses_and_then_delivers(tmp_path, monkeypatch):
+    recipients(monkeypatch, ['1', '2'])
+    bot = FakeBot(errors={'1': [RetryAfter(1)]})
+
+    async def scenario():
+        broadcaster = Broadcaster(str(tmp_path), rate=1000, concurrency=1)
+        await broadcaster.start(bot)
+        started = time.monotonic()
+        state = await broadcaster.broadcast('OP1', "hi")
+        await finish(broadcaster)
+        return state, time.monotonic() - started
+
+    state, elapsed = run(scenario())
+    assert sorted(state['sent']) == ['1', '2']
+    assert state['failed'] == {}
+    assert elapsed >= 0.9
+
+
+def test_progress_is_checkpointed_while_sending(tmp_path, monkeypatch):
+    users = [str(n) for n in range(6)]
+    recipients(monkeypatch, users)
+    seen = []
+
+    def peek(chat_id):
+        # What a restart right now would find on disk
+        for filename in os.listdir(tmp_path):
+            if filename.endswith('.json'):
+                with open(tmp_path / filename, encoding='utf-8') as f:
+                    seen.append(len(json.load(f)['sent']))
+
+    bot = FakeBot(on_send=peek)
+
+    async def scenario():
+        broadcaster = Broadcaster(str(tmp_path), rate=1000, concurrency=1, checkpoint_every=2)
+        await broadcaster.start(bot)
+        await broadcaster.broadcast('OP1', "hi")
+        await finish(broadcaster)
+
+    run(scenario())
+    assert seen[0] == 0
+    assert max(seen) >= 4
+
+
+def test_restart_resumes_with_pending_recipients_only(tmp_path, monkeypatch):
+    recipients(monkeypatch, [])
+    running = {
+        'id': 'OP1_20250101120000_abcdef', 'game_id': 'OP1', 'text': "hi", 'report_chat_id': None,
+        'recipients': ['1', '2', '3', '4'], 'sent': ['1'], 'failed': {'2': 'blocked'},
+        'status': 'running', 'started': '2025-01-01T12:00:00', 'elapsed': 3.0,
+    }
+    finished = dict(running, id='OP2_20250101110000_123456', game_id='OP2', status='done')
+    for state in (running, finished):
+        with open(tmp_path / f"{state['id']}.json", 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+    bot = FakeBot()
+
+    async def scenario():
+        broadcaster = Broadcaster(str(tmp_path), rate=1000)
+        await broadcaster.start(bot)
+        await finish(broadcaster)
+        return broadcaster.broadcasts
+
+    broadcasts = run(scenario())
+    assert sorted(chat_id for chat_id, _ in bot.sent) == ['3', '4']
+    state = broadcasts[running['id']]
+    assert state['status'] == 'done'
+    assert sorted(state['sent']) == ['1', '3', '4']
+    assert state['failed'] == {'2': 'blocked'}
+    assert 'OP2_20250101110000_123456' not in broadcasts
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.json')] == []
@@ -0,0 +1,83 @@
+"""Streamed reads of the registration store match full loads at any chunk size."""
+
+import json
+import shutil
+
+import pytest
+
+from common import codec
+from conftest import REPO_ROOT
+
+CHUNK_SIZES = (1, 2, 3, 5, 7, 16, 64, 1 << 20)
+# Codecs that can be tested here
+NAMES = [name for name in codec.CODECS if name not in codec._DEPENDENCIES or codec._DEPENDENCIES[name]() is not None]
+
+TRICKY = {
+    '42': [{'full_name': 'Jānis Bērziņš', 'place': 'Rīga «Центр» 東京 😀',
+            'note': 'tab\there, "quoted", back\\slash, new\nline,  , \u0000',
+            'total_price': 30.0, 'cust_amount': 2, 'canceled': False, 'pdf_path': None}],
+    'пользователь': [],
+    # Top-level numbers and literals, cut at '.', 'e' or a sign at small chunk sizes
+    'count': 12345,
+    'price': -0.25,
+    'ratio': 1.5e-07,
+    'big': 6.02E+23,
+    'flag': True,
+    'nothing': None,
+    'last': 10,
+}
+
+
+def write(tmp_path, name, data):
+    path = tmp_path / f"user_data.{name}"
+    with open(path, 'wb') as f:
+        codec.CODECS[name].dump(data, f)
+    return path
+
+
+def streamed(path, chunk_size, monkeypatch):
+    monkeypatch.setattr(codec, 'CHUNK_SIZE', chunk_size)
+    return list(codec.iter_users(str(path)))
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_real_store_streams_at_any_chunk_size(tmp_path, monkeypatch, chunk_size):
+    path = tmp_path / 'user_data.json'
+    shutil.copy(f"{REPO_ROOT}/store/user_data.json", path)
+    with open(path, encoding='utf-8') as f:
+        expected = json.load(f)
+    assert streamed(path, chunk_size, monkeypatch) == list(expected.items())
+
+
+@pytest.mark.parametrize('name', NAMES)
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_round_trip_with_escapes_non_ascii_and_numbers(tmp_path, monkeypatch, name, chunk_size):
+    path = write(tmp_path, name, TRICKY)
+    assert codec.load_file(str(path)) == TRICKY
+    assert streamed(path, chunk_size, monkeypatch) == list(TRICKY.items())
+
+
+@pytest.mark.parametrize('name', NAMES)
+def test_dump_items_round_trip(tmp_path, monkeypatch, name):
+    path = tmp_path / f"user_data.{name}"
+    with open(path, 'wb') as f:
+        codec.CODECS[name].dump_items(iter(TRICKY.items()), f)
+    for chunk_size in CHUNK_SIZES:
+        assert streamed(path, chunk_size, monkeypatch) == list(TRICKY.items())
+
+
+def test_numbers_cut_at_a_chunk_boundary(tmp_path, monkeypatch):
+    path = tmp_path / 'user_data.json'
+    path.write_text('{"a":12.5,"b":1e3,"c":-7,"d":2.5E-2}', encoding='utf-8')
+    # Every split point of the file at least once
+    for chunk_size in range(1, 40):
+        assert streamed(path, chunk_size, monkeypatch) == [('a', 12.5), ('b', 1000.0), ('c', -7), ('d', 0.025)]
+
+
+def test_codec_needs_every_method():
+    class Partial(codec.Codec):
+        def dumps(self, data):
+            return b''
+
+    with pytest.raises(TypeError):
+        Partial()
@@ -0,0 +1,141 @@
+"""PerUserUpdateProcessor: per-user order, queue caps and admission before queueing."""
+
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip('telegram')
+from telegram import Update  # noqa: E402
+
+from common.dispatch import PerUserUpdateProcessor  # noqa: E402
+from common.rate_limit import AdmissionControl  # noqa: E402
+
+
+def message(update_id: int, user_id: int, text: str) -> Update:
+    return Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': "User"}}}, None)
+
+
+def inline_query(update_id: int, user_id: int, query: str) -> Update:
+    return Update.de_json({'update_id': update_id, 'inline_query': {
+        'id': str(update_id), 'query': query, 'offset': '',
+        'from': {'id': user_id, 'is_bot': False, 'first_name': "User"}}}, None)
+
+
+def test_one_users_burst_does_not_block_other_users():
+    async def scenario():
+        processor = PerUserUpdateProcessor(max_concurrent_updates=2, max_queued_per_user=3)
+        handled = []
+
+        async def handle(update, delay):
+            await asyncio.sleep(delay)
+            handled.append((update.update_id, time.monotonic()))
+
+        started = time.monotonic()
+        burst = [message(n, 1, f"spam {n}") for n in range(1, 21)]
+        tasks = [asyncio.create_task(processor.process_update(update, handle(update, 0.05))) for update in burst]
+        await asyncio.sleep(0)
+        other = message(100, 2, "hello")
+        tasks.append(asyncio.create_task(processor.process_update(other, handle(other, 0.0))))
+        await asyncio.gather(*tasks)
+        return processor, handled, started
+
+    processor, handled, started = asyncio.run(scenario())
+    finished = dict(handled)
+    # The other user didn't wait for the burst
+    assert finished[100] - started < 0.05
+    # One running plus three queued; the rest of the burst was dropped, in order
+    burst_ids = [update_id for update_id, _ in handled if update_id != 100]
+    assert burst_ids == [1, 2, 3, 4]
+    assert processor.queue_full == 16
+    assert processor.dropped == 16
+
+
+def test_rejected_updates_never_queue():
+    async def scenario():
+        admitted = []
+
+        async def admit(update):
+            admitted.append(update.update_id)
+            return update.update_id % 2 == 0
+
+        processor = PerUserUpdateProcessor(max_concurrent_updates=4, admit=admit)
+        gate = asyncio.Event()
+        handled = []
+
+        async def handle(update):
+            await gate.wait()
+            handled.append(update.update_id)
+
+        updates = [message(n, 1, f"text {n}") for n in range(1, 7)]
+        tasks = [asyncio.create_task(processor.process_update(update, handle(update))) for update in updates]
+        await asyncio.sleep(0.01)
+        # Every update was screened while the first admitted one still holds the user's turn
+        screened = list(admitted)
+        gate.set()
+        await asyncio.gather(*tasks)
+        return processor, screened, handled
+
+    processor, screened, handled = asyncio.run(scenario())
+    assert screened == [1, 2, 3, 4, 5, 6]
+    assert handled == [2, 4, 6]
+    assert processor.rejected == 3
+
+
+def test_duplicates_are_dropped_before_admission():
+    async def scenario():
+        admitted = []
+
+        async def admit(update):
+            admitted.append(update.update_id)
+            return True
+
+        processor = PerUserUpdateProcessor(admit=admit)
+        handled = []
+
+        async def handle(update):
+            handled.append(update.update_id)
+
+        first, repeat = message(1, 1, "English"), message(2, 1, "English")
+        for update in (first, repeat, first):
+            await processor.process_update(update, handle(update))
+        return processor, admitted, handled
+
+    processor, admitted, handled = asyncio.run(scenario())
+    assert handled == [1] and admitted == [1]
+    assert processor.duplicates_dropped == 2
+
+
+def test_inline_queries_do_not_crowd_out_the_conversation():
+    async def scenario():
+        control = AdmissionControl(user_burst=3, inline_burst=100)
+        processor = PerUserUpdateProcessor(max_queued_per_user=2, admit=control.screen)
+        gate = asyncio.Event()
+        handled = []
+
+        async def handle(update):
+            if update.message:
+                await gate.wait()
+            handled.append(update.update_id)
+
+        # A registration step is running while the user types a search
+        step = asyncio.create_task(processor.process_update(message(1, 1, "2"), handle(message(1, 1, "2"))))
+        await asyncio.sleep(0.01)
+        searches = [inline_query(n, 1, "game"[:n % 4 + 1]) for n in range(10, 30)]
+        for update in searches:
+            await processor.process_update(update, handle(update))
+        # The search neither waited for the step nor used up its queue or tokens
+        assert handled == [update.update_id for update in searches]
+        gate.set()
+        await step
+        following = message(2, 1, "ana@example.com")
+        await processor.process_update(following, handle(following))
+        return processor, control, handled
+
+    processor, control, handled = asyncio.run(scenario())
+    assert handled[-2:] == [1, 2]
+    assert processor.dropped == 0
+    assert control.shed['user'] == 0 and control.shed['inline'] == 0
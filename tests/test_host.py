@@ -0,0 +1,51 @@
+"""Smoke test: both bots load through one BotHost, start and stop."""
+
+import asyncio
+import importlib
+import os
+import shutil
+
+from conftest import REPO_ROOT
+
+
+def test_host_starts_and_stops_both_bots(tmp_path, monkeypatch, bot_dependencies):
+    from common.host import BotHost
+    from common.traffic import StubRequest
+
+    # Bots read and write ./store; give them a copy
+    shutil.copytree(os.path.join(REPO_ROOT, 'store'), tmp_path / 'store',
+                    ignore=shutil.ignore_patterns('traffic', 'profiles', 'broadcasts', '*.lock'))
+    os.makedirs(tmp_path / 'common')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('BOT_TOKEN', "123456:smoke")
+    monkeypatch.setenv('BOT_TOKEN_ANNO', "654321:smoke")
+    monkeypatch.delenv('RECORD_UPDATES', raising=False)
+
+    reg_bot = importlib.import_module('reg_bot1')
+    anno_bot = importlib.import_module('anno_bot1')
+    # Either may have been imported by an earlier test without the tokens
+    monkeypatch.setattr(reg_bot, 'BOT_TOKEN', "123456:smoke")
+    monkeypatch.setattr(anno_bot, 'telegram_bot_token', "654321:smoke")
+
+    async def scenario():
+        host = BotHost()
+        stub = StubRequest(latency=0.0)
+        monkeypatch.setattr(host, 'request', lambda: stub)
+        for module in (reg_bot, anno_bot):
+            # No polling: the stub has no updates to hand out
+            host.add(module.BOT_NAME, module.build_application(host), polling=False)
+        runner = asyncio.create_task(host.run())
+        for _ in range(200):
+            if all(application.running for _, application, _ in host.applications):
+                break
+            await asyncio.sleep(0.05)
+        running = [name for name, application, _ in host.applications if application.running]
+        host.stop()
+        await asyncio.wait_for(runner, 10)
+        return host, stub, running
+
+    host, stub, running = asyncio.run(scenario())
+    assert running == ['reg_bot1', 'anno_bot1']
+    assert stub.calls.get('getMe') == 2
+    assert not any(application.running for _, application, _ in host.applications)
+    assert host.http.is_closed
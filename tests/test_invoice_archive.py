@@ -0,0 +1,50 @@
+"""Invoice archive: deduplicated blobs and retention."""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from common import invoice_archive
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    directory = tmp_path / 'invoice_store'
+    monkeypatch.setattr(invoice_archive, 'ARCHIVE_DIR', str(directory))
+    monkeypatch.setattr(invoice_archive, 'MANIFEST_FILE', str(directory / 'manifest.json'))
+    monkeypatch.setattr(invoice_archive, 'CACHE_DIR', str(directory / 'cache'))
+    monkeypatch.setattr(invoice_archive, 'PDF_SETTINGS_FILE', str(tmp_path / 'pdf_settings.json'))
+    monkeypatch.setattr(invoice_archive, '_manifest_cache', (None, None))
+    return tmp_path
+
+
+def rendered(directory, name, content=b'%PDF-1.4 same invoice'):
+    path = directory / name
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_deduplicated_invoice_keeps_its_blob_from_expiring(archive):
+    old = datetime.now() - timedelta(days=400)
+    invoice_archive.store_invoice('OG_010124_1', rendered(archive, 'a.pdf'))
+    with invoice_archive.file_lock(invoice_archive.MANIFEST_FILE):
+        manifest = invoice_archive.read_json_unlocked(invoice_archive.MANIFEST_FILE)
+        for blob in manifest['blobs'].values():
+            blob['stored_at'] = old.isoformat()
+        invoice_archive.write_json_unlocked(invoice_archive.MANIFEST_FILE, manifest)
+
+    # A new invoice with the same content points at the old blob
+    path = invoice_archive.store_invoice('OG_191026_1', rendered(archive, 'b.pdf'))
+    stats = invoice_archive.apply_retention()
+
+    assert stats == {'compressed': 0, 'offloaded': 0, 'deleted': 0}
+    assert invoice_archive.get_invoice_path('OG_191026_1') == path
+    assert invoice_archive.get_invoice_path('OG_010124_1') == path
+
+
+def test_unreferenced_old_blob_expires(archive):
+    invoice_archive.store_invoice('OG_010124_1', rendered(archive, 'a.pdf'))
+    stats = invoice_archive.apply_retention(datetime.now() + timedelta(days=400))
+
+    assert stats['deleted'] == 1
+    assert invoice_archive.get_invoice_path('OG_010124_1') is None
@@ -0,0 +1,73 @@
+"""Stage dependencies, retries and failure handling of the background pipeline."""
+
+import asyncio
+import json
+
+from common.pipeline import Pipeline, BLOCKED, DONE, FAILED, RUNNING
+
+
+def build(jobs_file, calls):
+    pipeline = Pipeline(str(jobs_file))
+
+    async def undo(data, bot):
+        calls.append('undo')
+
+    @pipeline.stage('payment', max_attempts=2, backoff=0.0, on_failure=undo)
+    async def payment(data, bot):
+        calls.append('payment')
+        raise RuntimeError("Stripe is down")
+
+    @pipeline.stage('pdf', depends_on=('payment',))
+    async def pdf(data, bot):
+        calls.append('pdf')
+
+    @pipeline.stage('notes')
+    async def notes(data, bot):
+        calls.append('notes')
+
+    return pipeline
+
+
+async def finish(pipeline):
+    await asyncio.gather(*list(pipeline._tasks))
+
+
+def test_failed_stage_blocks_its_dependents(tmp_path):
+    calls = []
+
+    async def scenario():
+        pipeline = build(tmp_path / 'jobs.json', calls)
+        await pipeline.start(None)
+        await pipeline.submit('job', {})
+        await finish(pipeline)
+        return pipeline.status('job')
+
+    status = asyncio.run(scenario())
+    assert status == {'payment': FAILED, 'pdf': BLOCKED, 'notes': DONE}
+    assert calls.count('payment') == 2 and calls.count('undo') == 1
+    assert 'pdf' not in calls
+
+
+def test_failure_handler_reruns_when_the_failure_was_not_saved(tmp_path):
+    # The bot stopped after the last attempt, before the stage was saved as failed
+    jobs_file = tmp_path / 'jobs.json'
+    jobs_file.write_text(json.dumps({'job': {
+        'data': {}, 'created': '2025-01-01T12:00:00',
+        'stages': {
+            'payment': {'status': RUNNING, 'attempts': 2, 'error': "Stripe is down"},
+            'pdf': {'status': 'pending', 'attempts': 0, 'error': None},
+            'notes': {'status': DONE, 'attempts': 1, 'error': None},
+        },
+    }}), encoding='utf-8')
+    calls = []
+
+    async def scenario():
+        pipeline = build(jobs_file, calls)
+        await pipeline.start(None)
+        await finish(pipeline)
+        return pipeline.status('job')
+
+    status = asyncio.run(scenario())
+    assert calls == ['undo']
+    assert status['payment'] == FAILED and status['pdf'] == BLOCKED
+    assert json.loads(jobs_file.read_text(encoding='utf-8')) == {}
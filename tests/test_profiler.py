@@ -0,0 +1,33 @@
+"""Sampling profiler: the claim on the profiler and slow-callback attribution."""
+
+import asyncio
+
+import pytest
+
+from common.profiler import SamplingProfiler, _running_callback
+
+
+def test_running_callback_with_and_without_qualified_names():
+    inner = "handle (reg_bot1.py:40)"
+    for run in ("Handle._run (asyncio/events.py:78)", "_run (asyncio/events.py:78)"):
+        assert _running_callback(["MainThread", "run_forever (asyncio/base_events.py:600)", run, inner]) == inner
+    # Some other _run is not the event loop's
+    assert _running_callback(["MainThread", "_run (app/jobs.py:10)", inner]) is None
+
+
+def test_claim_is_released_however_the_profile_ends(tmp_path):
+    async def scenario():
+        profiler = SamplingProfiler(profile_dir=str(tmp_path))
+        first = profiler.profile(0.05)
+        with pytest.raises(RuntimeError):
+            profiler.profile(0.05)
+        result = await first
+        assert not profiler.running and result['samples'] > 0
+
+        # Canceled before it ever ran
+        profiler.profile(5).cancel()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert not profiler.running
+
+    asyncio.run(scenario())
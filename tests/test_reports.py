@@ -0,0 +1,105 @@
+"""Report totals: paid, unpaid and canceled registrations, live and rebuilt."""
+
+import asyncio
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from common import reports
+
+
+@pytest.fixture
+def totals_file(tmp_path, monkeypatch):
+    path = tmp_path / "report_totals.json"
+    monkeypatch.setattr(reports, 'REPORTS_FILE', str(path))
+    monkeypatch.setattr(reports, '_totals_cache', (None, None))
+    return path
+
+
+def registration(invoice, amount, price, **fields):
+    return {'invoice_number': invoice, 'cust_amount': amount, 'total_price': price,
+            'game_details': {'game_id': 'OP1'}, 'registered_at': '2025-03-01T10:00:00', **fields}
+
+
+def test_paid_then_canceled_is_subtracted_once(totals_file):
+    reports.record_registration('OP1', 2, 30.0, '2025-03-01')
+    reports.record_registration('OP1', 1, 15.0, '2025-03-01')
+    reports.record_payment('OP1', 30.0, '2025-03-02')
+    reports.record_cancellation('OP1', 2, 30.0, '2025-03-03', paid=True)
+
+    report = reports.game_report('OP1')
+    assert report['net_revenue'] == 15.0
+    # The one registration left is unpaid
+    assert report['unpaid'] == 1
+    assert report['unpaid_revenue'] == 15.0
+    assert report['payments'] == 1 and report['canceled_payments'] == 1
+
+
+def test_payment_recorded_after_cancellation(totals_file):
+    reports.record_registration('OP1', 1, 15.0, '2025-03-01')
+    reports.record_cancellation('OP1', 1, 15.0, '2025-03-02')
+    reports.record_payment('OP1', 15.0, '2025-03-03', canceled=True)
+
+    report = reports.game_report('OP1')
+    assert report['unpaid'] == 0
+    assert report['unpaid_revenue'] == 0.0
+
+
+def test_registration_is_counted_once_per_invoice(totals_file):
+    reports.record_registration('OP1', 2, 30.0, '2025-03-01', 'A')
+    # A retried or resumed pipeline job records it again
+    reports.record_registration('OP1', 2, 30.0, '2025-03-01', 'A')
+    reports.record_registration('OP1', 1, 15.0, '2025-03-01', 'B')
+
+    report = reports.game_report('OP1')
+    assert report['registrations'] == 2 and report['revenue'] == 45.0
+
+
+def test_rebuild_matches_live_totals(totals_file):
+    stored = {'1': [
+        registration('A', 2, 30.0, payment_status='complete', paid_at='2025-03-02T09:00:00',
+                     canceled='canceled', canceled_at='2025-03-03T09:00:00'),
+        registration('B', 1, 15.0),
+        registration('C', 1, 15.0, payment_status='complete', paid_at='2025-03-02T12:00:00'),
+    ]}
+    reports.record_registration('OP1', 2, 30.0, '2025-03-01', 'A')
+    reports.record_registration('OP1', 1, 15.0, '2025-03-01', 'B')
+    reports.record_registration('OP1', 1, 15.0, '2025-03-01', 'C')
+    reports.record_payment('OP1', 30.0, '2025-03-02')
+    reports.record_payment('OP1', 15.0, '2025-03-02')
+    reports.record_cancellation('OP1', 2, 30.0, '2025-03-03', paid=True)
+    live = json.loads(totals_file.read_text(encoding='utf-8'))
+
+    assert reports.rebuild_from_user_data(stored) == live
+    report = reports.game_report('OP1')
+    assert (report['unpaid'], report['unpaid_revenue']) == (1, 15.0)
+
+
+def test_payment_job_records_payments_once(tmp_path, totals_file, monkeypatch, bot_dependencies):
+    import reg_bot1
+
+    data_file = tmp_path / "user_data.json"
+    data_file.write_text(json.dumps({'42': [
+        registration('A', 2, 30.0, payment_status='complete'),
+        registration('B', 1, 15.0, payment_status='complete', canceled='canceled'),
+        registration('C', 1, 15.0),
+    ]}), encoding='utf-8')
+    monkeypatch.setattr(reg_bot1, 'DATA_FILE', str(data_file))
+    sent = []
+
+    class Bot:
+        async def send_message(self, chat_id, text):
+            sent.append((chat_id, text))
+
+    context = SimpleNamespace(bot=Bot())
+    asyncio.run(reg_bot1.check_payment_updates(context))
+    asyncio.run(reg_bot1.check_payment_updates(context))
+
+    assert sent == [('42', "Your payment was successful!")] * 2
+    report = reports.game_report('OP1')
+    assert report['payments'] == 2 and report['paid_revenue'] == 45.0
+    assert report['canceled_payments'] == 1
+    stored = json.loads(data_file.read_text(encoding='utf-8'))['42']
+    assert [reg.get('notified') for reg in stored] == [True, True, None]
+    assert all(reg.get('paid_at') for reg in stored[:2])
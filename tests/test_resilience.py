@@ -0,0 +1,299 @@
+"""Fault injection against Guard: timeouts, the circuit breaker, the bulkhead,
+ignored errors and the deferred-payment fallback."""
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from common.resilience import (
+    CLOSED, HALF_OPEN, OPEN, BulkheadFull, CircuitOpen, DependencyTimeout, Guard,
+)
+
+
+class CardError(Exception):
+    """Stands in for stripe.error.CardError: the caller's fault, not an outage."""
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def failing():
+    raise ConnectionError("injected failure")
+
+
+async def ok():
+    return 'ok'
+
+
+def test_slow_call_times_out_and_counts_as_failure():
+    async def scenario():
+        guard = Guard('dep', timeout=0.05, failure_threshold=5)
+
+        async def hang():
+            await asyncio.sleep(5)
+
+        started = time.monotonic()
+        with pytest.raises(DependencyTimeout):
+            await guard.call(hang)
+        assert time.monotonic() - started < 1
+        assert guard.counts['timeouts'] == 1
+        assert guard.breaker.failures == 1
+
+    run(scenario())
+
+
+def test_blocking_call_keeps_its_slot_until_the_thread_returns():
+    async def scenario():
+        guard = Guard('dep', timeout=0.05, max_concurrent=1, queue_timeout=0.01)
+        with pytest.raises(DependencyTimeout):
+            await guard.call(time.sleep, 0.3)
+        assert guard.stats()['in_flight'] == 1
+        with pytest.raises(BulkheadFull):
+            await guard.call(ok)
+        await asyncio.sleep(0.4)
+        assert guard.stats()['in_flight'] == 0
+        assert await guard.call(ok) == 'ok'
+
+    run(scenario())
+
+
+def test_breaker_opens_after_threshold_and_fails_fast():
+    async def scenario():
+        guard = Guard('dep', timeout=1, failure_threshold=2, reset_timeout=60)
+        calls = []
+
+        async def dependency():
+            calls.append(1)
+            raise ConnectionError("down")
+
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                await guard.call(dependency)
+        assert guard.breaker.state == OPEN
+        with pytest.raises(CircuitOpen):
+            await guard.call(dependency)
+        assert len(calls) == 2
+        assert guard.counts['rejected_open'] == 1
+
+    run(scenario())
+
+
+def test_half_open_allows_one_trial_and_closes_on_success():
+    async def scenario():
+        guard = Guard('dep', timeout=1, failure_threshold=1, reset_timeout=0.05)
+        with pytest.raises(ConnectionError):
+            await guard.call(failing)
+        assert guard.breaker.state == OPEN
+        await asyncio.sleep(0.06)
+
+        release = asyncio.Event()
+
+        async def trial():
+            await release.wait()
+            return 'recovered'
+
+        first = asyncio.ensure_future(guard.call(trial))
+        await asyncio.sleep(0)
+        assert guard.breaker.state == HALF_OPEN
+        # Only one trial at a time while half open
+        with pytest.raises(CircuitOpen):
+            await guard.call(ok)
+        release.set()
+        assert await first == 'recovered'
+        assert guard.breaker.state == CLOSED
+        assert await guard.call(ok) == 'ok'
+
+    run(scenario())
+
+
+def test_failed_trial_reopens_the_circuit():
+    async def scenario():
+        guard = Guard('dep', timeout=1, failure_threshold=3, reset_timeout=0.05)
+        for _ in range(3):
+            with pytest.raises(ConnectionError):
+                await guard.call(failing)
+        await asyncio.sleep(0.06)
+        with pytest.raises(ConnectionError):
+            await guard.call(failing)
+        assert guard.breaker.state == OPEN
+        with pytest.raises(CircuitOpen):
+            await guard.call(ok)
+
+    run(scenario())
+
+
+def test_bulkhead_rejects_callers_beyond_max_concurrent():
+    async def scenario():
+        guard = Guard('dep', timeout=5, max_concurrent=2, queue_timeout=0.05)
+        release = asyncio.Event()
+
+        async def busy():
+            await release.wait()
+            return 'done'
+
+        running = [asyncio.ensure_future(guard.call(busy)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(BulkheadFull):
+            await guard.call(ok)
+        assert guard.counts['rejected_full'] == 1
+        # A full bulkhead is back-pressure, not a dependency failure
+        assert guard.breaker.failures == 0
+        release.set()
+        assert await asyncio.gather(*running) == ['done', 'done']
+        assert await guard.call(ok) == 'ok'
+
+    run(scenario())
+
+
+def test_bulkhead_full_gives_back_the_half_open_trial():
+    async def scenario():
+        guard = Guard('dep', timeout=5, max_concurrent=1, queue_timeout=0.05,
+                      failure_threshold=1, reset_timeout=0.05)
+        release = asyncio.Event()
+
+        async def busy():
+            await release.wait()
+
+        holder = asyncio.ensure_future(guard.call(busy))
+        await asyncio.sleep(0)
+        guard.breaker.record_failure(time.monotonic())
+        await asyncio.sleep(0.06)
+        with pytest.raises(BulkheadFull):
+            await guard.call(ok)
+        release.set()
+        await holder
+        guard.breaker.state, guard.breaker.opened_at = OPEN, 0.0
+        assert await guard.call(ok) == 'ok'
+
+    run(scenario())
+
+
+def test_ignored_exceptions_propagate_without_tripping_the_breaker():
+    async def scenario():
+        guard = Guard('dep', timeout=1, failure_threshold=1, ignore=(CardError,))
+
+        def declined():
+            raise CardError("card declined")
+
+        for _ in range(3):
+            with pytest.raises(CardError):
+                await guard.call(declined)
+        assert guard.breaker.state == CLOSED
+        assert guard.counts['errors'] == 0
+        assert await guard.call(ok) == 'ok'
+
+    run(scenario())
+
+
+def test_guard_defers_while_stripe_hangs_then_recovers():
+    """call_or gives None while a call hangs or the circuit is open; once it
+    resets, the same call goes through with the same idempotency key."""
+    async def scenario():
+        stripe_guard = Guard('stripe', timeout=0.05, max_concurrent=2, failure_threshold=2,
+                             reset_timeout=0.1, ignore=(CardError,))
+        calls = []
+        mode = {'stripe': 'hang'}
+
+        def create_checkout_session(game_info, total_price, user_id, commit_token):
+            calls.append(commit_token)
+            if mode['stripe'] == 'hang':
+                time.sleep(0.2)
+            return SimpleNamespace(id='cs_test_1', url='https://checkout.stripe.com/c/pay/cs_test_1')
+
+        args = ({'game_name': 'Game1'}, 30.0, '42', 'token-1')
+        for _ in range(2):
+            started = time.monotonic()
+            assert await stripe_guard.call_or(None, create_checkout_session, *args) is None
+            assert time.monotonic() - started < 0.15
+        assert stripe_guard.breaker.state == OPEN
+
+        # Open circuit: deferred at once, Stripe isn't called
+        assert await stripe_guard.call_or(None, create_checkout_session, *args) is None
+        assert len(calls) == 2
+
+        # The payment stage retries after reset_timeout and Stripe is back
+        mode['stripe'] = 'up'
+        await asyncio.sleep(0.25)
+        session = await stripe_guard.call(create_checkout_session, *args)
+        assert session.id == 'cs_test_1'
+        assert calls == ['token-1'] * 3
+        assert stripe_guard.breaker.state == CLOSED
+
+    run(scenario())
+
+
+def test_deferred_payment_fallback_in_commit_registration(tmp_path, monkeypatch, bot_dependencies):
+    """get_cust_amount takes the registration while Stripe hangs, and the
+    pipeline's payment stage sends the link once Stripe is back."""
+    import reg_bot1
+    from common.registration import Registration
+    from common.user_cache import UserStateCache
+
+    game_info = {'game_id': 'OP1', 'game_name': 'Game1', 'place': 'Riga', 'date': '2025-03-01',
+                 'time': '19:00', 'price_per_person': '15', 'spots_left': '10'}
+    mode = {'stripe': 'hang'}
+    calls, replies, sent, jobs, reserved = [], [], [], [], []
+
+    def create_checkout_session(game_info, total_price, user_id, commit_token):
+        calls.append(commit_token)
+        if mode['stripe'] == 'hang':
+            time.sleep(0.2)
+        return SimpleNamespace(id='cs_test_1', url='https://checkout.stripe.com/c/pay/cs_test_1')
+
+    async def changed(game_id, reason):
+        pass
+
+    async def submit(job_id, data):
+        jobs.append((job_id, data))
+
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+
+    async def send_message(chat_id, text):
+        sent.append((chat_id, text))
+
+    user_data = UserStateCache(str(tmp_path / 'user_data.json'))
+    monkeypatch.setattr(reg_bot1, 'user_data', user_data)
+    monkeypatch.setattr(reg_bot1, 'create_checkout_session', create_checkout_session)
+    monkeypatch.setattr(reg_bot1, 'stripe_guard', Guard('stripe', timeout=0.05, failure_threshold=2))
+    monkeypatch.setattr(reg_bot1, 'reserve_game_spots', lambda game_id, spots: reserved.append(spots) or True)
+    monkeypatch.setattr(reg_bot1, 'bot_host', SimpleNamespace(catalog=SimpleNamespace(changed=changed)))
+    monkeypatch.setattr(reg_bot1, 'registration_pipeline', SimpleNamespace(submit=submit))
+
+    async def scenario():
+        (await user_data.load('42')).append(Registration.from_dict(
+            {'lang': 'en', 'full_name': 'Ana', 'email': 'ana@example.com'}))
+        update = SimpleNamespace(message=SimpleNamespace(
+            from_user=SimpleNamespace(id=42), text='2', reply_text=reply_text))
+        state = await reg_bot1.get_cust_amount(update, SimpleNamespace(chat_data={'game_info': game_info}))
+        assert state == reg_bot1.MAIN_MENU
+
+        mode['stripe'] = 'up'
+        await reg_bot1.deferred_payment_stage(jobs[0][1], SimpleNamespace(send_message=send_message))
+
+    run(scenario())
+    registration = user_data['42'][-1]
+    commit_token = registration['commit_token']
+    # Taken without a link, then linked by the payment stage with the same key
+    assert reserved == [2]
+    assert jobs[0][0] == commit_token and jobs[0][1]['session_id'] is None
+    assert reg_bot1.t('payment_link_deferred', 'en') in replies[0]
+    assert calls == [commit_token] * 2
+    assert registration['session_id'] == 'cs_test_1' and registration['payment_status'] is None
+    assert sent == [('42', "Click this link to pay: https://checkout.stripe.com/c/pay/cs_test_1")]
+
+
+def test_call_or_does_not_swallow_other_errors():
+    async def scenario():
+        guard = Guard('stripe', timeout=1, ignore=(CardError,))
+
+        def declined(*args):
+            raise CardError("card declined")
+
+        with pytest.raises(CardError):
+            await guard.call_or(None, declined)
+
+    run(scenario())
@@ -0,0 +1,86 @@
+"""Record anonymized traffic with UpdateRecorder and replay it against reg_bot1."""
+
+import argparse
+import asyncio
+import json
+
+import pytest
+
+from conftest import REPO_ROOT
+
+telegram = pytest.importorskip('telegram')
+from telegram import Update  # noqa: E402
+
+from common.traffic import ANON_TEXT, UpdateRecorder, read_capture, replay  # noqa: E402
+
+USER = 424242
+OTHER = 515151
+
+
+def message(update_id: int, user_id: int, text: str) -> dict:
+    data = {'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': user_id, 'type': 'private', 'first_name': "Jānis"},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': "Jānis", 'username': "janis"}}
+    if text.startswith('/'):
+        data['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': data}
+
+
+TRAFFIC = [
+    message(1, USER, "/start"),
+    message(2, USER, "English"),
+    message(3, USER, "Jānis Bērziņš"),
+    message(4, USER, "29123456"),
+    {'update_id': 5, 'inline_query': {'id': "q1", 'query': "game janis", 'offset': "",
+                                      'from': {'id': OTHER, 'is_bot': False, 'first_name': "Anna"}}},
+    message(6, OTHER, "/start"),
+]
+
+
+def record(path) -> None:
+    recorder = UpdateRecorder(str(path), keep_texts={"English"}, known_term=lambda term: term == "game")
+
+    async def feed():
+        for data in TRAFFIC:
+            await recorder(Update.de_json(data, None), None)
+
+    asyncio.run(feed())
+    recorder.close()
+
+
+def test_recorder_anonymizes_and_refuses_to_append(tmp_path):
+    path = tmp_path / "capture.jsonl"
+    record(path)
+    lines = read_capture(str(path))
+    assert len(lines) == len(TRAFFIC)
+    raw = path.read_text(encoding='utf-8')
+    for secret in ("Jānis", "janis", "29123456", str(USER), str(OTHER)):
+        assert secret not in raw
+    texts = [line['u']['message']['text'] for line in lines if 'message' in line['u']]
+    assert texts[:3] == ["/start", "English", ANON_TEXT]
+    assert texts[3].isdigit() and len(texts[3]) == 8
+    assert lines[4]['u']['inline_query']['query'] == "game #anon"
+    # Same user, same pseudonym
+    assert lines[0]['u']['message']['from']['id'] == lines[1]['u']['message']['from']['id']
+
+    with pytest.raises(FileExistsError):
+        UpdateRecorder(str(path))
+
+
+def test_replay_runs_a_recorded_capture(tmp_path, monkeypatch, bot_dependencies):
+    path = tmp_path / "capture.jsonl"
+    record(path)
+    monkeypatch.chdir(REPO_ROOT)
+    monkeypatch.setenv('BOT_TOKEN', "123456:replay")
+    args = argparse.Namespace(capture=str(path), bot='reg_bot1', speed=0.0, label='test',
+                              telegram_latency=0.0, stripe_latency=0.0, smtp_latency=0.0,
+                              handle_timeout=20.0, drain_timeout=5.0)
+    result = replay(args)
+
+    assert result['updates'] == len(TRAFFIC)
+    assert result['handled'] == len(TRAFFIC)
+    assert result['unfinished'] == 0
+    assert result['latency_ms']['/start']['count'] == 2
+    assert result['telegram_calls'].get('sendMessage', 0) >= 2
+    assert result['telegram_calls'].get('answerInlineQuery') == 1
+    json.dumps(result)
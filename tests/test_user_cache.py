@@ -0,0 +1,48 @@
+"""Per-user saves stream the store and keep other users and stored entry order intact."""
+
+import asyncio
+import json
+
+from common.registration import Registration
+from common.user_cache import UserStateCache, merge_registrations
+
+
+def test_merge_keeps_stored_order_and_appends_new_entries():
+    stored = [
+        {'session_id': 'a', 'payment_status': 'complete'},
+        {'game_id': 'OP1'},
+        {'session_id': 'b', 'payment_status': 'pending'},
+    ]
+    cached = [{'session_id': 'b', 'lang': 'en'}, {'session_id': 'c'}, {'session_id': 'a', 'lang': 'ru'}]
+    assert merge_registrations(stored, cached) == [
+        {'session_id': 'a', 'payment_status': 'complete', 'lang': 'ru'},
+        {'session_id': 'b', 'payment_status': 'pending', 'lang': 'en'},
+        {'session_id': 'c'},
+    ]
+
+
+def test_save_rewrites_only_that_user(tmp_path):
+    data_file = tmp_path / 'user_data.json'
+    store = {
+        '1': [{'session_id': 's1', 'payment_status': 'complete', 'name': 'Ана'}],
+        '2': [{'session_id': 'old'}, {'session_id': 's2', 'payment_status': 'pending'}],
+        '3': [{'invoice_number': 'INV-3', 'note': 'tab\there "quoted"'}],
+    }
+    data_file.write_text(json.dumps(store, ensure_ascii=False), encoding='utf-8')
+
+    async def scenario():
+        cache = UserStateCache(str(data_file))
+        registrations = await cache.load('2')
+        registrations[1]['lang'] = 'en'
+        registrations.append(Registration.from_dict({'session_id': 'new'}))
+        await cache.save('2')
+        (await cache.load('4')).append(Registration.from_dict({'session_id': 's4'}))
+        await cache.save('4')
+
+    asyncio.run(scenario())
+    saved = json.loads(data_file.read_text(encoding='utf-8'))
+    assert list(saved) == ['1', '2', '3', '4']
+    assert saved['1'] == store['1'] and saved['3'] == store['3']
+    assert [reg['session_id'] for reg in saved['2']] == ['old', 's2', 'new']
+    assert saved['2'][1] == {'session_id': 's2', 'payment_status': 'pending', 'lang': 'en'}
+    assert saved['4'] == [{'session_id': 's4'}]